@@ -1,5 +1,6 @@
 from pydantic_settings import BaseSettings
 from functools import lru_cache
+from typing import Literal
 
 
 class Settings(BaseSettings):
@@ -19,6 +20,55 @@ class Settings(BaseSettings):
     UPLOAD_ALLOWED_EXTENSIONS: list[str] = [
         ".pdf", ".ppt", ".pptx", ".doc", ".docx", ".txt", ".odp", ".odt"
     ]
+    CONVERT_CONCURRENCY: int = 0  # Office-to-PDF conversions at once per machine (all workers); 0 = half the cores
+    CONVERT_TIMEOUT_SECONDS: float = 120.0  # A conversion running longer is killed and reported as failed
+    OFFICE_POOL_SIZE: int = 2  # Warm LibreOffice (unoserver) daemons per app worker; 0 = one-shot CLI per document
+    OFFICE_UNOSERVER: str = "unoserver"  # unoserver executable (needs a Python with the uno module)
+    OFFICE_RECYCLE_AFTER_JOBS: int = 50  # Conversions before a daemon is replaced with a fresh one
+    OFFICE_START_TIMEOUT_SECONDS: float = 60.0  # A daemon not answering by then counts as failed to start
+    OFFICE_HEALTH_INTERVAL_SECONDS: float = 30.0  # How often idle daemons are pinged and replaced if dead
+    # Where uploads and rendered pages are kept
+    STORAGE_BACKEND: Literal["local", "s3"] = "local"  # s3: any S3-compatible store, shared by all API replicas
+    STORAGE_LOCAL_ROOT: str = "."  # local: uploads/ lives under this directory
+    STORAGE_CACHE_DIR: str = "storage_cache"  # s3: local copies of the originals renders and conversions read
+    STORAGE_S3_BUCKET: str = ""
+    STORAGE_S3_ENDPOINT_URL: str = ""  # e.g. http://localhost:9000 for MinIO; empty = AWS
+    STORAGE_S3_REGION: str = "us-east-1"
+    STORAGE_S3_ACCESS_KEY: str = ""  # Empty = boto3's default credential chain
+    STORAGE_S3_SECRET_KEY: str = ""
+    STORAGE_S3_PUBLIC_URL: str = ""  # Base URL clients fetch objects from (CDN or public bucket); empty = presigned URLs
+    STORAGE_PRESIGN_SECONDS: int = 3600  # Lifetime of presigned page-image URLs
+    # WebSocket fan-out settings
+    WS_SEND_QUEUE_SIZE: int = 256  # Max frames buffered per socket before the slow-consumer policy applies
+    WS_SEND_TIMEOUT_SECONDS: float = 10.0  # A single send stuck longer than this drops the socket
+    WS_SLOW_CONSUMER_POLICY: Literal["drop", "coalesce"] = "coalesce"
+    WS_REPLAY_MAXLEN: int = 1000  # Events kept per session for reconnecting clients
+    WS_REPLAY_TTL_SECONDS: int = 60 * 60 * 24  # Idle session logs expire after a day
+    WS_BATCH_INTERVAL_MS: int = 100  # Tick for merging new_response/upvote frames; 0 sends each one
+    # Cached live state pushed to guests as a snapshot on connect
+    LIVE_STATE_TTL_SECONDS: int = 60 * 60 * 24
+    JOIN_CACHE_TTL_SECONDS: int = 300  # Guest join payload cached in Redis; writes invalidate it sooner
+    LIVE_SNAPSHOT_MAX_RESPONSES: int = 500  # Top responses (by upvotes) included in a snapshot
+    WORD_CLOUD_TOP_K: int = 50  # Terms kept in the live word cloud (pushed deltas and default reads)
+    # Audience response ingestion
+    RESPONSE_INGEST_MODE: Literal["direct", "buffered"] = "direct"  # buffered: 202 + write-behind batch INSERTs
+    INGEST_BATCH_SIZE: int = 500  # Max responses per multi-row INSERT in buffered mode
+    UPVOTE_FLUSH_INTERVAL_SECONDS: float = 5.0  # How often Redis upvote counters are written to Postgres
+    # Slide metadata (session code, is_active, type) cached for the guest write path
+    SLIDE_CACHE_SIZE: int = 4096  # Slides kept in each worker's in-process LRU
+    SLIDE_CACHE_RECHECK_SECONDS: float = 1.0  # Max staleness of a worker's LRU after an invalidation
+    RATE_LIMIT_GUEST_READS_PER_MINUTE: int = 600  # Per guest (X-Guest-Id), or per IP without one
+    RATE_LIMIT_ADDRESS_READS_PER_MINUTE: int = 20000  # Per IP across all its guests; a venue shares one NAT address
+    RENDER_CACHE_DIR: str = "render_cache"  # Content-addressed cache of rendered PDF pages
+    RENDER_WORKERS: int = 2  # PyMuPDF processes per app worker
+    RENDER_QUEUE_LIMIT: int = 64  # Renders allowed to wait for a process before answering 503
+    RENDER_TIMEOUT_SECONDS: float = 20.0  # A render running longer has its process killed
+    RENDER_DOC_CACHE_SIZE: int = 8  # Open PDFs kept per render process so repeat renders skip parsing; 0 disables
+    RENDER_DOC_CACHE_MAX_MB: int = 1024  # A render process with more resident memory closes its cached PDFs
+    RENDER_WIDTHS: list[int] = [160, 320, 640, 1280, 1920]  # Pixel-width buckets for ?w=; the smallest are thumbnails
+    RENDER_QUALITY: int = 80  # WebP/JPEG quality of sized variants
+    RENDER_PREWARM_WIDTHS: list[int] = [1280]  # WebP widths rendered ahead of time (a phone at 2x)
+    PREFETCH_PAGES: int = 2  # Pages ahead of the presenter rendered speculatively; 0 disables
 
     model_config = {"env_file": ".env", "extra": "ignore"}
 
@@ -0,0 +1,377 @@
+"""
+Office documents converted to PDF in the background.
+
+An uploaded PPT/PPTX/DOC/DOCX/ODP/ODT used to be converted inside the
+request, with the event loop blocked for as long as LibreOffice took. Now
+the upload stores the original, records a job and returns straight away.
+The job runs as a task of the same worker (the file is on its disk). When
+it finishes, the slide and asset point at the PDF, and the session's
+WebSocket gets a ``conversion_update`` frame. The same frame reports
+failures. The conversion itself goes to a warm daemon from
+``app.office_pool``. The PDF is stored next to its source as
+``uploads/{sha256}.pdf``, so ``uploads.store`` can hand it to the next
+upload of the same bytes without converting again.
+
+Job state lives in Redis (``convert:job:{id}``), so any worker can answer
+``GET /api/conversions/{id}``. The worker running a job keeps renewing a
+short lease on it (``convert:lease:{id}``). A job whose lease has lapsed
+lost its worker to a restart or crash; ``recover`` runs at startup and
+takes those over, so no slide waits on a conversion nobody is doing.
+Conversions are capped per machine, not per
+worker: the workers on one host share ``CONVERT_CONCURRENCY`` leased slots,
+because every conversion is a full office process competing for the same
+cores and memory.
+"""
+import asyncio
+import contextlib
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+from redis.asyncio import Redis
+from sqlalchemy import select
+
+from app import join_cache, live_state, office_pool, prerender, rendering, storage, uploads
+from app.config import get_settings
+from app.database import async_session
+from app.lua import Script
+from app.models import SessionAsset, Slide
+from app.routers.ws import publish_event
+from app.schemas import SlideOut
+
+settings = get_settings()
+
+# Every allowed upload that LibreOffice turns into a PDF
+OFFICE_EXTENSIONS = frozenset({".ppt", ".pptx", ".doc", ".docx", ".odp", ".odt"})
+
+_JOB_TTL_SECONDS = 60 * 60 * 24
+# Renewed every third of this while the job's worker is alive
+_LEASE_SECONDS = 60
+_SLOTS_KEY = f"convert:slots:{socket.gethostname()}"
+
+# Take a slot if fewer than ARGV[1] unexpired leases exist; 1 on success.
+# Leases expire on their own, so a worker that dies mid-job frees its slot.
+_ACQUIRE = Script("""
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[3])
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return 1
+""")
+
+# Extend the job lease only if ARGV[1] still holds it; 1 on success
+_RENEW = Script("""
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+""")
+
+# Conversion tasks, referenced so they are not garbage-collected mid-run
+_tasks: set[asyncio.Task] = set()
+# LibreOffice profiles not in use. Parallel instances need separate profiles,
+# and reusing one skips the first-start setup.
+_free_profiles: list[str] = []
+
+
+class ConversionError(Exception):
+    """LibreOffice failed, timed out or produced no PDF."""
+
+
+def _job_key(job_id: str) -> str:
+    return f"convert:job:{job_id}"
+
+
+def _lease_key(job_id: str) -> str:
+    return f"convert:lease:{job_id}"
+
+
+def _concurrency() -> int:
+    return settings.CONVERT_CONCURRENCY or max(1, (os.cpu_count() or 2) // 2)
+
+
+async def get(redis: Redis, job_id: str) -> dict | None:
+    job = await redis.hgetall(_job_key(job_id))
+    return job or None
+
+
+async def _update(redis: Redis, job_id: str, **fields) -> None:
+    await redis.hset(_job_key(job_id), mapping={k: "" if v is None else str(v) for k, v in fields.items()})
+
+
+@contextlib.asynccontextmanager
+async def _slot(redis: Redis):
+    """Hold one of this machine's conversion slots for the duration of the block."""
+    token = uuid.uuid4().hex
+    lease_ms = int((settings.CONVERT_TIMEOUT_SECONDS + 30) * 1000)
+    delay = 0.1
+    while not await _ACQUIRE(redis, [_SLOTS_KEY], [_concurrency(), lease_ms, token]):
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.5)
+    try:
+        yield
+    finally:
+        await redis.zrem(_SLOTS_KEY, token)
+
+
+async def _hold_lease(redis: Redis, job_id: str, token: str) -> None:
+    """Keep the job's lease alive until cancelled."""
+    while True:
+        await asyncio.sleep(_LEASE_SECONDS / 3)
+        try:
+            if not await _RENEW(redis, [_lease_key(job_id)], [token, _LEASE_SECONDS]):
+                print(f"[convert] Lost the lease on job {job_id}")
+        except Exception as e:
+            print(f"[convert] Error: {e}")
+
+
+async def _convert_cli(source: str, outdir: str) -> None:
+    """One-shot ``libreoffice --convert-to`` (when the daemon pool is disabled)."""
+    profile = _free_profiles.pop() if _free_profiles else tempfile.mkdtemp(prefix="rforum-lo-")
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "libreoffice",
+            f"-env:UserInstallation={Path(profile).as_uri()}",
+            "--headless", "--convert-to", "pdf", "--outdir", outdir, source,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+            # Own process group: the launcher script forks soffice.bin, which must die with it
+            start_new_session=True,
+        )
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), settings.CONVERT_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(proc.pid, signal.SIGKILL)
+            await proc.wait()
+            raise ConversionError("Conversion timed out")
+        if proc.returncode != 0:
+            detail = stderr.decode(errors="replace").strip()[-300:]
+            raise ConversionError(detail or f"LibreOffice exited with {proc.returncode}")
+    finally:
+        _free_profiles.append(profile)
+
+
+async def _convert(source_key: str) -> str:
+    """Convert the stored ``source_key`` to ``uploads/{stem}.pdf`` and return that key."""
+    try:
+        source = await storage.backend.local_path(source_key)
+    except FileNotFoundError:
+        raise ConversionError("The uploaded file is no longer available")
+    # Beside the stored files, so handing the PDF over is a rename
+    outdir = tempfile.mkdtemp(prefix=".convert-", dir=storage.backend.scratch_dir(uploads.UPLOAD_DIR))
+    produced = Path(outdir) / f"{Path(source).stem}.pdf"
+    try:
+        if office_pool.pool.size > 0:
+            try:
+                await office_pool.pool.convert(source, str(produced))
+            except office_pool.OfficeError as e:
+                raise ConversionError(str(e))
+        else:
+            await _convert_cli(source, outdir)
+        if not produced.exists():
+            raise ConversionError("LibreOffice produced no PDF")
+        # Stored next to the upload only once complete
+        key = f"{uploads.UPLOAD_DIR}/{produced.name}"
+        await storage.backend.put(key, str(produced), move=True, content_type="application/pdf")
+        return key
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
+
+
+def _pdf_name(original: str | None, pdf_key: str) -> str:
+    """The uploader's file name with a .pdf extension (the stored name is a hash)."""
+    return f"{os.path.splitext(original)[0]}.pdf" if original else os.path.basename(pdf_key)
+
+
+async def _apply(redis: Redis, job: dict, pdf_key: str | None, error: str | None) -> dict | None:
+    """
+    Point the slide and asset at the PDF (or record the failure). Skipped if
+    a newer upload replaced the file while this job ran. Returns the slide as
+    sent to clients, if there is one.
+    """
+    total_pages, file_hash, paginated = 1, None, False
+    if pdf_key:
+        pdf_path = await storage.backend.local_path(pdf_key)
+        file_hash = await rendering.digest(pdf_path)
+        try:
+            total_pages = await rendering.page_count(pdf_path, file_hash)
+            paginated = True
+        except Exception:
+            pass
+    status = "done" if pdf_key else "failed"
+    slide_out = None
+    async with async_session() as db:
+        if pdf_key:
+            # A release of an older copy must not delete the PDF before it is referenced
+            await uploads.lock(db, f"/{pdf_key}")
+            if not await storage.backend.exists(pdf_key):
+                raise ConversionError("Converted file was removed")
+        slide = None
+        if job["slide_id"]:
+            slide = (await db.execute(
+                select(Slide).where(Slide.id == uuid.UUID(job["slide_id"])).with_for_update()
+            )).scalar_one_or_none()
+            content_json = dict(slide.content_json or {}) if slide else {}
+            if (content_json.get("conversion") or {}).get("job_id") != job["id"]:
+                slide = None
+        if slide is not None:
+            content_json["conversion"] = {"job_id": job["id"], "status": status}
+            if error:
+                content_json["conversion"]["error"] = error
+            if pdf_key:
+                content_json["file_name"] = _pdf_name(content_json.get("file_name"), pdf_key)
+                content_json["file_url"] = f"/{pdf_key}"
+                content_json["file_type"] = "application/pdf"
+                content_json["file_page"] = 1
+                content_json["total_pages"] = total_pages
+                content_json["file_hash"] = file_hash
+                content_json.pop("prerender", None)
+            slide.content_json = content_json
+        if pdf_key and job["asset_id"]:
+            asset = (await db.execute(
+                select(SessionAsset).where(SessionAsset.id == uuid.UUID(job["asset_id"]))
+            )).scalar_one_or_none()
+            if asset is not None and asset.file_url == job["source_url"]:
+                asset.file_name = _pdf_name(asset.file_name, pdf_key)
+                asset.file_url = f"/{pdf_key}"
+                asset.file_type = "application/pdf"
+        await db.commit()
+        if slide is not None:
+            if job["session_code"]:
+                await join_cache.invalidate(redis, job["session_code"])
+                await live_state.update_slide(redis, job["session_code"], slide)
+            slide_out = SlideOut.model_validate(slide).model_dump(mode="json")
+            # The frame goes to everyone in the session, guests included
+            slide_out["content_json"] = live_state.guest_content_json(slide_out["content_json"])
+            if paginated:
+                prerender.schedule(redis, slide.id, pdf_path, file_hash, total_pages)
+    if pdf_key:
+        # The original is no longer needed once its PDF is in place; the PDF
+        # itself stays only if something still points at it
+        await uploads.release(job["source_url"])
+        await uploads.release(f"/{pdf_key}")
+    return slide_out
+
+
+async def _run(redis: Redis, job: dict, token: str) -> None:
+    job_id = job["id"]
+    lease = asyncio.create_task(_hold_lease(redis, job_id, token))
+    try:
+        await _execute(redis, job)
+    finally:
+        lease.cancel()
+        with contextlib.suppress(Exception):
+            await redis.delete(_lease_key(job_id))
+
+
+async def _execute(redis: Redis, job: dict) -> None:
+    job_id = job["id"]
+    pdf_key = error = None
+    try:
+        async with _slot(redis):
+            await _update(redis, job_id, status="running", started_at=time.time())
+            pdf_key = await _convert(job["source_url"].lstrip("/"))
+    except ConversionError as e:
+        error = str(e)
+    except Exception as e:
+        print(f"[convert] Error: {e}")
+        error = "Conversion failed"
+    try:
+        slide = await _apply(redis, job, pdf_key, error)
+    except Exception as e:
+        print(f"[convert] Error: {e}")
+        slide, pdf_key, error = None, None, "Could not save the converted file"
+    status = "done" if pdf_key else "failed"
+    await _update(
+        redis, job_id, status=status, error=error, finished_at=time.time(),
+        file_url=f"/{pdf_key}" if pdf_key else None,
+    )
+    if job["session_code"]:
+        await publish_event(redis, job["session_code"], {
+            "event": "conversion_update",
+            "data": {
+                "job_id": job_id, "status": status, "error": error,
+                "slide_id": job["slide_id"] or None, "asset_id": job["asset_id"] or None,
+                "slide": slide,
+            },
+        })
+
+
+async def submit(
+    redis: Redis,
+    job_id: str,
+    source_url: str,
+    *,
+    user_id: uuid.UUID,
+    session_code: str | None,
+    slide_id: uuid.UUID | None = None,
+    asset_id: uuid.UUID | None = None,
+) -> dict:
+    """
+    Queue the conversion of the upload at ``source_url``. The caller has
+    already committed ``{"job_id": job_id, "status": "queued"}`` under the
+    slide's ``content_json["conversion"]``; the job only updates a slide
+    that still carries its id.
+    """
+    job = {
+        "id": job_id,
+        "status": "queued",
+        "user_id": str(user_id),
+        "session_code": session_code or "",
+        "slide_id": str(slide_id) if slide_id else "",
+        "asset_id": str(asset_id) if asset_id else "",
+        "source_url": source_url,
+        "created_at": str(time.time()),
+    }
+    key = _job_key(job_id)
+    token = uuid.uuid4().hex
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.set(_lease_key(job_id), token, ex=_LEASE_SECONDS)
+        pipe.hset(key, mapping=job)
+        pipe.expire(key, _JOB_TTL_SECONDS)
+        await pipe.execute()
+    _start(redis, job, token)
+    return job
+
+
+def _start(redis: Redis, job: dict, token: str) -> None:
+    task = asyncio.create_task(_run(redis, job, token), name=f"convert:{job['id']}")
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def recover(redis: Redis) -> int:
+    """
+    Take over the queued or running jobs whose worker went away without
+    finishing them, and return how many. Each is claimed through its lapsed
+    lease, so a job is picked up by one worker only and never while its own
+    worker is still alive. A job whose upload is gone fails the usual way.
+    """
+    recovered = 0
+    async for key in redis.scan_iter(match=_job_key("*"), count=500):
+        job = await redis.hgetall(key)
+        if job.get("status") not in ("queued", "running") or "id" not in job:
+            continue
+        token = uuid.uuid4().hex
+        if not await redis.set(_lease_key(job["id"]), token, nx=True, ex=_LEASE_SECONDS):
+            continue
+        await _update(redis, job["id"], status="queued")
+        _start(redis, job, token)
+        recovered += 1
+    return recovered
+
+
+def cancel_all() -> None:
+    for task in _tasks:
+        task.cancel()
@@ -0,0 +1,151 @@
+"""
+Write-behind ingestion of audience responses.
+
+With ``RESPONSE_INGEST_MODE=buffered``, ``submit_response`` validates the
+submission, assigns its id and timestamp, and appends it to the
+``ingest:responses`` Redis Stream. Then it answers 202 without a
+transaction. The room still sees the response at once, because the live
+fan-out does not wait for Postgres. A writer task in every worker drains
+the stream through a consumer group and inserts whole batches with one
+multi-row INSERT.
+
+Entries are acknowledged only after their batch has been committed. If a
+worker dies, a peer reclaims the entries that worker left unacknowledged.
+Inserts ignore ids that already exist, so a batch that is replayed is
+harmless. The ids of queued responses are also kept in the
+``ingest:pending`` set until their batch is done, written or rejected, so
+``upvotes`` can tell a row that is still coming from one that never will.
+"""
+import asyncio
+import time
+
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+
+from app.config import get_settings
+from app.database import async_session
+from app.models import Response
+from app.schemas import ResponseOut
+
+settings = get_settings()
+
+STREAM = "ingest:responses"
+GROUP = "response-writers"
+PENDING = "ingest:pending"
+
+# Entries read but not acknowledged for this long belong to a dead worker
+_RECLAIM_IDLE_MS = 60_000
+_RECLAIM_EVERY_SECONDS = 30
+
+# Per-process counters, reported by stats()
+_counters = {"written": 0, "batches": 0, "rejected": 0}
+
+
+async def enqueue(redis: Redis, response: ResponseOut) -> None:
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.sadd(PENDING, str(response.id))
+        pipe.xadd(STREAM, {"r": response.model_dump_json()})
+        await pipe.execute()
+
+
+async def pending(redis: Redis, response_ids: list[str]) -> list[bool]:
+    """Whether each response is still queued for ingestion."""
+    if not response_ids:
+        return []
+    return [bool(flag) for flag in await redis.smismember(PENDING, response_ids)]
+
+
+async def _ensure_group(redis: Redis) -> None:
+    try:
+        await redis.xgroup_create(STREAM, GROUP, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def _write(rows: list[dict]) -> None:
+    stmt = insert(Response).on_conflict_do_nothing(index_elements=[Response.id])
+    async with async_session() as db:
+        try:
+            await db.execute(stmt, rows)
+            await db.commit()
+            _counters["written"] += len(rows)
+            return
+        except IntegrityError:
+            await db.rollback()
+        # One bad row (e.g. its slide was deleted meanwhile) must not wedge
+        # the queue: retry one by one and drop only the rows that fail
+        for row in rows:
+            try:
+                await db.execute(stmt, [row])
+                await db.commit()
+                _counters["written"] += 1
+            except IntegrityError:
+                await db.rollback()
+                _counters["rejected"] += 1
+
+
+async def _flush(redis: Redis, entries: list) -> None:
+    rows = [ResponseOut.model_validate_json(fields["r"]).model_dump() for _, fields in entries]
+    await _write(rows)
+    ids = [entry_id for entry_id, _ in entries]
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.xack(STREAM, GROUP, *ids)
+        pipe.xdel(STREAM, *ids)
+        pipe.srem(PENDING, *[str(row["id"]) for row in rows])
+        await pipe.execute()
+    _counters["batches"] += 1
+
+
+async def run_writer(redis: Redis, consumer: str) -> None:
+    """Drain the ingest stream into Postgres until cancelled."""
+    await _ensure_group(redis)
+    next_reclaim = 0.0
+    while True:
+        try:
+            entries = []
+            if time.monotonic() >= next_reclaim:
+                next_reclaim = time.monotonic() + _RECLAIM_EVERY_SECONDS
+                claimed = await redis.xautoclaim(
+                    STREAM, GROUP, consumer, _RECLAIM_IDLE_MS,
+                    start_id="0-0", count=settings.INGEST_BATCH_SIZE,
+                )
+                entries = claimed[1]
+            if not entries:
+                result = await redis.xreadgroup(
+                    GROUP, consumer, {STREAM: ">"},
+                    count=settings.INGEST_BATCH_SIZE, block=1000,
+                )
+                entries = result[0][1] if result else []
+            if entries:
+                await _flush(redis, entries)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[ingest] Error: {e}")
+            await asyncio.sleep(1)
+
+
+async def stats(redis: Redis) -> dict:
+    """Queue depth and lag of the ingest stream, plus this worker's write counters."""
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.xlen(STREAM)
+        pipe.xrange(STREAM, count=1)
+        queued, oldest = await pipe.execute()
+    try:
+        in_flight = (await redis.xpending(STREAM, GROUP))["pending"]
+    except ResponseError:
+        in_flight = 0
+    lag_seconds = None
+    if oldest:
+        enqueued_ms = int(oldest[0][0].split("-")[0])
+        lag_seconds = round(max(0.0, time.time() - enqueued_ms / 1000), 3)
+    return {
+        "mode": settings.RESPONSE_INGEST_MODE,
+        "queued": queued,
+        "in_flight": in_flight,
+        "lag_seconds": lag_seconds,
+        **_counters,
+    }
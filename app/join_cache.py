@@ -0,0 +1,91 @@
+"""
+Cached guest join payload.
+
+``GET /api/sessions/join/{code}`` is what every guest's phone calls first,
+so a room of hundreds joins within the same minute. The payload (the
+session, its slides, private file paths stripped) is built once, serialized
+with orjson and kept in Redis:
+
+    join:{code}           hash    etag, body   (JOIN_CACHE_TTL_SECONDS)
+    join:{code}:version   string  bumped by every invalidation
+
+The routers that change a session or its slides call ``invalidate`` after
+committing. As in ``slide_cache``, a fill only lands if the version still
+has the value read before the DB query, so a worker that read Postgres
+just before a write cannot cache what it read. The TTL is a backstop for
+writes that reach sessions indirectly (deleting a user or an event
+cascades to its sessions).
+
+The ETag is a hash of the body, so a reconnecting client revalidates with
+``If-None-Match`` and gets a 304 while nothing has changed.
+"""
+import hashlib
+
+import orjson
+from redis.asyncio import Redis
+
+from app.config import get_settings
+from app.lua import Script
+
+settings = get_settings()
+
+# Store the payload only if no invalidation happened since the DB read began
+_FILL_IF_CURRENT = Script("""
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then return 0 end
+redis.call('HSET', KEYS[1], 'etag', ARGV[3], 'body', ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+""")
+
+_counters = {"hits": 0, "fills": 0, "stale_fills": 0, "invalidations": 0}
+
+
+def _key(code: str) -> str:
+    return f"join:{code}"
+
+
+def _version_key(code: str) -> str:
+    return f"join:{code}:version"
+
+
+async def get(redis: Redis, code: str) -> tuple[str, str] | None:
+    """The cached ``(etag, body)`` for ``code``, if any."""
+    cached = await redis.hmget(_key(code), "etag", "body")
+    if cached[0] is None or cached[1] is None:
+        return None
+    _counters["hits"] += 1
+    return cached[0], cached[1]
+
+
+async def version(redis: Redis, code: str) -> str:
+    """Read before querying Postgres, then pass to ``fill``."""
+    return await redis.get(_version_key(code)) or "0"
+
+
+async def fill(redis: Redis, code: str, seen_version: str, payload: dict) -> tuple[str, str]:
+    """Serialize ``payload`` and cache it unless invalidated meanwhile; returns ``(etag, body)``."""
+    body = orjson.dumps(payload)
+    etag = f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+    text = body.decode()
+    stored = await _FILL_IF_CURRENT(
+        redis,
+        [_key(code), _version_key(code)],
+        [seen_version, settings.JOIN_CACHE_TTL_SECONDS, etag, text],
+    )
+    _counters["fills" if stored else "stale_fills"] += 1
+    return etag, text
+
+
+async def invalidate(redis: Redis, code: str | None) -> None:
+    if not code:
+        return
+    _counters["invalidations"] += 1
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.delete(_key(code))
+        pipe.incr(_version_key(code))
+        pipe.expire(_version_key(code), settings.LIVE_STATE_TTL_SECONDS)
+        await pipe.execute()
+
+
+def stats() -> dict:
+    return dict(_counters)
@@ -0,0 +1,223 @@
+"""
+Cached per-session live state, pushed to guests as a snapshot frame on connect.
+
+Holds what a guest needs to render the room: whether the session is live,
+the active slide (with private file paths stripped) and the responses to that
+slide. The routers that change any of it write through to Redis, so a room of
+hundreds joining at once is served without touching Postgres.
+
+Redis layout (both keys share ``LIVE_STATE_TTL_SECONDS``):
+
+    live:session:{code}            hash  is_live, slide_id, slide (JSON)
+    live:session:{code}:responses  hash  response id -> ResponseOut JSON
+"""
+import asyncio
+import json
+
+from redis.asyncio import Redis
+from sqlalchemy import select
+
+from app import tally, upvotes, word_cloud
+from app.config import get_settings
+from app.database import async_session
+from app.lua import Script
+from app.models import Response, Session, Slide, SlideType
+from app.schemas import ResponseOut, SlideOut
+
+settings = get_settings()
+
+# Only write when the cached active slide is the one being changed. The hash
+# may not exist yet (no responses when the slide was cached), so its TTL is set here.
+_SET_IF_ACTIVE_SLIDE = Script("""
+if redis.call('HGET', KEYS[1], 'slide_id') ~= ARGV[1] then return 0 end
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return 1
+""")
+
+# Forget the active slide and its responses if it is the one being removed
+_CLEAR_IF_ACTIVE_SLIDE = Script("""
+if redis.call('HGET', KEYS[1], 'slide_id') ~= ARGV[1] then return 0 end
+redis.call('HSET', KEYS[1], 'slide_id', '', 'slide', '')
+redis.call('DEL', KEYS[2])
+return 1
+""")
+
+# Raise a cached response's upvote count; counts only grow, so a late,
+# lower value from a racing request is ignored
+_SET_UPVOTES = Script("""
+if redis.call('HGET', KEYS[1], 'slide_id') ~= ARGV[1] then return 0 end
+local raw = redis.call('HGET', KEYS[2], ARGV[2])
+if not raw then return 0 end
+local response = cjson.decode(raw)
+if (tonumber(response['upvotes']) or 0) >= tonumber(ARGV[3]) then return 0 end
+response['upvotes'] = tonumber(ARGV[3])
+redis.call('HSET', KEYS[2], ARGV[2], cjson.encode(response))
+return 1
+""")
+
+# Only write into state that is already cached; a cold key is rebuilt from the DB
+_SET_IF_PRESENT = Script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return 1
+""")
+
+# One DB rebuild per session per worker, however many sockets arrive at once
+_load_locks: dict[str, asyncio.Lock] = {}
+
+
+def _state_key(session_code: str) -> str:
+    return f"live:session:{session_code}"
+
+
+def _responses_key(session_code: str) -> str:
+    return f"live:session:{session_code}:responses"
+
+
+def guest_content_json(content_json: dict | None) -> dict:
+    """Strip private file paths (and moderator-only render progress) before guests see a slide."""
+    cj = dict(content_json or {})
+    if "file_url" in cj:
+        cj["has_file"] = True
+        del cj["file_url"]
+    cj.pop("file_name", None)
+    cj.pop("prerender", None)
+    return cj
+
+
+def _slide_json(slide: Slide) -> str:
+    data = SlideOut.model_validate(slide).model_dump(mode="json")
+    data["content_json"] = guest_content_json(data["content_json"])
+    return json.dumps(data)
+
+
+def _response_json(response: Response | ResponseOut, live_upvotes: int | None = None) -> str:
+    out = ResponseOut.model_validate(response)
+    if live_upvotes is not None:
+        out.upvotes = live_upvotes
+    return out.model_dump_json()
+
+
+async def set_active_slide(
+    redis: Redis,
+    session_code: str,
+    slide: Slide | None,
+    responses: list[Response],
+    is_live: bool | None = None,
+) -> None:
+    """Replace the cached active slide (``None`` when nothing is active) and its responses."""
+    state = {
+        "slide_id": str(slide.id) if slide else "",
+        "slide": _slide_json(slide) if slide else "",
+    }
+    if is_live is not None:
+        state["is_live"] = int(is_live)
+    # The table lags the Redis upvote counters by up to one flush interval
+    counts = await upvotes.get_counts(redis, slide.id, [r.id for r in responses]) if slide else {}
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(_state_key(session_code), mapping=state)
+        pipe.delete(_responses_key(session_code))
+        if responses:
+            pipe.hset(_responses_key(session_code), mapping={
+                str(r.id): _response_json(r, counts.get(str(r.id))) for r in responses
+            })
+        pipe.expire(_state_key(session_code), settings.LIVE_STATE_TTL_SECONDS)
+        pipe.expire(_responses_key(session_code), settings.LIVE_STATE_TTL_SECONDS)
+        await pipe.execute()
+
+
+async def clear_active_slide(redis: Redis, session_code: str, slide_id) -> None:
+    """Forget the active slide if it is ``slide_id`` (deactivated or deleted)."""
+    await _CLEAR_IF_ACTIVE_SLIDE(
+        redis, [_state_key(session_code), _responses_key(session_code)], [str(slide_id)]
+    )
+
+
+async def update_slide(redis: Redis, session_code: str, slide: Slide) -> None:
+    """Refresh the cached slide content (e.g. the current page) if it is the active one."""
+    await _SET_IF_ACTIVE_SLIDE(
+        redis, [_state_key(session_code), _state_key(session_code)],
+        [str(slide.id), "slide", _slide_json(slide), settings.LIVE_STATE_TTL_SECONDS],
+    )
+
+
+async def put_response(redis: Redis, session_code: str, response: Response | ResponseOut) -> None:
+    """Add or update a response in the cache if it belongs to the active slide."""
+    await _SET_IF_ACTIVE_SLIDE(
+        redis, [_state_key(session_code), _responses_key(session_code)],
+        [str(response.slide_id), str(response.id), _response_json(response), settings.LIVE_STATE_TTL_SECONDS],
+    )
+
+
+async def set_upvotes(redis: Redis, session_code: str, slide_id, response_id, upvotes: int) -> None:
+    """Update a cached response's upvote count if it belongs to the active slide."""
+    await _SET_UPVOTES(
+        redis, [_state_key(session_code), _responses_key(session_code)],
+        [str(slide_id), str(response_id), upvotes],
+    )
+
+
+async def set_live(redis: Redis, session_code: str, is_live: bool) -> None:
+    """Flip the cached ``is_live`` flag when the moderator starts or ends the session."""
+    await _SET_IF_PRESENT(redis, [_state_key(session_code)], ["is_live", int(is_live)])
+
+
+async def _load(redis: Redis, session_code: str) -> bool:
+    """Rebuild the cached state from the database. Returns False for unknown sessions."""
+    async with async_session() as db:
+        session = (await db.execute(
+            select(Session).where(Session.unique_code == session_code)
+        )).scalar_one_or_none()
+        if session is None:
+            return False
+        slide = (await db.execute(
+            select(Slide).where(Slide.session_id == session.id, Slide.is_active == True).limit(1)
+        )).scalar_one_or_none()
+        responses: list[Response] = []
+        if slide is not None:
+            responses = list((await db.execute(
+                select(Response).where(Response.slide_id == slide.id)
+            )).scalars().all())
+    await set_active_slide(redis, session_code, slide, responses, is_live=session.is_live)
+    return True
+
+
+async def get_snapshot(redis: Redis, session_code: str) -> dict | None:
+    """
+    Return ``{"is_live", "slide", "responses"}`` for the session, or ``None``
+    if no such session exists. Responses are ordered like ``list_responses``
+    and capped at ``LIVE_SNAPSHOT_MAX_RESPONSES``, so results are not counted
+    from them: a POLL slide also carries its full option counts under
+    ``tally`` and a WORD_CLOUD slide its top terms under ``words``.
+    """
+    if not await redis.exists(_state_key(session_code)):
+        lock = _load_locks.setdefault(session_code, asyncio.Lock())
+        try:
+            async with lock:
+                if not await redis.exists(_state_key(session_code)):
+                    if not await _load(redis, session_code):
+                        return None
+        finally:
+            if not lock.locked():
+                _load_locks.pop(session_code, None)
+
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.hgetall(_state_key(session_code))
+        pipe.hvals(_responses_key(session_code))
+        state, raw_responses = await pipe.execute()
+
+    responses = [json.loads(raw) for raw in raw_responses]
+    responses.sort(key=lambda r: r["created_at"], reverse=True)
+    responses.sort(key=lambda r: r["upvotes"], reverse=True)
+    slide = json.loads(state["slide"]) if state.get("slide") else None
+    snapshot = {
+        "is_live": state.get("is_live") == "1",
+        "slide": slide,
+        "responses": responses[:settings.LIVE_SNAPSHOT_MAX_RESPONSES],
+    }
+    if slide and slide["type"] == SlideType.POLL.value:
+        snapshot["tally"] = (await tally.get_tally(redis, slide["id"]))["counts"]
+    elif slide and slide["type"] == SlideType.WORD_CLOUD.value:
+        snapshot["words"] = await word_cloud.top_terms(redis, slide["id"])
+    return snapshot
@@ -0,0 +1,25 @@
+"""
+Server-side Lua scripts, called by SHA.
+
+``Script`` sends ``EVALSHA`` so each call carries a 40-byte digest instead
+of the whole script body. A server that has not seen the script yet (after
+a restart or ``SCRIPT FLUSH``) answers NOSCRIPT. The script then falls back
+to one ``EVAL``, which also loads it for every later call. Do not queue
+scripts on a pipeline: a NOSCRIPT reply there would fail the whole batch.
+"""
+import hashlib
+
+from redis.asyncio import Redis
+from redis.exceptions import NoScriptError
+
+
+class Script:
+    def __init__(self, source: str):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode()).hexdigest()
+
+    async def __call__(self, redis: Redis, keys: list | tuple = (), args: list | tuple = ()):
+        try:
+            return await redis.evalsha(self.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            return await redis.eval(self.source, len(keys), *keys, *args)
@@ -1,3 +1,4 @@
+import asyncio
 from contextlib import asynccontextmanager
 import sys
 from pathlib import Path
@@ -7,10 +8,11 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import ORJSONResponse
 from redis.asyncio import Redis
 
+from app import conversion, ingest, office_pool, prerender, rendering, upvotes
 from app.config import get_settings
 from app.database import engine
 from app.routers import auth, responses, sessions, slides, ws, events, analytics
-from app.routers import admin, session_assets
+from app.routers import admin, conversions, results, session_assets
 
 # Ensure the 'rforum' directory is in PYTHONPATH
 sys.path.append(str(Path(__file__).resolve().parent.parent))
@@ -22,8 +24,43 @@ settings = get_settings()
 async def lifespan(app: FastAPI):
     # ── Startup ───────────────────────────────────────
     app.state.redis = Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    upvote_flusher = asyncio.create_task(upvotes.run_flusher(app.state.redis))
+    office_health = asyncio.create_task(office_pool.pool.run_health_checks())
+    try:
+        recovered = await conversion.recover(app.state.redis)
+        if recovered:
+            print(f"[convert] Resumed {recovered} unfinished conversion(s)")
+    except Exception as e:
+        print(f"[convert] Error: {e}")
+    ingest_writer = None
+    if settings.RESPONSE_INGEST_MODE == "buffered":
+        ingest_writer = asyncio.create_task(
+            ingest.run_writer(app.state.redis, consumer=ws.SERVER_ID)
+        )
     yield
     # ── Shutdown ──────────────────────────────────────
+    upvote_flusher.cancel()
+    try:
+        await upvote_flusher
+    except asyncio.CancelledError:
+        pass
+    try:
+        await upvotes.flush(app.state.redis)
+    except Exception as e:
+        print(f"[upvotes] Final flush failed: {e}")
+    if ingest_writer is not None:
+        # Unwritten entries stay in the stream for the next writer to pick up
+        ingest_writer.cancel()
+        try:
+            await ingest_writer
+        except asyncio.CancelledError:
+            pass
+    await ws.manager.close()
+    conversion.cancel_all()
+    office_health.cancel()
+    await office_pool.pool.close()
+    prerender.cancel_all()
+    rendering.shutdown()
     await app.state.redis.close()
     await engine.dispose()
 
@@ -44,7 +81,7 @@ app.add_middleware(
     allow_origins=settings.CORS_ORIGINS,
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
-    allow_headers=["Authorization", "Content-Type"],
+    allow_headers=["Authorization", "Content-Type", "X-Guest-Id"],
 )
 
 # Uploads are served through the /page/{page_num} endpoint — not as raw static files
@@ -54,11 +91,13 @@ app.include_router(auth.router)
 app.include_router(sessions.router)
 app.include_router(slides.router)
 app.include_router(responses.router)
+app.include_router(results.router)
 app.include_router(events.router)
 app.include_router(analytics.router)
 app.include_router(ws.router)
 app.include_router(admin.router)
 app.include_router(session_assets.router)
+app.include_router(conversions.router)
 
 
 @app.get("/api/health")
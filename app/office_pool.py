@@ -0,0 +1,235 @@
+"""
+A pool of long-lived headless LibreOffice processes for document conversion.
+
+Starting ``libreoffice --headless`` per document costs seconds and hundreds
+of MB before any work starts. Instead each app worker keeps up to
+``OFFICE_POOL_SIZE`` ``unoserver`` daemons. Each one supervises its own
+soffice with a private profile and takes conversion requests over XML-RPC
+on a loopback port. A job borrows a daemon, sends it the input and output
+paths, and hands it back.
+
+Daemons start lazily on first use. One is replaced when:
+
+- it has served ``OFFICE_RECYCLE_AFTER_JOBS`` conversions (soffice leaks),
+- it fails a periodic health check while idle,
+- it dies or drops the connection mid-job (the job is retried once on a
+  fresh one), or
+- a conversion overruns ``CONVERT_TIMEOUT_SECONDS`` (its process group is
+  killed).
+"""
+import asyncio
+import contextlib
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+import xmlrpc.client
+from pathlib import Path
+
+from app.config import get_settings
+
+settings = get_settings()
+
+_HEALTH_TIMEOUT_SECONDS = 5.0
+
+_metrics = {
+    "jobs": 0,
+    "starts": 0,
+    "recycled": 0,
+    "crashes": 0,
+    "health_failures": 0,
+    "timeouts": 0,
+    "start_seconds": 0.0,
+}
+
+
+class OfficeError(Exception):
+    """A daemon could not be started or rejected the document."""
+
+
+class _DaemonGone(Exception):
+    """The daemon died or dropped the connection; another one may succeed."""
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class _Daemon:
+    """One ``unoserver`` process (and the soffice it supervises)."""
+
+    def __init__(self) -> None:
+        self.proc: asyncio.subprocess.Process | None = None
+        self.port = 0
+        self.profile = tempfile.mkdtemp(prefix="rforum-office-")
+        self.jobs = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.returncode is None
+
+    def _proxy(self, timeout: float) -> xmlrpc.client.ServerProxy:
+        transport = xmlrpc.client.Transport()
+        transport.timeout = timeout  # applied to the underlying HTTPConnection
+        return xmlrpc.client.ServerProxy(
+            f"http://127.0.0.1:{self.port}", transport=transport, allow_none=True
+        )
+
+    def _ping(self) -> None:
+        self._proxy(_HEALTH_TIMEOUT_SECONDS).info()
+
+    async def healthy(self) -> bool:
+        if not self.alive:
+            return False
+        try:
+            await asyncio.to_thread(self._ping)
+            return True
+        except (OSError, xmlrpc.client.Error):
+            return False
+
+    async def start(self) -> None:
+        started = time.perf_counter()
+        self.port = _free_port()
+        try:
+            self.proc = await asyncio.create_subprocess_exec(
+                settings.OFFICE_UNOSERVER,
+                "--interface", "127.0.0.1",
+                "--port", str(self.port),
+                "--uno-port", str(_free_port()),
+                "--user-installation", Path(self.profile).as_uri(),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+                # Own process group, so soffice goes down with its supervisor
+                start_new_session=True,
+            )
+        except FileNotFoundError:
+            raise OfficeError(f"{settings.OFFICE_UNOSERVER} is not installed")
+        _metrics["starts"] += 1
+        deadline = time.monotonic() + settings.OFFICE_START_TIMEOUT_SECONDS
+        while not await self.healthy():
+            if not self.alive or time.monotonic() > deadline:
+                await self.stop()
+                raise OfficeError("Office daemon did not start")
+            await asyncio.sleep(0.2)
+        self.jobs = 0
+        _metrics["start_seconds"] += time.perf_counter() - started
+
+    async def stop(self) -> None:
+        if self.proc is None:
+            return
+        if self.proc.returncode is None:
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            await self.proc.wait()
+        self.proc = None
+
+    def _convert(self, source: str, target: str) -> None:
+        try:
+            self._proxy(settings.CONVERT_TIMEOUT_SECONDS + 5).convert(source, None, target, "pdf")
+        except xmlrpc.client.Fault as e:
+            # Faults read "<class 'SomeError'>:message"
+            message = e.faultString.strip().rpartition(">:")[2]
+            raise OfficeError(message[-300:] or "Conversion failed")
+        except (OSError, xmlrpc.client.ProtocolError) as e:
+            raise _DaemonGone() from e
+
+    async def convert(self, source: str, target: str) -> None:
+        self.jobs += 1
+        _metrics["jobs"] += 1
+        try:
+            await asyncio.wait_for(
+                asyncio.to_thread(self._convert, source, target), settings.CONVERT_TIMEOUT_SECONDS
+            )
+        except asyncio.TimeoutError:
+            # Killing the daemon also unblocks the thread waiting on its socket
+            _metrics["timeouts"] += 1
+            await self.stop()
+            raise OfficeError("Conversion timed out")
+
+
+class OfficePool:
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._idle: asyncio.Queue[_Daemon] = asyncio.Queue()
+        self._daemons: list[_Daemon] = []
+        self._busy = 0
+
+    async def _acquire(self) -> _Daemon:
+        if self._idle.empty() and len(self._daemons) < self.size:
+            daemon = _Daemon()
+            self._daemons.append(daemon)
+        else:
+            daemon = await self._idle.get()
+        self._busy += 1
+        try:
+            if not daemon.alive:
+                if daemon.proc is not None:
+                    _metrics["crashes"] += 1
+                await daemon.stop()
+                await daemon.start()
+        except BaseException:
+            self._release(daemon)
+            raise
+        return daemon
+
+    def _release(self, daemon: _Daemon) -> None:
+        self._busy -= 1
+        self._idle.put_nowait(daemon)
+
+    async def convert(self, source: str, target: str) -> None:
+        """Convert ``source`` to the PDF ``target`` (absolute or cwd-relative paths)."""
+        source, target = os.path.abspath(source), os.path.abspath(target)
+        for attempt in (1, 2):
+            daemon = await self._acquire()
+            try:
+                await daemon.convert(source, target)
+                return
+            except _DaemonGone:
+                _metrics["crashes"] += 1
+                await daemon.stop()
+                if attempt == 2:
+                    raise OfficeError("Office daemon crashed during conversion")
+            finally:
+                if daemon.alive and daemon.jobs >= settings.OFFICE_RECYCLE_AFTER_JOBS:
+                    _metrics["recycled"] += 1
+                    await daemon.stop()
+                self._release(daemon)
+
+    async def run_health_checks(self) -> None:
+        """Replace idle daemons that stopped answering, until cancelled."""
+        while True:
+            await asyncio.sleep(settings.OFFICE_HEALTH_INTERVAL_SECONDS)
+            for _ in range(self._idle.qsize()):
+                daemon = self._idle.get_nowait()
+                try:
+                    if daemon.proc is not None and not await daemon.healthy():
+                        _metrics["health_failures"] += 1
+                        await daemon.stop()
+                        await daemon.start()
+                except Exception as e:
+                    print(f"[office] Error: {e}")
+                finally:
+                    self._idle.put_nowait(daemon)
+
+    async def close(self) -> None:
+        for daemon in self._daemons:
+            await daemon.stop()
+            shutil.rmtree(daemon.profile, ignore_errors=True)
+        self._daemons.clear()
+
+    def stats(self) -> dict:
+        starts = _metrics["starts"]
+        return {
+            "size": self.size,
+            "running": sum(d.alive for d in self._daemons),
+            "busy": self._busy,
+            **{k: round(v, 4) if isinstance(v, float) else v for k, v in _metrics.items()},
+            "avg_start_seconds": round(_metrics["start_seconds"] / starts, 4) if starts else 0.0,
+        }
+
+
+pool = OfficePool(settings.OFFICE_POOL_SIZE)
@@ -0,0 +1,93 @@
+"""
+Speculative rendering of the pages a presenter is about to show.
+
+Presenters almost always move forward one page at a time. When a
+``page_change`` or ``slide_change`` passes through the WebSocket, the next
+``PREFETCH_PAGES`` pages of the active deck are rendered into the cache.
+The caller then sends clients a ``prefetch`` hint, and they pull those
+images into their HTTP cache before the presenter advances.
+
+Only the slide id is taken from the (client-sent) event. The file, current
+page and page count are read from the database, because the moderator
+saves the slide before announcing the change.
+"""
+import uuid
+
+from redis.asyncio import Redis
+from sqlalchemy import select
+
+from app import rendering, storage
+from app.config import get_settings
+from app.database import async_session
+from app.models import Session, Slide
+
+settings = get_settings()
+
+TRIGGER_EVENTS = frozenset({"page_change", "slide_change"})
+
+_metrics = {"triggers": 0, "pages_rendered": 0, "pages_cached": 0, "skipped_busy": 0}
+
+
+def _slide_id(message: dict) -> uuid.UUID | None:
+    data = message.get("data")
+    if not isinstance(data, dict):
+        return None
+    try:
+        return uuid.UUID(str(data.get("slide_id")))
+    except ValueError:
+        return None
+
+
+async def run(redis: Redis, session_code: str, message: dict) -> dict | None:
+    """
+    Render the pages after the current one for the slide named in ``message``.
+    Returns the hint payload, or ``None`` when there is nothing to prefetch.
+    """
+    slide_id = _slide_id(message)
+    if slide_id is None or settings.PREFETCH_PAGES <= 0:
+        return None
+    async with async_session() as db:
+        content_json = (await db.execute(
+            select(Slide.content_json)
+            .join(Session, Session.id == Slide.session_id)
+            .where(Slide.id == slide_id, Session.unique_code == session_code)
+        )).scalar_one_or_none()
+    content_json = content_json or {}
+    if content_json.get("file_type") != "application/pdf" or not content_json.get("file_url"):
+        return None
+    try:
+        path = await storage.backend.local_path(content_json["file_url"].lstrip("/"))
+    except (FileNotFoundError, ValueError):
+        return None
+
+    _metrics["triggers"] += 1
+    digest = await rendering.digest(path)
+    total = await rendering.page_count(path, digest)
+    current = content_json.get("file_page") or 1
+    pages = [n for n in range(current + 1, current + 1 + settings.PREFETCH_PAGES) if n <= total]
+    ready = []
+    for page_num in pages:
+        missing = [
+            v for v in rendering.WARM_VARIANTS
+            if not await rendering.is_warm(digest, page_num, v)
+        ]
+        if not missing:
+            _metrics["pages_cached"] += 1
+            ready.append(page_num)
+            continue
+        try:
+            for variant in missing:
+                await rendering.warm_page(path, digest, page_num, variant, redis=redis)
+        except rendering.RenderBusy:
+            # Guests are waiting on real pages; a guess is not worth a queue slot
+            _metrics["skipped_busy"] += 1
+            break
+        _metrics["pages_rendered"] += 1
+        ready.append(page_num)
+    if not ready:
+        return None
+    return {"slide_id": str(slide_id), "file_hash": digest, "pages": ready}
+
+
+def stats() -> dict:
+    return {"pages_ahead": settings.PREFETCH_PAGES, **_metrics}
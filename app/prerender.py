@@ -0,0 +1,125 @@
+"""
+Background pre-rendering of uploaded decks.
+
+Rendering lazily means the first guest to open a page pays for it, and that
+is exactly when the whole room is watching. Instead, when a PDF is uploaded
+or replaced, every page is rendered into the cache in the background, in
+the sizes most guests ask for (``rendering.WARM_VARIANTS``). The work runs
+one page at a time, so live guest requests always keep the other render
+processes. Going live runs the same pass again as a warm-up: pages
+already cached cost a stat, and pages missing because the cache was
+cleared get rendered before the audience arrives.
+
+Progress is merged into the slide's ``content_json`` under ``prerender``:
+
+    {"file_hash": ..., "status": "running" | "done", "done": 12, "total": 40, "failed": 0}
+
+Each write is guarded by ``file_hash``, so a pass over a replaced deck can
+never overwrite the progress of the current one.
+"""
+import asyncio
+import time
+import uuid
+
+from redis.asyncio import Redis
+from sqlalchemy import JSON, cast, func, select, update
+from sqlalchemy.dialects.postgresql import JSONB
+
+from app import rendering, storage
+from app.database import async_session
+from app.models import Slide
+
+# At most one pass per slide in this process; a newer upload cancels the older pass
+_tasks: dict[str, asyncio.Task] = {}
+# Warm-up tasks, referenced so they are not garbage-collected mid-run
+_background: set[asyncio.Task] = set()
+
+_REPORT_EVERY_SECONDS = 1.0
+
+
+async def _report(slide_id: uuid.UUID, digest: str, progress: dict) -> None:
+    """Merge ``progress`` into content_json without clobbering concurrent edits (e.g. file_page)."""
+    patch = func.jsonb_build_object("prerender", cast({"file_hash": digest, **progress}, JSONB))
+    async with async_session() as db:
+        await db.execute(
+            update(Slide)
+            .where(Slide.id == slide_id, Slide.content_json["file_hash"].astext == digest)
+            .values(content_json=cast(cast(Slide.content_json, JSONB).op("||")(patch), JSON))
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+
+
+async def _run(redis: Redis, slide_id: uuid.UUID, path: str, digest: str, total: int) -> None:
+    done = failed = 0
+    await _report(slide_id, digest, {"status": "running", "done": 0, "total": total, "failed": 0})
+    reported_at = time.monotonic()
+    for page_num in range(1, total + 1):
+        try:
+            for variant in rendering.WARM_VARIANTS:
+                while True:
+                    try:
+                        await rendering.warm_page(path, digest, page_num, variant, redis=redis)
+                        break
+                    except rendering.RenderBusy:
+                        # Guests come first; try again once the queue drains
+                        await asyncio.sleep(1)
+            done += 1
+        except Exception as e:
+            failed += 1
+            print(f"[prerender] {slide_id} page {page_num}: {e!r}")
+        if time.monotonic() - reported_at >= _REPORT_EVERY_SECONDS:
+            await _report(slide_id, digest, {
+                "status": "running", "done": done, "total": total, "failed": failed,
+            })
+            reported_at = time.monotonic()
+    await _report(slide_id, digest, {"status": "done", "done": done, "total": total, "failed": failed})
+
+
+def schedule(redis: Redis, slide_id: uuid.UUID, path: str, digest: str, total: int) -> None:
+    """Start (or restart) pre-rendering every page of ``path`` for ``slide_id``."""
+    key = str(slide_id)
+    previous = _tasks.get(key)
+    if previous is not None and not previous.done():
+        previous.cancel()
+    task = asyncio.create_task(_run(redis, slide_id, path, digest, total), name=f"prerender:{key}")
+    _tasks[key] = task
+
+    def _forget(t: asyncio.Task) -> None:
+        if _tasks.get(key) is t:
+            del _tasks[key]
+        if not t.cancelled() and t.exception() is not None:
+            print(f"[prerender] {key} failed: {t.exception()!r}")
+
+    task.add_done_callback(_forget)
+
+
+async def _warm_session(redis: Redis, session_id: uuid.UUID) -> None:
+    async with async_session() as db:
+        slides = (await db.execute(
+            select(Slide.id, Slide.content_json).where(Slide.session_id == session_id)
+        )).all()
+    for slide_id, content_json in slides:
+        content_json = content_json or {}
+        if content_json.get("file_type") != "application/pdf" or not content_json.get("file_url"):
+            continue
+        try:
+            path = await storage.backend.local_path(content_json["file_url"].lstrip("/"))
+            digest = await rendering.digest(path)
+            total = await rendering.page_count(path, digest)
+        except Exception as e:
+            print(f"[prerender] warm-up skipped {slide_id}: {e!r}")
+            continue
+        schedule(redis, slide_id, path, digest, total)
+
+
+def warm_session(redis: Redis, session_id: uuid.UUID) -> None:
+    """Re-run the pre-render pass over every deck in a session that is going live."""
+    task = asyncio.create_task(_warm_session(redis, session_id), name=f"prerender-warm:{session_id}")
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+def cancel_all() -> None:
+    for task in [*_tasks.values(), *_background]:
+        task.cancel()
@@ -0,0 +1,170 @@
+"""
+Rate limiting and deduplication for guest-facing endpoints.
+
+Each check is one atomic script call, so a single round trip both decides
+and records the hit. Every policy reads the Redis server clock, so all
+workers agree on the window boundaries.
+
+    fixed         at most ``limit`` hits per ``window``-second bucket
+                  (``limit=1`` makes it a dedup: "once per window")
+    sliding       at most ``limit`` hits in any trailing ``window`` seconds
+    token_bucket  bursts of up to ``limit`` hits, refilled at ``limit`` per ``window``
+
+Guest reads are limited per guest, not per address: a room of hundreds
+joins from behind one venue NAT. A guest is named by the ``X-Guest-Id``
+header its page sends, scoped to the session in the path. An address still
+has a much larger budget of its own, so inventing a new id for every
+request does not lift the limit. Both buckets are checked in the same
+script call.
+"""
+import math
+import re
+import uuid
+from typing import Literal, NamedTuple
+
+from fastapi import HTTPException, Request
+from redis.asyncio import Redis
+
+from app.config import get_settings
+from app.lua import Script
+
+settings = get_settings()
+
+# One hit on each key; ARGV[1] is a unique member for sliding logs, then
+# policy, limit and window (ms) per key. Returns {allowed (0/1), remaining,
+# retry_after_ms} per key, flattened.
+_HIT = Script("""
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+
+local function hit(key, policy, limit, window)
+    if policy == 'fixed' then
+        local n = redis.call('INCR', key)
+        if n == 1 then redis.call('PEXPIRE', key, window) end
+        if n > limit then return {0, 0, redis.call('PTTL', key)} end
+        return {1, limit - n, 0}
+    end
+
+    if policy == 'sliding' then
+        redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+        local n = redis.call('ZCARD', key)
+        if n >= limit then
+            local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+            return {0, 0, tonumber(oldest[2]) + window - now}
+        end
+        redis.call('ZADD', key, now, ARGV[1])
+        redis.call('PEXPIRE', key, window)
+        return {1, limit - n - 1, 0}
+    end
+
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or limit
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(limit, tokens + math.max(0, now - ts) * limit / window)
+    local allowed, retry = 0, 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    else
+        retry = math.ceil((1 - tokens) * window / limit)
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', now)
+    redis.call('PEXPIRE', key, window)
+    return {allowed, math.floor(tokens), retry}
+end
+
+local out = {}
+for i, key in ipairs(KEYS) do
+    local a = 2 + (i - 1) * 3
+    for _, v in ipairs(hit(key, ARGV[a], tonumber(ARGV[a + 1]), tonumber(ARGV[a + 2]))) do
+        table.insert(out, v)
+    end
+end
+return out
+""")
+
+
+class Rule(NamedTuple):
+    policy: Literal["fixed", "sliding", "token_bucket"]
+    limit: int
+    window: float  # seconds
+
+
+class Decision(NamedTuple):
+    allowed: bool
+    remaining: int
+    retry_after: float  # seconds; 0 when allowed
+
+
+GUEST_READ = Rule("token_bucket", settings.RATE_LIMIT_GUEST_READS_PER_MINUTE, 60)
+ADDRESS_READ = Rule("token_bucket", settings.RATE_LIMIT_ADDRESS_READS_PER_MINUTE, 60)
+
+# The frontend's guest ids are short random tokens kept in localStorage
+_GUEST_ID_RE = re.compile(r"^[A-Za-z0-9_-]{4,64}$")
+# Path parameters that place a read in a session, in order of preference
+_ROOM_PARAMS = ("code", "session_id", "slide_id")
+
+
+async def hit_many(redis: Redis, checks: list[tuple[str, Rule]]) -> list[Decision]:
+    """Count one hit against each ``(key, rule)`` in a single round trip."""
+    args = [uuid.uuid4().hex]
+    for _, rule in checks:
+        args += [rule.policy, rule.limit, int(rule.window * 1000)]
+    flat = await _HIT(redis, [f"rl:{key}" for key, _ in checks], args)
+    return [
+        Decision(bool(flat[i]), int(flat[i + 1]), max(0, int(flat[i + 2])) / 1000)
+        for i in range(0, len(flat), 3)
+    ]
+
+
+async def hit(redis: Redis, key: str, rule: Rule) -> Decision:
+    """Count one hit against ``key`` under ``rule``."""
+    return (await hit_many(redis, [(key, rule)]))[0]
+
+
+async def enforce(
+    redis: Redis, key: str, rule: Rule, detail: str = "Too many requests. Please slow down."
+) -> None:
+    """Raise 429 (with ``Retry-After``) when ``key`` is over ``rule``."""
+    _raise_if_denied([await hit(redis, key, rule)], detail)
+
+
+def _raise_if_denied(decisions: list[Decision], detail: str) -> None:
+    denied = [d for d in decisions if not d.allowed]
+    if denied:
+        retry_after = max(d.retry_after for d in denied)
+        raise HTTPException(
+            status_code=429,
+            detail=detail,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+
+def _guest(request: Request) -> str | None:
+    guest = request.headers.get("x-guest-id", "")
+    if not _GUEST_ID_RE.match(guest):
+        return None
+    room = next((str(request.path_params[p]) for p in _ROOM_PARAMS if p in request.path_params), "")
+    return f"{room}:{guest}"
+
+
+def enforce_client(
+    scope: str, rule: Rule = GUEST_READ, detail: str = "Too many requests. Please slow down."
+):
+    """
+    A dependency that limits the guest (or, without a guest id, the client
+    IP) behind the request under ``scope``. Outside ``Depends`` call it as
+    ``await enforce_client(scope)(request)``.
+    """
+    async def dependency(request: Request) -> None:
+        redis = request.app.state.redis
+        guest = _guest(request)
+        if guest is None:
+            checks = [(f"{scope}:{request.client.host}", rule)]
+        else:
+            checks = [
+                (f"{scope}:guest:{guest}", rule),
+                (f"{scope}:addr:{request.client.host}", ADDRESS_READ),
+            ]
+        _raise_if_denied(await hit_many(redis, checks), detail)
+    return dependency
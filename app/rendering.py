@@ -0,0 +1,574 @@
+"""
+Rasterised PDF pages, cached on disk by content.
+
+A rendered page is named after the SHA-256 of the PDF it came from plus the
+page, scale and format. The same bytes therefore always map to the same
+file, and a replaced deck maps to fresh names. The cache never needs
+invalidating, and every entry can be served with a strong ETag. The page
+count of each digest is cached next to its renders, so revalidation never
+opens the PDF.
+
+PyMuPDF work (rasterising, counting pages) runs in a small process pool,
+never on the event loop, so one heavy page cannot stall every socket on
+the worker. Each app worker admits ``RENDER_WORKERS`` jobs at a time. At
+most ``RENDER_QUEUE_LIMIT`` more may wait; beyond that a job fails fast
+with ``RenderBusy``. A job running past ``RENDER_TIMEOUT_SECONDS`` has its
+process killed. A process pool cannot lose one process and keep going, so
+the whole pool is replaced; the jobs that were sharing it are run again
+once on the new pool, and fail with ``RenderBusy`` if that breaks too.
+``stats()`` splits the time of each job into queue wait
+and run time.
+
+Each render process also keeps the last ``RENDER_DOC_CACHE_SIZE`` PDFs it
+opened, keyed by path, mtime and size. Paging through a deck then parses
+its cross-reference table once, not once per image. A process whose
+resident memory passes ``RENDER_DOC_CACHE_MAX_MB`` closes cached documents
+(oldest first) and shrinks MuPDF's own store. Each job reports the
+process's hit and miss counts back, and ``stats()`` sums them.
+
+Besides the 2x PNG master, a page can be requested at a pixel width, which
+is rounded up to one of ``RENDER_WIDTHS`` so a few variants serve every
+screen, and as WebP or JPEG. The smallest bucket doubles as the thumbnail
+for the moderator's page strip.
+
+    {RENDER_CACHE_DIR}/{digest[:2]}/{digest}/pages        page count
+    {RENDER_CACHE_DIR}/{digest[:2]}/{digest}/p{n}@{s}x.{fmt}
+    {RENDER_CACHE_DIR}/{digest[:2]}/{digest}/p{n}w{width}.{fmt}
+
+With a remote ``storage`` backend this directory is only the worker's
+scratch space. ``publish_page`` uploads each image once under
+``storage_key``, and clients are sent to the store for the bytes. Hosts
+then coordinate through the store: one renders and uploads while holding
+the lock, and the others wait until the image shows up there. Rendered
+images are never deleted from the store, so once one is seen there this
+worker stops asking.
+"""
+import asyncio
+import contextlib
+import hashlib
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import NamedTuple
+
+import fitz  # PyMuPDF
+from PIL import Image
+from redis.asyncio import Redis
+
+from app import storage
+from app.config import get_settings
+from app.singleflight import SingleFlight
+
+settings = get_settings()
+
+# Render at 2x for crisp display on phones
+DEFAULT_SCALE = 2
+
+MEDIA_TYPES = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+
+# Served when the URL names the digest (?v=), so the bytes behind it never change
+IMMUTABLE = "public, max-age=31536000, immutable"
+# Served for unversioned URLs: clients keep the image but revalidate (usually a 304)
+REVALIDATE = "no-cache"
+
+# (realpath, mtime_ns, size) -> digest, so a hit costs a stat instead of a full read
+_digests: dict[tuple[str, int, int], str] = {}
+_MAX_DIGESTS = 4096
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 of the file at ``path``, memoised on its size and mtime."""
+    st = os.stat(path)
+    key = (os.path.realpath(path), st.st_mtime_ns, st.st_size)
+    digest = _digests.get(key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        if len(_digests) >= _MAX_DIGESTS:
+            _digests.clear()
+        _digests[key] = digest
+    return digest
+
+
+def remember_digest(path: str, digest: str) -> None:
+    """Record a digest computed elsewhere (e.g. while the upload streamed in)."""
+    st = os.stat(path)
+    if len(_digests) >= _MAX_DIGESTS:
+        _digests.clear()
+    _digests[(os.path.realpath(path), st.st_mtime_ns, st.st_size)] = digest
+
+
+def _entry_dir(digest: str) -> Path:
+    return Path(settings.RENDER_CACHE_DIR) / digest[:2] / digest
+
+
+class Variant(NamedTuple):
+    """How a page is rasterised: at ``scale``, or to ``width`` pixels when set."""
+    scale: float = DEFAULT_SCALE
+    fmt: str = "png"
+    width: int | None = None
+
+
+MASTER = Variant()
+# What pre-rendering and prefetching warm: the sizes most guests end up asking for
+WARM_VARIANTS = [Variant(fmt="webp", width=w) for w in settings.RENDER_PREWARM_WIDTHS]
+
+
+def negotiate(
+    accept: str | None, width: int | None = None, dpr: float | None = None, fmt: str | None = None
+) -> Variant:
+    """
+    Pick the variant for a request. ``width`` (CSS pixels) times ``dpr`` is
+    rounded up to a ``RENDER_WIDTHS`` bucket; ``dpr`` alone picks a whole
+    scale. Without an explicit ``fmt`` WebP goes to clients that accept it,
+    and other sized variants fall back to JPEG. A request with none of these
+    gets the 2x PNG master whatever it accepts, so plain page URLs keep
+    their ETags.
+    """
+    if width is None and dpr is None and fmt is None:
+        return MASTER
+    density = min(max(dpr or 1.0, 1.0), 4.0)
+    if fmt is None:
+        if "image/webp" in (accept or ""):
+            fmt = "webp"
+        else:
+            fmt = "jpeg" if width else "png"
+    if width:
+        buckets = sorted(settings.RENDER_WIDTHS)
+        wanted = width * density
+        bucket = next((b for b in buckets if b >= wanted), buckets[-1])
+        return Variant(fmt=fmt, width=bucket)
+    scale = min(max(round(dpr), 1), 3) if dpr else DEFAULT_SCALE
+    return Variant(scale=scale, fmt=fmt)
+
+
+def _variant_name(page_num: int, variant: Variant) -> str:
+    if variant.width:
+        return f"p{page_num}w{variant.width}.{variant.fmt}"
+    return f"p{page_num}@{variant.scale:g}x.{variant.fmt}"
+
+
+def page_path(digest: str, page_num: int, variant: Variant = MASTER) -> Path:
+    return _entry_dir(digest) / _variant_name(page_num, variant)
+
+
+def storage_key(digest: str, page_num: int, variant: Variant = MASTER) -> str:
+    return f"renders/{digest[:2]}/{digest}/{_variant_name(page_num, variant)}"
+
+
+# Keys of rendered images known to be in the store; cleared whole when full
+_published: set[str] = set()
+_MAX_PUBLISHED = 16384
+
+
+async def _in_store(key: str) -> bool:
+    if key in _published:
+        return True
+    if not await storage.backend.exists(key):
+        return False
+    if len(_published) >= _MAX_PUBLISHED:
+        _published.clear()
+    _published.add(key)
+    return True
+
+
+def etag(digest: str, page_num: int, variant: Variant = MASTER) -> str:
+    size = f"w{variant.width}" if variant.width else f"{variant.scale:g}"
+    return f'"{digest[:32]}-{page_num}-{size}-{variant.fmt}"'
+
+
+def etag_matches(if_none_match: str | None, tag: str) -> bool:
+    """True when an ``If-None-Match`` header names ``tag`` (or ``*``)."""
+    if not if_none_match:
+        return False
+    candidates = {c.strip().removeprefix("W/") for c in if_none_match.split(",")}
+    return "*" in candidates or tag in candidates
+
+
+def _write_atomic(target: Path, data: bytes) -> None:
+    """Write via a temp file and rename so readers never see a partial file."""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, target)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+
+
+# ── Work done inside the render processes ────────────────────────────────────
+
+# (realpath, mtime_ns, size) -> open document, least recently used first
+_docs: "OrderedDict[tuple[str, int, int], fitz.Document]" = OrderedDict()
+_docs_lock = threading.Lock()
+_doc_metrics = {"hits": 0, "misses": 0, "evictions": 0, "pressure_evictions": 0}
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def _resident_mb() -> float | None:
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * _PAGE_SIZE / (1 << 20)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _close_lru() -> bool:
+    """Close the least recently used document; False when none is cached. Hold ``_docs_lock``."""
+    if not _docs:
+        return False
+    _, doc = _docs.popitem(last=False)
+    doc.close()
+    return True
+
+
+@contextlib.contextmanager
+def _document(path: str):
+    """
+    An open ``fitz.Document`` for ``path``, reused across jobs. A document
+    is checked out while in use, so two threads never share one; a second
+    concurrent user of the same file opens its own copy.
+    """
+    st = os.stat(path)
+    key = (os.path.realpath(path), st.st_mtime_ns, st.st_size)
+    with _docs_lock:
+        doc = _docs.pop(key, None)
+        _doc_metrics["hits" if doc is not None else "misses"] += 1
+    if doc is None:
+        doc = fitz.open(path)
+    try:
+        yield doc
+    except BaseException:
+        doc.close()
+        raise
+    if settings.RENDER_DOC_CACHE_SIZE <= 0:
+        doc.close()
+        return
+    with _docs_lock:
+        # An older version of the file, or a copy opened while this one was out
+        for stale in [k for k in _docs if k[0] == key[0]]:
+            _docs.pop(stale).close()
+        _docs[key] = doc
+        while len(_docs) > settings.RENDER_DOC_CACHE_SIZE and _close_lru():
+            _doc_metrics["evictions"] += 1
+        resident = _resident_mb()
+        if resident is not None and resident > settings.RENDER_DOC_CACHE_MAX_MB:
+            while _close_lru():
+                _doc_metrics["pressure_evictions"] += 1
+            fitz.TOOLS.store_shrink(100)
+
+
+def _in_worker(fn, *args):
+    """Run ``fn(*args)`` and hand back this process's document-cache counters with the result."""
+    result = fn(*args)
+    with _docs_lock:
+        docs = {**_doc_metrics, "open": len(_docs)}
+    return result, os.getpid(), docs
+
+
+def _count_pages(path: str, digest: str) -> int:
+    marker = _entry_dir(digest) / "pages"
+    with _document(path) as doc:
+        total = len(doc)
+    _write_atomic(marker, str(total).encode())
+    return total
+
+
+def _encode(pix: "fitz.Pixmap", fmt: str) -> bytes:
+    if fmt == "png":
+        return pix.tobytes("png")
+    if fmt == "jpeg":
+        return pix.tobytes("jpeg", jpg_quality=settings.RENDER_QUALITY)
+    # PyMuPDF cannot write WebP
+    image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    buf = io.BytesIO()
+    image.save(buf, "WEBP", quality=settings.RENDER_QUALITY, method=4)
+    return buf.getvalue()
+
+
+def _render(path: str, digest: str, page_num: int, variant: Variant) -> Path:
+    target = page_path(digest, page_num, variant)
+    if not target.exists():
+        with _document(path) as doc:
+            page = doc[page_num - 1]
+            scale = variant.width / page.rect.width if variant.width else variant.scale
+            pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+            data = _encode(pix, variant.fmt)
+        _write_atomic(target, data)
+    return target
+
+
+# ── Process pool ─────────────────────────────────────────────────────────────
+
+class RenderError(Exception):
+    """Base class for renders the pool refused or abandoned."""
+
+
+class RenderBusy(RenderError):
+    """More renders are already waiting than ``RENDER_QUEUE_LIMIT`` allows."""
+
+
+class RenderTimeout(RenderError):
+    """A render ran past ``RENDER_TIMEOUT_SECONDS``; its process was recycled."""
+
+
+_pool: ProcessPoolExecutor | None = None
+# Identical renders requested at once (a room following a page_change) share one job
+_flights = SingleFlight()
+# Latest document-cache counters reported by each live render process
+_doc_stats: dict[int, dict] = {}
+_slots: asyncio.Semaphore | None = None
+_waiting = 0
+_running = 0
+_metrics = {
+    "jobs": 0,
+    "busy_rejections": 0,
+    "timeouts": 0,
+    "failures": 0,
+    "queue_wait_seconds": 0.0,
+    "max_queue_wait_seconds": 0.0,
+    "run_seconds": 0.0,
+    "max_run_seconds": 0.0,
+}
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool, _slots
+    if _pool is None:
+        # spawn: never fork a process that holds an event loop and open sockets
+        _pool = ProcessPoolExecutor(
+            max_workers=settings.RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    if _slots is None:
+        _slots = asyncio.Semaphore(settings.RENDER_WORKERS)
+    return _pool
+
+
+def _recycle_pool() -> None:
+    """Throw away a pool with a stuck or crashed worker; the next job starts a fresh one."""
+    global _pool
+    pool, _pool = _pool, None
+    if pool is None:
+        return
+    _doc_stats.clear()
+    for process in list(getattr(pool, "_processes", {}).values()):
+        with contextlib.suppress(Exception):
+            process.terminate()
+    # Not cancel_futures: queued jobs must fail with BrokenProcessPool, which
+    # _run retries, rather than be cancelled out from under their callers
+    pool.shutdown(wait=False)
+
+
+async def _run(fn, *args):
+    """
+    Run ``fn(*args)`` in the render pool. At most ``RENDER_WORKERS`` jobs
+    run at once per worker process of the app; the rest wait their turn,
+    up to ``RENDER_QUEUE_LIMIT``.
+    """
+    global _waiting, _running
+    _get_pool()
+    if _waiting >= settings.RENDER_QUEUE_LIMIT:
+        _metrics["busy_rejections"] += 1
+        raise RenderBusy()
+    queued_at = time.perf_counter()
+    _waiting += 1
+    try:
+        await _slots.acquire()
+    finally:
+        _waiting -= 1
+    _running += 1
+    try:
+        started = time.perf_counter()
+        wait = started - queued_at
+        _metrics["queue_wait_seconds"] += wait
+        _metrics["max_queue_wait_seconds"] = max(_metrics["max_queue_wait_seconds"], wait)
+        loop = asyncio.get_running_loop()
+        try:
+            for attempt in range(2):
+                pool = _get_pool()
+                try:
+                    result, pid, docs = await asyncio.wait_for(
+                        loop.run_in_executor(pool, _in_worker, fn, *args), settings.RENDER_TIMEOUT_SECONDS
+                    )
+                    _doc_stats[pid] = docs
+                    return result
+                except asyncio.TimeoutError:
+                    _metrics["timeouts"] += 1
+                    if pool is _pool:
+                        _recycle_pool()
+                    raise RenderTimeout()
+                except BrokenProcessPool:
+                    # Only the first job to see a pool break replaces it; the
+                    # others were just sharing it and run again on the new one
+                    if pool is _pool:
+                        _metrics["failures"] += 1
+                        _recycle_pool()
+            raise RenderBusy()
+        finally:
+            ran = time.perf_counter() - started
+            _metrics["jobs"] += 1
+            _metrics["run_seconds"] += ran
+            _metrics["max_run_seconds"] = max(_metrics["max_run_seconds"], ran)
+    finally:
+        _running -= 1
+        _slots.release()
+
+
+def shutdown() -> None:
+    """Stop the render processes (on app shutdown)."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _document_stats() -> dict:
+    totals = {"hits": 0, "misses": 0, "evictions": 0, "pressure_evictions": 0, "open": 0}
+    for docs in _doc_stats.values():
+        for k in totals:
+            totals[k] += docs.get(k, 0)
+    lookups = totals["hits"] + totals["misses"]
+    return {
+        "capacity_per_process": settings.RENDER_DOC_CACHE_SIZE,
+        **totals,
+        "hit_rate": round(totals["hits"] / lookups, 4) if lookups else 0.0,
+    }
+
+
+def stats() -> dict:
+    jobs = _metrics["jobs"]
+    return {
+        "workers": settings.RENDER_WORKERS,
+        "running": _running,
+        "waiting": _waiting,
+        **{k: round(v, 4) if isinstance(v, float) else v for k, v in _metrics.items()},
+        "avg_queue_wait_seconds": round(_metrics["queue_wait_seconds"] / jobs, 4) if jobs else 0.0,
+        "avg_run_seconds": round(_metrics["run_seconds"] / jobs, 4) if jobs else 0.0,
+        "single_flight": _flights.stats(),
+        "documents": _document_stats(),
+    }
+
+
+# ── Async API used by the routers ────────────────────────────────────────────
+
+async def digest(path: str) -> str:
+    """``file_digest`` off the event loop; a memo hit stays inline."""
+    st = os.stat(path)
+    cached = _digests.get((os.path.realpath(path), st.st_mtime_ns, st.st_size))
+    return cached or await asyncio.to_thread(file_digest, path)
+
+
+async def page_count(path: str, digest: str) -> int:
+    """Number of pages in the PDF, read from the cache when known."""
+    try:
+        return int((_entry_dir(digest) / "pages").read_text())
+    except (OSError, ValueError):
+        return await _flights.do(f"pages:{digest}", lambda: _run(_count_pages, path, digest))
+
+
+async def render_page(
+    path: str,
+    digest: str,
+    page_num: int,
+    variant: Variant = MASTER,
+    redis: Redis | None = None,
+) -> Path:
+    """
+    Return the cached image of a 1-based page, rendering it in the pool on a
+    miss. Concurrent misses for the same image share one render: within this
+    process always, and across app workers when ``redis`` is given.
+    """
+    target = page_path(digest, page_num, variant)
+    if target.exists():
+        return target
+
+    async def compute() -> Path:
+        return await _run(_render, path, digest, page_num, variant)
+
+    async def peek() -> Path | None:
+        if target.exists():
+            return target
+        # A render finished on another host is only visible in the store
+        if storage.backend.remote:
+            remote_key = storage_key(digest, page_num, variant)
+            if await _in_store(remote_key):
+                await storage.backend.get(remote_key, str(target))
+                return target
+        return None
+
+    key = f"render:{digest}:{_variant_name(page_num, variant)}"
+    if redis is None:
+        return await _flights.do(key, compute)
+    return await _flights.do(key, lambda: _flights.across_workers(
+        redis, key, compute, peek, lock_ttl=settings.RENDER_TIMEOUT_SECONDS + 5,
+    ))
+
+
+async def publish_page(
+    path: str,
+    digest: str,
+    page_num: int,
+    variant: Variant = MASTER,
+    redis: Redis | None = None,
+) -> str:
+    """
+    Make sure the page image is in the storage backend and return its key.
+    A page another replica already uploaded is not rendered again here.
+    """
+    key = storage_key(digest, page_num, variant)
+
+    async def compute() -> str:
+        image = await render_page(path, digest, page_num, variant)
+        await storage.backend.put(
+            key, str(image), content_type=MEDIA_TYPES[variant.fmt], cache_control=IMMUTABLE
+        )
+        _published.add(key)
+        return key
+
+    async def peek() -> str | None:
+        return key if await _in_store(key) else None
+
+    async def publish() -> str:
+        if await _in_store(key):
+            return key
+        if redis is None:
+            return await compute()
+        # The lock covers the upload too, so waiting hosts find the image in the store
+        return await _flights.across_workers(
+            redis, f"publish:{key}", compute, peek, lock_ttl=settings.RENDER_TIMEOUT_SECONDS + 30,
+        )
+
+    return await _flights.do(f"publish:{key}", publish)
+
+
+async def warm_page(
+    path: str,
+    digest: str,
+    page_num: int,
+    variant: Variant = MASTER,
+    redis: Redis | None = None,
+) -> None:
+    """Render a page ahead of demand into wherever it will be served from."""
+    if storage.backend.remote:
+        await publish_page(path, digest, page_num, variant, redis=redis)
+    else:
+        await render_page(path, digest, page_num, variant, redis=redis)
+
+
+async def is_warm(digest: str, page_num: int, variant: Variant = MASTER) -> bool:
+    if storage.backend.remote:
+        return await _in_store(storage_key(digest, page_num, variant))
+    return page_path(digest, page_num, variant).exists()
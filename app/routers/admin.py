@@ -6,17 +6,23 @@ Capabilities:
 - Change user roles
 - List / delete any session (moderation)
 - List / delete any event (moderation)
+- Inspect this worker's realtime fan-out
+- Inspect the buffered response-ingestion queue
+- Inspect this worker's page-render pool
+- Inspect this worker's office conversion daemons
 """
 import uuid
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from pydantic import BaseModel
 from sqlalchemy import delete, func, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app import ingest, join_cache, office_pool, prefetch, rendering, singleflight, slide_cache
 from app.auth import get_current_super_admin
 from app.database import get_db
-from app.models import Event, Session, SessionAsset, User, UserRole
+from app.models import Event, Session, SessionAsset, Slide, User, UserRole
+from app.routers.ws import manager
 from app.schemas import UserAdminOut, UserOut, UserRoleUpdate
 
 
@@ -195,6 +201,7 @@ async def list_all_sessions(
 @router.delete("/sessions/{session_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_any_session(
     session_id: str,
+    request: Request,
     admin: User = Depends(get_current_super_admin),
     db: AsyncSession = Depends(get_db),
 ):
@@ -204,10 +211,14 @@ async def delete_any_session(
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid session ID")
 
-    result = await db.execute(delete(Session).where(Session.id == sid))
-    if result.rowcount == 0:
+    slide_ids = (await db.execute(select(Slide.id).where(Slide.session_id == sid))).scalars().all()
+    result = await db.execute(delete(Session).where(Session.id == sid).returning(Session.unique_code))
+    code = result.scalar_one_or_none()
+    if code is None:
         raise HTTPException(status_code=404, detail="Session not found")
     await db.commit()
+    await slide_cache.invalidate(request.app.state.redis, slide_ids)
+    await join_cache.invalidate(request.app.state.redis, code)
 
 
 # ── Events (moderation) ───────────────────────────────────────────────────────
@@ -292,3 +303,46 @@ async def admin_get_storage(
     ]
 
     return {"total_bytes": total, "asset_count": asset_count, "top_users": top_users}
+
+
+# ── Realtime ─────────────────────────────────────────────────────────────
+
+@router.get("/realtime")
+async def admin_get_realtime(
+    admin: User = Depends(get_current_super_admin),
+):
+    """
+    Per-session socket count, outbound queue depth and drop counters, slide-
+    and join-cache hits, and requests collapsed on public reads (this worker only).
+    """
+    return {
+        "sessions": manager.stats(),
+        "slide_cache": slide_cache.stats(),
+        "join_cache": join_cache.stats(),
+        "coalesced": singleflight.endpoint_stats(),
+    }
+
+
+@router.get("/ingest")
+async def admin_get_ingest(
+    request: Request,
+    admin: User = Depends(get_current_super_admin),
+):
+    """Queued and in-flight buffered responses, age of the oldest one, and this worker's write counters."""
+    return await ingest.stats(request.app.state.redis)
+
+
+@router.get("/rendering")
+async def admin_get_rendering(
+    admin: User = Depends(get_current_super_admin),
+):
+    """Render pool load, queue wait versus run time, timeouts, rejections, open-PDF cache hits and prefetching (this worker only)."""
+    return {**rendering.stats(), "prefetch": prefetch.stats()}
+
+
+@router.get("/conversions")
+async def admin_get_conversions(
+    admin: User = Depends(get_current_super_admin),
+):
+    """Warm office daemons: starts, recycles, crashes, failed health checks and timeouts (this worker only)."""
+    return office_pool.pool.stats()
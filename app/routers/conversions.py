@@ -0,0 +1,31 @@
+"""Status of background office-to-PDF conversion jobs."""
+from fastapi import APIRouter, Depends, HTTPException, Request
+
+from app import conversion
+from app.auth import get_current_user
+from app.models import User, UserRole
+
+router = APIRouter(prefix="/api/conversions", tags=["conversions"])
+
+
+@router.get("/{job_id}")
+async def get_conversion(
+    job_id: str,
+    request: Request,
+    user: User = Depends(get_current_user),
+):
+    """
+    ``status`` is queued, running, done or failed. A finished job carries the
+    PDF's ``file_url`` or an ``error``. Jobs are kept for a day.
+    """
+    job = await conversion.get(request.app.state.redis, job_id)
+    if not job or (job["user_id"] != str(user.id) and user.role != UserRole.SUPER_ADMIN):
+        raise HTTPException(status_code=404, detail="Conversion job not found")
+    return {
+        "id": job["id"],
+        "status": job["status"],
+        "slide_id": job["slide_id"] or None,
+        "asset_id": job["asset_id"] or None,
+        "file_url": job.get("file_url") or None,
+        "error": job.get("error") or None,
+    }
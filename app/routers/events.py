@@ -6,6 +6,7 @@ from sqlalchemy import delete, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 
+from app import ratelimit, singleflight
 from app.auth import get_current_user
 from app.database import get_db
 from app.models import Event, Session, User, UserRole
@@ -114,7 +115,12 @@ async def list_events(
 
 
 # ── Guest endpoint (no auth) ─────────────────────────
-@router.get("/public/today", response_model=list[dict])
+@router.get(
+    "/public/today",
+    response_model=list[dict],
+    dependencies=[Depends(ratelimit.enforce_client("events"))],
+)
+@singleflight.coalesce("events.today")
 async def get_today_event(db: AsyncSession = Depends(get_db)):
     result = await db.execute(
         select(Event)
@@ -136,7 +142,12 @@ async def get_today_event(db: AsyncSession = Depends(get_db)):
     return payload
 
 
-@router.get("/public", response_model=list[dict])
+@router.get(
+    "/public",
+    response_model=list[dict],
+    dependencies=[Depends(ratelimit.enforce_client("events"))],
+)
+@singleflight.coalesce("events.public")
 async def list_public_events(
     event_date: date | None = None,
     upcoming: bool = False,
@@ -1,20 +1,34 @@
-import json
 import uuid
+from datetime import datetime, timezone
 
 from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import ORJSONResponse
 from redis.asyncio import Redis
 from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
 
+from app import ingest, live_state, ratelimit, slide_cache, tally, upvotes, word_cloud
+from app.config import get_settings
 from app.database import get_db
-from app.models import Response, Slide
-from app.schemas import ResponseCreate, ResponseOut
+from app.models import Response, SlideType
+from app.routers.ws import publish_event
+from app.schemas import ResponseCreate, ResponseOut, UpvoteOut
+
+settings = get_settings()
+
+SUBMIT_LIMIT = ratelimit.Rule("sliding", 10, 60)
+UPVOTE_ONCE = ratelimit.Rule("fixed", 1, 86400)
 
 router = APIRouter(prefix="/api/slides/{slide_id}/responses", tags=["responses"])
 
 
-@router.post("/", response_model=ResponseOut, status_code=201)
+@router.post(
+    "/",
+    response_model=ResponseOut,
+    status_code=201,
+    responses={202: {"model": ResponseOut, "description": "Accepted for buffered ingestion"}},
+)
 async def submit_response(
     slide_id: str,
     payload: ResponseCreate,
@@ -27,44 +41,80 @@ async def submit_response(
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid slide ID format")
     
-    result = await db.execute(
-        select(Slide).where(Slide.id == slide_uuid).options(selectinload(Slide.session))
-    )
-    slide = result.scalar_one_or_none()
+    redis: Redis = request.app.state.redis
+    slide = await slide_cache.get(redis, slide_uuid)
     if not slide:
         raise HTTPException(status_code=404, detail="Slide not found")
     if not slide.is_active:
         raise HTTPException(status_code=400, detail="Slide is not currently active")
-
-    # Rate limit: max 10 submissions per guest per slide per minute
-    redis: Redis = request.app.state.redis
-    rate_key = f"rate:response:{payload.guest_identifier}:{slide_id}"
-    count = await redis.incr(rate_key)
-    if count == 1:
-        await redis.expire(rate_key, 60)
-    if count > 10:
-        raise HTTPException(status_code=429, detail="Too many responses. Please slow down.")
-
-    response = Response(slide_id=slide_uuid, **payload.model_dump())
-    db.add(response)
-    await db.flush()
-    await db.commit()
-    await db.refresh(response)
-
-    # Publish to Redis so all WS clients (including moderator) receive this live
-    session_code = slide.session.unique_code
-    out = ResponseOut.model_validate(response)
-    await redis.publish(
-        f"session:{session_code}",
-        json.dumps({"event": "new_response", "data": out.model_dump(mode="json")}),
+    # Each option is a field of the tally and goes out to the room
+    if slide.type == SlideType.POLL and payload.value not in slide.options:
+        raise HTTPException(status_code=400, detail="Not one of the poll's options")
+
+    # Rate limit: max 10 submissions per guest per slide in any minute
+    await ratelimit.enforce(
+        redis, f"response:{payload.guest_identifier}:{slide_id}", SUBMIT_LIMIT,
+        detail="Too many responses. Please slow down.",
     )
 
-    return response
-
+    buffered = settings.RESPONSE_INGEST_MODE == "buffered"
+    if buffered:
+        # Write-behind: the row is inserted later by the ingest writer
+        out = ResponseOut(
+            id=uuid.uuid4(),
+            slide_id=slide_uuid,
+            upvotes=0,
+            created_at=datetime.now(timezone.utc),
+            **payload.model_dump(),
+        )
+        await ingest.enqueue(redis, out)
+    else:
+        response = Response(slide_id=slide_uuid, **payload.model_dump())
+        db.add(response)
+        try:
+            await db.flush()
+        except IntegrityError:
+            # The slide was deleted after its metadata was cached
+            await db.rollback()
+            await slide_cache.invalidate(redis, [slide_uuid])
+            raise HTTPException(status_code=404, detail="Slide not found")
+        await db.commit()
+        await db.refresh(response)
+        out = ResponseOut.model_validate(response)
 
-@router.get("/", response_model=list[ResponseOut])
+    # Publish to Redis so all WS clients (including moderator) receive this live
+    session_code = slide.session_code
+    await upvotes.seed(redis, slide_uuid, out.id)
+    await live_state.put_response(redis, session_code, out)
+    if slide.type == SlideType.WORD_CLOUD:
+        # Rooms see the cloud through the term index, not every raw submission
+        update = await word_cloud.record(redis, slide_uuid, out.id, out.value)
+        await publish_event(redis, session_code, {"event": "word_cloud_update", "data": update})
+    elif slide.type == SlideType.POLL:
+        # Likewise a poll: one option count per vote, not the vote itself
+        count = await tally.record_vote(redis, slide_uuid, out.id, out.value)
+        await publish_event(redis, session_code, {
+            "event": "tally_update",
+            "data": {"slide_id": slide_id, "option": out.value, "count": count},
+        })
+    else:
+        await publish_event(
+            redis, session_code, {"event": "new_response", "data": out.model_dump(mode="json")}
+        )
+
+    if buffered:
+        return ORJSONResponse(status_code=202, content=out.model_dump(mode="json"))
+    return out
+
+
+@router.get(
+    "/",
+    response_model=list[ResponseOut],
+    dependencies=[Depends(ratelimit.enforce_client("responses"))],
+)
 async def list_responses(
     slide_id: str,
+    request: Request,
     db: AsyncSession = Depends(get_db),
 ):
     try:
@@ -77,10 +127,21 @@ async def list_responses(
         .where(Response.slide_id == slide_uuid)
         .order_by(Response.upvotes.desc(), Response.created_at.desc())
     )
-    return result.scalars().all()
+    responses = [ResponseOut.model_validate(r) for r in result.scalars().all()]
 
+    # The upvotes column trails the live Redis counters until the next flush
+    counts = await upvotes.get_counts(
+        request.app.state.redis, slide_uuid, [r.id for r in responses]
+    )
+    if counts:
+        for r in responses:
+            r.upvotes = counts.get(str(r.id), r.upvotes)
+        responses.sort(key=lambda r: r.created_at, reverse=True)
+        responses.sort(key=lambda r: r.upvotes, reverse=True)
+    return responses
 
-@router.post("/{response_id}/upvote", response_model=ResponseOut)
+
+@router.post("/{response_id}/upvote", response_model=UpvoteOut)
 async def upvote_response(
     slide_id: str,
     response_id: str,
@@ -93,32 +154,35 @@ async def upvote_response(
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid ID format")
 
-    # Rate-limit: one upvote per IP per response (stored in Redis)
+    # Dedup: one upvote per IP per response in a 24-hour window
     redis: Redis = request.app.state.redis
-    rate_key = f"upvote:{response_id}:{request.client.host}"
-    if await redis.exists(rate_key):
-        raise HTTPException(status_code=429, detail="Already upvoted")
-    await redis.setex(rate_key, 86400, "1")  # 24-hour window
-
-    result = await db.execute(
-        select(Response)
-        .where(Response.id == response_uuid, Response.slide_id == slide_uuid)
-        .options(selectinload(Response.slide).selectinload(Slide.session))
+    await ratelimit.enforce(
+        redis, f"upvote:{response_id}:{request.client.host}", UPVOTE_ONCE,
+        detail="Already upvoted",
     )
-    response = result.scalar_one_or_none()
-    if not response:
-        raise HTTPException(status_code=404, detail="Response not found")
 
-    response.upvotes += 1
-    await db.commit()
-    await db.refresh(response)
+    slide = await slide_cache.get(redis, slide_uuid)
+    if not slide:
+        raise HTTPException(status_code=404, detail="Slide not found")
+    session_code = slide.session_code
+
+    count = await upvotes.increment(redis, slide_uuid, response_uuid)
+    if count is None:
+        # Cold counter: seed it from the persisted count
+        result = await db.execute(
+            select(Response.upvotes)
+            .where(Response.id == response_uuid, Response.slide_id == slide_uuid)
+        )
+        persisted = result.scalar_one_or_none()
+        if persisted is None:
+            raise HTTPException(status_code=404, detail="Response not found")
+        count = await upvotes.increment(redis, slide_uuid, response_uuid, base=persisted)
 
     # Publish upvote to Redis so all WS clients update the vote count live
-    session_code = response.slide.session.unique_code
-    out = ResponseOut.model_validate(response)
-    await redis.publish(
-        f"session:{session_code}",
-        json.dumps({"event": "upvote", "data": out.model_dump(mode="json")}),
+    out = UpvoteOut(id=response_uuid, slide_id=slide_uuid, upvotes=count)
+    await live_state.set_upvotes(redis, session_code, slide_uuid, response_uuid, count)
+    await publish_event(
+        redis, session_code, {"event": "upvote", "data": out.model_dump(mode="json")}
     )
 
-    return response
+    return out
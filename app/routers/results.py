@@ -0,0 +1,44 @@
+"""Aggregated, read-optimised views of audience responses for a slide."""
+import uuid
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from redis.asyncio import Redis
+
+from app import ratelimit, slide_cache, tally, word_cloud
+from app.models import SlideType
+
+router = APIRouter(
+    prefix="/api/slides/{slide_id}",
+    tags=["results"],
+    dependencies=[Depends(ratelimit.enforce_client("results"))],
+)
+
+
+async def _slide_of_type(redis: Redis, slide_id: str, slide_type: SlideType) -> uuid.UUID:
+    """Parse ``slide_id`` and 404 unless it names a slide of ``slide_type``, before any index is built."""
+    try:
+        slide_uuid = uuid.UUID(slide_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid slide ID format")
+    meta = await slide_cache.get(redis, slide_uuid)
+    if meta is None or meta.type != slide_type:
+        raise HTTPException(status_code=404, detail="Slide not found")
+    return slide_uuid
+
+
+@router.get("/tally")
+async def get_poll_tally(slide_id: str, request: Request):
+    """Vote counts per option for a POLL slide, served from Redis. No auth so projectors can poll it."""
+    redis: Redis = request.app.state.redis
+    return await tally.get_tally(redis, await _slide_of_type(redis, slide_id, SlideType.POLL))
+
+
+@router.get("/words")
+async def get_word_cloud(
+    slide_id: str,
+    request: Request,
+    limit: int | None = Query(None, ge=1, le=200),
+):
+    """Top terms of a WORD_CLOUD slide from the server-side frequency index. No auth."""
+    redis: Redis = request.app.state.redis
+    return await word_cloud.top_terms(redis, await _slide_of_type(redis, slide_id, SlideType.WORD_CLOUD), limit)
@@ -1,13 +1,12 @@
 """Session Assets router – CRUD for uploaded files with storage tracking."""
 import os
 import uuid
-from pathlib import Path
 
-import fitz  # PyMuPDF
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from sqlalchemy import delete, func, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app import conversion, join_cache, live_state, prerender, rendering, slide_cache, storage, uploads
 from app.auth import get_current_user
 from app.config import get_settings
 from app.database import get_db
@@ -19,18 +18,6 @@ router = APIRouter(prefix="/api/assets", tags=["session_assets"])
 
 # ── Helpers ───────────────────────────────────────────────────────────────────
 
-def _remove_file(file_url: str | None) -> None:
-    """Silently remove file from disk if it exists."""
-    if not file_url:
-        return
-    path = file_url.lstrip("/")
-    if path and os.path.exists(path):
-        try:
-            os.remove(path)
-        except OSError:
-            pass
-
-
 async def _get_owned_asset(asset_id: str, user: User, db: AsyncSession) -> SessionAsset:
     try:
         asset_uuid = uuid.UUID(asset_id)
@@ -101,7 +88,7 @@ async def get_storage(
 @router.put("/{asset_id}/file", response_model=SessionAssetOut)
 async def replace_asset_file(
     asset_id: str,
-    file: UploadFile,
+    request: Request,
     user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
@@ -109,101 +96,121 @@ async def replace_asset_file(
     asset = await _get_owned_asset(asset_id, user, db)
 
     settings = get_settings()
-    # Strip any directory components from the filename to prevent path traversal
-    original_name = Path(file.filename or "upload.bin").name or "upload.bin"
-    ext = Path(original_name).suffix.lower()
-
-    if ext not in settings.UPLOAD_ALLOWED_EXTENSIONS:
-        allowed = ", ".join(settings.UPLOAD_ALLOWED_EXTENSIONS)
-        raise HTTPException(
-            status_code=400,
-            detail=f"File type '{ext}' not allowed. Allowed types: {allowed}",
-        )
-
-    content = await file.read()
-    max_bytes = settings.UPLOAD_MAX_MB * 1024 * 1024
-    if len(content) > max_bytes:
-        raise HTTPException(
-            status_code=413,
-            detail=f"File size exceeds the {settings.UPLOAD_MAX_MB} MB limit",
-        )
-
-    # Remove old file from disk
-    _remove_file(asset.file_url)
+    # Streamed to disk; extension and size limits are enforced while it arrives
+    upload = await uploads.receive(request, settings.UPLOAD_ALLOWED_EXTENSIONS, settings.UPLOAD_MAX_MB)
+    original_name = upload.filename
+    ext = upload.extension
 
-    os.makedirs("uploads", exist_ok=True)
-    filename = f"{asset_id}_{original_name}"
-    file_path = os.path.join("uploads", filename)
-    with open(file_path, "wb") as fh:
-        fh.write(content)
-
-    content_type = file.content_type or "application/octet-stream"
-    file_url = f"/uploads/{filename}"
+    content_type = upload.content_type
     file_name = original_name
-
-    # PPT → PDF conversion
-    if ext in {".ppt", ".pptx"}:
-        try:
-            import subprocess
-            subprocess.run(
-                ["libreoffice", "--headless", "--convert-to", "pdf", "--outdir", "uploads", file_path],
-                check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            )
-            pdf_name = f"{Path(file_path).stem}.pdf"
-            pdf_path = os.path.join("uploads", pdf_name)
-            if os.path.exists(pdf_path):
-                file_url = f"/uploads/{pdf_name}"
-                file_name = pdf_name
-                content_type = "application/pdf"
-        except Exception:
-            pass
-
-    total_pages = 1
-    final_path = file_url.lstrip("/")
-    if content_type == "application/pdf" and os.path.exists(final_path):
-        try:
-            doc = fitz.open(final_path)
-            total_pages = len(doc)
-            doc.close()
-        except Exception:
-            pass
-
-    # Update linked slide content_json if any
-    if asset.slide_id:
-        slide_result = await db.execute(select(Slide).where(Slide.id == asset.slide_id))
-        slide = slide_result.scalar_one_or_none()
-        if slide:
-            cj = dict(slide.content_json or {})
-            cj["file_name"] = file_name
-            cj["file_url"] = file_url
-            cj["file_type"] = content_type
-            cj["file_page"] = 1
-            cj["total_pages"] = total_pages
-            slide.content_json = cj
-
-    asset.file_name = file_name
-    asset.file_url = file_url
-    asset.file_type = content_type
-    asset.file_size = len(content)
-
-    await db.commit()
+    # Identical bytes share one stored file, conversion and set of rendered pages
+    office = ext in conversion.OFFICE_EXTENSIONS
+    # Neither the temp file nor a newly stored one may outlive a failed commit
+    file_url = None
+    try:
+        file_url, converted = await uploads.store(db, upload, office=office)
+        if converted:
+            file_name = f"{os.path.splitext(original_name)[0]}.pdf"
+            content_type = "application/pdf"
+        # Office documents are converted to PDF in the background
+        job_id = str(uuid.uuid4()) if office and not converted else None
+
+        total_pages = 1
+        file_hash = None
+        paginated = False
+        final_path = None
+        if not job_id:
+            final_path = await storage.backend.local_path(file_url.lstrip("/"))
+            file_hash = await rendering.digest(final_path)
+            if content_type == "application/pdf":
+                try:
+                    total_pages = await rendering.page_count(final_path, file_hash)
+                    paginated = True
+                except Exception:
+                    pass
+
+        # Update linked slide content_json if any
+        slide = None
+        if asset.slide_id:
+            slide_result = await db.execute(select(Slide).where(Slide.id == asset.slide_id))
+            slide = slide_result.scalar_one_or_none()
+            if slide:
+                cj = dict(slide.content_json or {})
+                cj["file_name"] = file_name
+                cj["file_url"] = file_url
+                cj["file_type"] = content_type
+                cj["file_page"] = 1
+                cj["total_pages"] = total_pages
+                if file_hash:
+                    cj["file_hash"] = file_hash
+                else:
+                    cj.pop("file_hash", None)
+                # Progress of the previous file's pass no longer applies
+                cj.pop("prerender", None)
+                cj.pop("conversion", None)
+                if job_id:
+                    cj["conversion"] = {"job_id": job_id, "status": "queued"}
+                slide.content_json = cj
+
+        previous_url = asset.file_url
+        asset.file_name = file_name
+        asset.file_url = file_url
+        asset.file_type = content_type
+        asset.file_size = upload.size
+
+        await db.commit()
+    except BaseException:
+        await uploads.abandon(db, upload, file_url)
+        raise
     await db.refresh(asset)
+    # The old file goes only if no other asset shares it
+    if previous_url != file_url:
+        await uploads.release(previous_url)
+    session_code = None
+    if asset.session_id and (slide or job_id):
+        session_code = await db.scalar(
+            select(Session.unique_code).where(Session.id == asset.session_id)
+        )
+    if slide and session_code:
+        await join_cache.invalidate(request.app.state.redis, session_code)
+        await live_state.update_slide(request.app.state.redis, session_code, slide)
+    if job_id:
+        await conversion.submit(
+            request.app.state.redis, job_id, file_url,
+            user_id=user.id,
+            session_code=session_code,
+            slide_id=asset.slide_id,
+            asset_id=asset.id,
+        )
+    if asset.slide_id and paginated:
+        prerender.schedule(request.app.state.redis, asset.slide_id, final_path, file_hash, total_pages)
     return asset
 
 
 @router.delete("/{asset_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_asset(
     asset_id: str,
+    request: Request,
     user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
-    """Delete an asset: remove file from disk, delete linked slide, delete the record."""
+    """Delete an asset: delete linked slide, delete the record, then its file unless shared."""
     asset = await _get_owned_asset(asset_id, user, db)
+    slide_id, file_url = asset.slide_id, asset.file_url
 
-    _remove_file(asset.file_url)
-
-    if asset.slide_id:
-        await db.execute(delete(Slide).where(Slide.id == asset.slide_id))
+    session_code = None
+    if slide_id:
+        session_code = await db.scalar(
+            select(Session.unique_code).join(Slide, Slide.session_id == Session.id).where(Slide.id == slide_id)
+        )
+        await db.execute(delete(Slide).where(Slide.id == slide_id))
 
     await db.execute(delete(SessionAsset).where(SessionAsset.id == asset.id))
     await db.commit()
+    if slide_id:
+        redis = request.app.state.redis
+        await slide_cache.invalidate(redis, [slide_id])
+        if session_code:
+            await join_cache.invalidate(redis, session_code)
+            await live_state.clear_active_slide(redis, session_code, slide_id)
+    await uploads.release(file_url)
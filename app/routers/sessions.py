@@ -2,14 +2,16 @@ import random
 import string
 import uuid
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import Response as HTTPResponse
 from sqlalchemy import delete, select
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 
+from app import join_cache, live_state, prerender, ratelimit, rendering, singleflight, slide_cache, upvotes
 from app.auth import get_current_user
 from app.database import get_db
-from app.models import Event, Session, User, UserRole
+from app.models import Event, Session, Slide, User, UserRole
 from app.schemas import SessionCreate, SessionOut, SessionUpdate, SessionWithSlides
 
 router = APIRouter(prefix="/api/sessions", tags=["sessions"])
@@ -117,6 +119,7 @@ async def get_session_by_code(
 async def update_session(
     session_id: str,
     payload: SessionUpdate,
+    request: Request,
     user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
@@ -133,15 +136,27 @@ async def update_session(
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
 
-    for field, value in payload.model_dump(exclude_unset=True).items():
+    updates = payload.model_dump(exclude_unset=True)
+    for field, value in updates.items():
         setattr(session, field, value)
     await db.commit()
+    await join_cache.invalidate(request.app.state.redis, session.unique_code)
+    if "is_live" in updates:
+        await live_state.set_live(request.app.state.redis, session.unique_code, session.is_live)
+        if session.is_live:
+            # Make sure every page is in the render cache before the audience arrives
+            prerender.warm_session(request.app.state.redis, session.id)
+        else:
+            # Persist the final counts now instead of waiting for the next tick.
+            # The update is already committed, so this must not fail the request.
+            upvotes.flush_soon(request.app.state.redis)
     return session
 
 
 @router.delete("/{session_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_session(
     session_id: str,
+    request: Request,
     user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
@@ -150,34 +165,51 @@ async def delete_session(
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid session ID format")
     
+    slide_ids = (await db.execute(
+        select(Slide.id).where(Slide.session_id == session_uuid)
+    )).scalars().all()
     stmt = delete(Session).where(Session.id == session_uuid)
     if user.role != UserRole.SUPER_ADMIN:
         stmt = stmt.where(Session.owner_id == user.id)
-    result = await db.execute(stmt)
-    if result.rowcount == 0:
+    result = await db.execute(stmt.returning(Session.unique_code))
+    code = result.scalar_one_or_none()
+    if code is None:
         raise HTTPException(status_code=404, detail="Session not found")
     await db.commit()
+    await slide_cache.invalidate(request.app.state.redis, slide_ids)
+    await join_cache.invalidate(request.app.state.redis, code)
 
 
 # ── Guest endpoint (no auth) ─────────────────────────
-@router.get("/join/{code}", response_model=SessionWithSlides)
-async def join_session(code: str, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(
-        select(Session)
-        .options(selectinload(Session.slides))
-        .where(Session.unique_code == code, Session.is_live == True)
-    )
-    session = result.unique().scalar_one_or_none()
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found or not live")
-
-    # Strip private file paths from guest-facing response
-    data = SessionWithSlides.model_validate(session)
-    for s in data.slides:
-        cj = dict(s.content_json)
-        if "file_url" in cj:
-            cj["has_file"] = True
-            del cj["file_url"]
-        cj.pop("file_name", None)
-        s.content_json = cj
-    return data
+@router.get(
+    "/join/{code}",
+    response_model=SessionWithSlides,
+    dependencies=[Depends(ratelimit.enforce_client("join"))],
+)
+# A reconnecting client's If-None-Match decides between 200 and 304
+@singleflight.coalesce("sessions.join", key=lambda code, request, **_: (code, request.headers.get("if-none-match")))
+async def join_session(code: str, request: Request, db: AsyncSession = Depends(get_db)):
+    redis = request.app.state.redis
+    cached = await join_cache.get(redis, code)
+    if cached is None:
+        seen_version = await join_cache.version(redis, code)
+        result = await db.execute(
+            select(Session)
+            .options(selectinload(Session.slides))
+            .where(Session.unique_code == code, Session.is_live == True)
+        )
+        session = result.unique().scalar_one_or_none()
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found or not live")
+
+        # Strip private file paths from guest-facing response
+        data = SessionWithSlides.model_validate(session)
+        for s in data.slides:
+            s.content_json = live_state.guest_content_json(s.content_json)
+        cached = await join_cache.fill(redis, code, seen_version, data.model_dump(mode="json"))
+
+    tag, body = cached
+    headers = {"ETag": tag, "Cache-Control": "no-cache"}
+    if rendering.etag_matches(request.headers.get("if-none-match"), tag):
+        return HTTPResponse(status_code=304, headers=headers)
+    return HTTPResponse(content=body, media_type="application/json", headers=headers)
@@ -1,19 +1,29 @@
 import os
-import subprocess
 import uuid
-from io import BytesIO
-from pathlib import Path
+from typing import Literal
 
-import fitz  # PyMuPDF
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, status
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import FileResponse, RedirectResponse
+from fastapi.responses import Response as HTTPResponse
+from redis.asyncio import Redis
 from sqlalchemy import delete, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app import (
+    conversion,
+    join_cache,
+    live_state,
+    prerender,
+    ratelimit,
+    rendering,
+    slide_cache,
+    storage,
+    uploads,
+)
 from app.auth import get_current_user
 from app.config import get_settings
 from app.database import get_db
-from app.models import Session, SessionAsset, Slide, User, UserRole
+from app.models import Response, Session, SessionAsset, Slide, User, UserRole
 from app.schemas import SlideCreate, SlideOut, SlideUpdate
 
 router = APIRouter(prefix="/api/sessions/{session_id}/slides", tags=["slides"])
@@ -41,15 +51,17 @@ async def _verify_ownership(
 async def create_slide(
     session_id: str,
     payload: SlideCreate,
+    request: Request,
     user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
-    await _verify_ownership(session_id, user, db)
+    session = await _verify_ownership(session_id, user, db)
 
     slide = Slide(session_id=uuid.UUID(session_id), **payload.model_dump())
     db.add(slide)
     await db.flush()
     await db.commit()
+    await join_cache.invalidate(request.app.state.redis, session.unique_code)
     return slide
 
 
@@ -73,10 +85,11 @@ async def update_slide(
     session_id: str,
     slide_id: str,
     payload: SlideUpdate,
+    request: Request,
     user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
-    await _verify_ownership(session_id, user, db)
+    session = await _verify_ownership(session_id, user, db)
 
     try:
         session_uuid = uuid.UUID(session_id)
@@ -93,18 +106,37 @@ async def update_slide(
 
     update_data = payload.model_dump(exclude_unset=True)
 
-    # If activating this slide, deactivate all others in the session
+    # If activating this slide, deactivate all others in the session. New
+    # poll options change the slide's cached metadata as well.
+    changed_ids = [slide.id] if update_data.keys() & {"is_active", "content_json"} else []
     if update_data.get("is_active"):
-        await db.execute(
+        deactivated = await db.execute(
             update(Slide)
-            .where(Slide.session_id == session_uuid)
+            .where(Slide.session_id == session_uuid, Slide.is_active == True)
             .values(is_active=False)
+            .returning(Slide.id)
         )
+        changed_ids += deactivated.scalars().all()
 
     for field, value in update_data.items():
         setattr(slide, field, value)
 
     await db.commit()
+
+    # Keep the cached live state (pushed to guests on connect) in step
+    redis: Redis = request.app.state.redis
+    await join_cache.invalidate(redis, session.unique_code)
+    if changed_ids:
+        await slide_cache.invalidate(redis, changed_ids)
+    if update_data.get("is_active"):
+        responses = await db.execute(select(Response).where(Response.slide_id == slide.id))
+        await live_state.set_active_slide(
+            redis, session.unique_code, slide, list(responses.scalars().all())
+        )
+    elif "is_active" in update_data:
+        await live_state.clear_active_slide(redis, session.unique_code, slide.id)
+    else:
+        await live_state.update_slide(redis, session.unique_code, slide)
     return slide
 
 
@@ -112,10 +144,11 @@ async def update_slide(
 async def delete_slide(
     session_id: str,
     slide_id: str,
+    request: Request,
     user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
-    await _verify_ownership(session_id, user, db)
+    session = await _verify_ownership(session_id, user, db)
 
     try:
         session_uuid = uuid.UUID(session_id)
@@ -129,13 +162,16 @@ async def delete_slide(
     if result.rowcount == 0:
         raise HTTPException(status_code=404, detail="Slide not found")
     await db.commit()
+    await slide_cache.invalidate(request.app.state.redis, [slide_uuid])
+    await join_cache.invalidate(request.app.state.redis, session.unique_code)
+    await live_state.clear_active_slide(request.app.state.redis, session.unique_code, slide_uuid)
 
 
 @router.post("/{slide_id}/upload", response_model=SlideOut)
 async def upload_content_file(
     session_id: str,
     slide_id: str,
-    file: UploadFile,
+    request: Request,
     user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
@@ -155,112 +191,107 @@ async def upload_content_file(
         raise HTTPException(status_code=404, detail="Slide not found")
 
     settings = get_settings()
-    # Strip any directory components from the filename to prevent path traversal
-    original_name = Path(file.filename or "upload.bin").name or "upload.bin"
-    ext = Path(original_name).suffix.lower()
-
-    # Validate file extension
-    if ext not in settings.UPLOAD_ALLOWED_EXTENSIONS:
-        allowed = ", ".join(settings.UPLOAD_ALLOWED_EXTENSIONS)
-        raise HTTPException(
-            status_code=400,
-            detail=f"File type '{ext}' not allowed. Allowed types: {allowed}",
-        )
-
-    content = await file.read()
-
-    # Validate file size
-    max_bytes = settings.UPLOAD_MAX_MB * 1024 * 1024
-    if len(content) > max_bytes:
-        raise HTTPException(
-            status_code=413,
-            detail=f"File size exceeds the {settings.UPLOAD_MAX_MB} MB limit",
-        )
+    # Streamed to disk; extension and size limits are enforced while it arrives
+    upload = await uploads.receive(request, settings.UPLOAD_ALLOWED_EXTENSIONS, settings.UPLOAD_MAX_MB)
+    original_name = upload.filename
+    ext = upload.extension
 
-    os.makedirs("uploads", exist_ok=True)
-    filename = f"{slide_id}_{original_name}"
-    file_path = os.path.join("uploads", filename)
-    with open(file_path, "wb") as handle:
-        handle.write(content)
-
-    content_type = file.content_type or "application/octet-stream"
-    file_url = f"/uploads/{filename}"
+    content_type = upload.content_type
     file_name = original_name
-
-    # Convert PPT/PPTX to PDF if possible
-    if ext in {".ppt", ".pptx"}:
-        try:
-            result = subprocess.run(
-                [
-                    "libreoffice",
-                    "--headless",
-                    "--convert-to",
-                    "pdf",
-                    "--outdir",
-                    "uploads",
-                    file_path,
-                ],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+    # Identical bytes share one stored file, conversion and set of rendered pages
+    office = ext in conversion.OFFICE_EXTENSIONS
+    # Neither the temp file nor a newly stored one may outlive a failed commit
+    file_url = None
+    try:
+        file_url, converted = await uploads.store(db, upload, office=office)
+        if converted:
+            file_name = f"{os.path.splitext(original_name)[0]}.pdf"
+            content_type = "application/pdf"
+        # Office documents are converted to PDF in the background; the slide
+        # shows the original until the job swaps it in
+        job_id = str(uuid.uuid4()) if office and not converted else None
+
+        # Count total pages for PDF files
+        total_pages = 1
+        file_hash = None
+        paginated = False
+        final_path = None
+        if not job_id:
+            final_path = await storage.backend.local_path(file_url.lstrip("/"))
+            file_hash = await rendering.digest(final_path)
+            if content_type == "application/pdf":
+                try:
+                    total_pages = await rendering.page_count(final_path, file_hash)
+                    paginated = True
+                except Exception:
+                    pass
+
+        content_json = dict(slide.content_json or {})
+        content_json["file_name"] = file_name
+        content_json["file_url"] = file_url
+        content_json["file_type"] = content_type
+        content_json["file_page"] = 1
+        content_json["total_pages"] = total_pages
+        if file_hash:
+            # Versions page-image URLs so browsers can cache them for good
+            content_json["file_hash"] = file_hash
+        else:
+            content_json.pop("file_hash", None)
+        content_json.pop("prerender", None)
+        content_json.pop("conversion", None)
+        if job_id:
+            content_json["conversion"] = {"job_id": job_id, "status": "queued"}
+        slide.content_json = content_json
+
+        # ── Create or update SessionAsset record ─────────────
+        existing_asset_result = await db.execute(
+            select(SessionAsset).where(SessionAsset.slide_id == slide_uuid)
+        )
+        asset = existing_asset_result.scalar_one_or_none()
+
+        # Fetch the session to get event_id
+        session_row = await db.execute(select(Session).where(Session.id == session_uuid))
+        session_obj = session_row.scalar_one_or_none()
+
+        previous_url = asset.file_url if asset else None
+        if asset:
+            asset.file_name = file_name
+            asset.file_url = file_url
+            asset.file_type = content_type
+            asset.file_size = upload.size
+        else:
+            asset = SessionAsset(
+                user_id=user.id,
+                session_id=session_uuid,
+                event_id=session_obj.event_id if session_obj else None,
+                slide_id=slide_uuid,
+                file_name=file_name,
+                file_url=file_url,
+                file_type=content_type,
+                file_size=upload.size,
             )
-            pdf_name = f"{Path(file_path).stem}.pdf"
-            pdf_path = os.path.join("uploads", pdf_name)
-            if os.path.exists(pdf_path):
-                file_url = f"/uploads/{pdf_name}"
-                file_name = pdf_name
-                content_type = "application/pdf"
-        except Exception:
-            pass
-
-    # Count total pages for PDF files
-    total_pages = 1
-    final_path = file_url.lstrip("/")
-    if content_type == "application/pdf" and os.path.exists(final_path):
-        try:
-            doc = fitz.open(final_path)
-            total_pages = len(doc)
-            doc.close()
-        except Exception:
-            pass
-
-    content_json = dict(slide.content_json or {})
-    content_json["file_name"] = file_name
-    content_json["file_url"] = file_url
-    content_json["file_type"] = content_type
-    content_json["file_page"] = 1
-    content_json["total_pages"] = total_pages
-    slide.content_json = content_json
-
-    # ── Create or update SessionAsset record ─────────────
-    existing_asset_result = await db.execute(
-        select(SessionAsset).where(SessionAsset.slide_id == slide_uuid)
-    )
-    existing_asset = existing_asset_result.scalar_one_or_none()
+            db.add(asset)
 
-    # Fetch the session to get event_id
-    session_row = await db.execute(select(Session).where(Session.id == session_uuid))
-    session_obj = session_row.scalar_one_or_none()
-
-    if existing_asset:
-        existing_asset.file_name = file_name
-        existing_asset.file_url = file_url
-        existing_asset.file_type = content_type
-        existing_asset.file_size = len(content)
-    else:
-        new_asset = SessionAsset(
+        await db.commit()
+    except BaseException:
+        await uploads.abandon(db, upload, file_url)
+        raise
+    if session_obj:
+        await join_cache.invalidate(request.app.state.redis, session_obj.unique_code)
+        await live_state.update_slide(request.app.state.redis, session_obj.unique_code, slide)
+    if previous_url != file_url:
+        await uploads.release(previous_url)
+    if job_id:
+        await conversion.submit(
+            request.app.state.redis, job_id, file_url,
             user_id=user.id,
-            session_id=session_uuid,
-            event_id=session_obj.event_id if session_obj else None,
+            session_code=session_obj.unique_code if session_obj else None,
             slide_id=slide_uuid,
-            file_name=file_name,
-            file_url=file_url,
-            file_type=content_type,
-            file_size=len(content),
+            asset_id=asset.id,
         )
-        db.add(new_asset)
-
-    await db.commit()
+    if paginated:
+        # Render every page now so the first guest to open one does not wait
+        prerender.schedule(request.app.state.redis, slide_uuid, final_path, file_hash, total_pages)
     return slide
 
 
@@ -269,9 +300,22 @@ async def get_page_image(
     session_id: str,
     slide_id: str,
     page_num: int,
+    request: Request,
+    v: str | None = None,
+    w: int | None = Query(None, ge=1, le=8192),
+    dpr: float | None = Query(None, gt=0, le=8),
+    format: Literal["png", "webp", "jpeg"] | None = None,
     db: AsyncSession = Depends(get_db),
 ):
-    """Render a single PDF page as a PNG image. No auth required so guests can view."""
+    """
+    Render a single PDF page as an image. No auth required so guests can view.
+    Pass the slide's ``file_hash`` as ``v`` to get an immutable, year-long cache entry.
+
+    ``w`` (CSS pixels) and ``dpr`` pick a size bucket; ``w=80`` gives a
+    thumbnail. For a sized request without ``format`` the ``Accept`` header
+    decides (WebP when supported). With no parameters it is the 2x PNG, as
+    before.
+    """
     try:
         slide_uuid = uuid.UUID(slide_id)
         session_uuid = uuid.UUID(session_id)
@@ -290,44 +334,71 @@ async def get_page_image(
     if not file_url:
         raise HTTPException(status_code=404, detail="No file attached")
 
-    # Resolve to local path and confine to the uploads/ directory
-    file_path = file_url.lstrip("/")
-    uploads_dir = os.path.realpath("uploads")
-    resolved = os.path.realpath(file_path)
-    if not resolved.startswith(uploads_dir + os.sep) and resolved != uploads_dir:
+    # Confine to uploads/, then fetch a local copy if the store is remote
+    key = os.path.normpath(file_url.lstrip("/"))
+    if not key.startswith(f"{uploads.UPLOAD_DIR}/"):
         raise HTTPException(status_code=400, detail="Invalid file path")
-    if not os.path.exists(file_path):
+    try:
+        file_path = await storage.backend.local_path(key)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid file path")
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found on disk")
 
     try:
-        doc = fitz.open(file_path)
+        digest = await rendering.digest(file_path)
+        total = await rendering.page_count(file_path, digest)
+    except rendering.RenderBusy:
+        raise HTTPException(status_code=503, detail="Renderer busy", headers={"Retry-After": "1"})
     except Exception:
         raise HTTPException(status_code=500, detail="Could not open PDF")
 
-    total = len(doc)
-
-    # Backfill total_pages if it was missing or wrong
-    if content_json.get("total_pages") != total:
+    # Backfill total_pages / file_hash if they were missing or wrong
+    if content_json.get("total_pages") != total or content_json.get("file_hash") != digest:
         content_json["total_pages"] = total
+        content_json["file_hash"] = digest
         slide.content_json = dict(content_json)
         await db.commit()
+        code = await db.scalar(select(Session.unique_code).where(Session.id == session_uuid))
+        await join_cache.invalidate(request.app.state.redis, code)
+        if code:
+            await live_state.update_slide(request.app.state.redis, code, slide)
 
     if page_num < 1 or page_num > total:
-        doc.close()
         raise HTTPException(status_code=400, detail=f"Page must be between 1 and {total}")
 
-    page = doc[page_num - 1]
-    # Render at 2x for crisp display on phones
-    pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-    img_bytes = pix.tobytes("png")
-    doc.close()
-
-    return StreamingResponse(
-        BytesIO(img_bytes),
-        media_type="image/png",
-        headers={
-            "Cache-Control": "no-store",
-            "Content-Disposition": "inline",
-            "X-Total-Pages": str(total),
-        },
-    )
+    variant = rendering.negotiate(request.headers.get("accept"), w, dpr, format)
+    tag = rendering.etag(digest, page_num, variant)
+    headers = {
+        "ETag": tag,
+        "Cache-Control": rendering.IMMUTABLE if v == digest else rendering.REVALIDATE,
+        "Content-Disposition": "inline",
+        "X-Total-Pages": str(total),
+    }
+    if format is None and (w is not None or dpr is not None):
+        headers["Vary"] = "Accept"
+    if rendering.etag_matches(request.headers.get("if-none-match"), tag):
+        return HTTPResponse(status_code=304, headers=headers)
+
+    redis = request.app.state.redis
+    # Only renders count against the limit. <img> requests carry no guest id,
+    # so a whole room shares its address, and cached pages are cheap to serve.
+    if not await rendering.is_warm(digest, page_num, variant):
+        await ratelimit.enforce_client("page")(request)
+    try:
+        if storage.backend.remote:
+            image_key = await rendering.publish_page(file_path, digest, page_num, variant, redis=redis)
+        else:
+            image_path = await rendering.render_page(file_path, digest, page_num, variant, redis=redis)
+    except rendering.RenderBusy:
+        raise HTTPException(status_code=503, detail="Renderer busy", headers={"Retry-After": "1"})
+    except rendering.RenderTimeout:
+        raise HTTPException(status_code=504, detail="Rendering timed out")
+    except Exception:
+        raise HTTPException(status_code=500, detail="Could not render page")
+    if storage.backend.remote:
+        # The client fetches the bytes from the store; only the redirect is cached here
+        ttl = get_settings().STORAGE_PRESIGN_SECONDS // 2
+        headers["Cache-Control"] = f"public, max-age={ttl}" if v == digest else rendering.REVALIDATE
+        return RedirectResponse(await storage.backend.presign(image_key), status_code=307, headers=headers)
+    return FileResponse(image_path, media_type=rendering.MEDIA_TYPES[variant.fmt], headers=headers)
@@ -1,10 +1,21 @@
 import asyncio
+import contextlib
 import json
+import re
 import uuid
+from collections import deque
+
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from redis.asyncio import Redis
+from redis.asyncio.client import PubSub
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from app import live_state, prefetch, ratelimit
+from app.config import get_settings
+from app.lua import Script
 
 router = APIRouter(tags=["websocket"])
+settings = get_settings()
 
 # Unique identifier for this process to avoid re-broadcasting our own Redis messages
 SERVER_ID = str(uuid.uuid4())
@@ -16,85 +27,530 @@ ALLOWED_WS_EVENTS = frozenset({
     "response_submitted", "new_response", "upvote", "heartbeat",
 })
 
+# High-frequency events merged into one "batch" frame per session per tick
+BATCHED_WS_EVENTS = frozenset({"new_response", "upvote", "tally_update", "word_cloud_update"})
+
+# Events that are fanned out live but never written to the replay log
+EPHEMERAL_WS_EVENTS = frozenset({"heartbeat", "prefetch"})
+
 # Maximum raw message size accepted from a client (64 KB)
 MAX_WS_MESSAGE_BYTES = 65_536
+# Inbound messages each socket may relay: bursts of 30, refilled at 3 per second
+WS_MESSAGE_LIMIT = ratelimit.Rule("token_bucket", 30, 10)
+
+# Replay cursors are Redis Stream ids: "<ms>-<seq>"
+_STREAM_ID_RE = re.compile(r"^\d+-\d+$")
+
+# Append to the capped per-session log and publish in one atomic step, so the
+# order of ids in the log always matches the order frames hit the channel.
+# The id is spliced into the already-serialised JSON object (which always has
+# an "event" key, so it is never empty).
+_PUBLISH_LOGGED = Script("""
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'm', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('PUBLISH', KEYS[2], '{"id": "' .. id .. '", ' .. string.sub(ARGV[2], 2))
+return id
+""")
+
+
+def _coalesce_key(message: dict) -> str | None:
+    """
+    Frames that share a key supersede each other: only the newest one matters.
+
+    A queued ``page_change`` is useless once the presenter has moved again, and
+    only the latest vote count of a given response needs to reach the screen.
+    """
+    event = message.get("event")
+    if event in ("slide_change", "page_change", "session_update", "prefetch"):
+        return event
+    if event == "upvote":
+        data = message.get("data")
+        if isinstance(data, dict) and data.get("id"):
+            return f"upvote:{data['id']}"
+    return None
+
+
+def _is_count(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class _Client:
+    """A connected socket with its own bounded outbound queue and writer task."""
+
+    __slots__ = ("websocket", "pending", "wakeup", "evicted", "task")
+
+    def __init__(self, websocket: WebSocket) -> None:
+        self.websocket = websocket
+        # (coalesce key, replay-log id, serialised frame)
+        self.pending: deque[tuple[str | None, str | None, str]] = deque()
+        self.wakeup = asyncio.Event()
+        self.evicted = False
+        self.task: asyncio.Task | None = None
+
+
+class _Batch:
+    """``BATCHED_WS_EVENTS`` collected for one session during one tick."""
+
+    __slots__ = ("new_responses", "upvotes", "tallies", "words", "last_id", "events", "timer")
+
+    def __init__(self) -> None:
+        self.new_responses: dict[str, dict] = {}
+        self.upvotes: dict[str, int] = {}
+        self.tallies: dict[str, dict[str, int]] = {}
+        self.words: dict[str, dict] = {}
+        self.last_id: str | None = None
+        self.events = 0
+        self.timer: asyncio.TimerHandle | None = None
+
+    @staticmethod
+    def accepts(message: dict) -> bool:
+        data = message.get("data")
+        if message.get("event") not in BATCHED_WS_EVENTS or not isinstance(data, dict):
+            return False
+        if message["event"] == "tally_update":
+            return bool(data.get("slide_id")) and isinstance(data.get("option"), str)
+        if message["event"] == "word_cloud_update":
+            return bool(data.get("slide_id")) and isinstance(data.get("terms"), dict)
+        # Clients relay these too, so the fields merged below must have the right types
+        if message["event"] == "upvote":
+            return isinstance(data.get("id"), str) and bool(data["id"]) and _is_count(data.get("upvotes"))
+        upvotes = data.get("upvotes")
+        return isinstance(data.get("id"), str) and bool(data["id"]) and (upvotes is None or _is_count(upvotes))
+
+    def add(self, message: dict) -> None:
+        data = message["data"]
+        if message["event"] == "tally_update":
+            self.tallies.setdefault(data["slide_id"], {})[data["option"]] = data.get("count")
+        elif message["event"] == "word_cloud_update":
+            merged = self.words.setdefault(data["slide_id"], {"terms": {}, "responses": 0})
+            merged["terms"].update(data["terms"])
+            merged["responses"] = max(merged["responses"], data.get("responses") or 0)
+        elif message["event"] == "new_response":
+            self.new_responses[data["id"]] = data
+        elif data["id"] in self.new_responses:
+            # Posted and upvoted within the same tick: ship the final count once
+            posted = self.new_responses[data["id"]]
+            self.new_responses[data["id"]] = {
+                **posted, "upvotes": max(posted.get("upvotes") or 0, data.get("upvotes") or 0)
+            }
+        else:
+            # Counts only grow; racing requests may publish out of order
+            self.upvotes[data["id"]] = max(self.upvotes.get(data["id"], 0), data.get("upvotes") or 0)
+        if message.get("id"):
+            self.last_id = message["id"]
+        self.events += 1
+
+    def frame(self) -> dict:
+        frame = {
+            "event": "batch",
+            "data": {
+                "new_responses": list(self.new_responses.values()),
+                "upvotes": self.upvotes,
+                "tallies": self.tallies,
+                "words": self.words,
+            },
+        }
+        if self.last_id:
+            frame = {"id": self.last_id, **frame}
+        return frame
 
 
 class ConnectionManager:
     """
     Manages WebSocket connections grouped by session code.
 
-    One shared Redis pubsub task per session code (not per connection).
-    With 80 audience members in one session this means 1 Redis subscription
-    instead of 80, and JSON is serialised once and fanned out to all sockets.
+    One Redis pubsub connection and one listener task per worker process.
+    Session channels are subscribed and unsubscribed on that connection as
+    sessions come and go, so 60 parallel sessions still cost a single Redis
+    connection, and JSON is serialised once and fanned out to all sockets.
+
+    Fan-out never awaits a socket: every client owns a bounded queue drained by
+    its own writer task, so one phone on bad Wi-Fi cannot stall the room.
+    When a queue is full the ``WS_SLOW_CONSUMER_POLICY`` decides whether the
+    client is dropped or its superseded frames are coalesced. A frame that
+    supersedes nothing still drops the client (close code 1013); it then
+    reconnects with its replay cursor and misses nothing.
+
+    ``BATCHED_WS_EVENTS`` are not sent one by one: they are collected per
+    session for ``WS_BATCH_INTERVAL_MS`` and leave as a single ``batch`` frame
+    carrying the new responses, the latest upvote counts, the latest poll
+    option counts and the word cloud term deltas.
+
+    The worker that relays a ``page_change`` or ``slide_change`` also renders
+    the next pages of the deck ahead of time (see ``app.prefetch``) and then
+    tells the room which pages are ready with a ``prefetch`` frame.
     """
 
     def __init__(self) -> None:
-        self._connections: dict[str, set[WebSocket]] = {}
-        self._pubsub_tasks: dict[str, asyncio.Task] = {}
+        self._connections: dict[str, dict[WebSocket, _Client]] = {}
+        self._counters: dict[str, dict[str, int]] = {}
+        self._pubsub: PubSub | None = None
+        self._listener: asyncio.Task | None = None
+        self._subscribed: set[str] = set()
+        self._subscription_lock = asyncio.Lock()
+        self._batches: dict[str, _Batch] = {}
+        self._prefetches: dict[str, asyncio.Task] = {}
+        self._redis: Redis | None = None
 
-    async def connect(self, session_code: str, websocket: WebSocket, redis: Redis) -> None:
+    async def connect(
+        self,
+        session_code: str,
+        websocket: WebSocket,
+        redis: Redis,
+        since: str | None = None,
+    ) -> None:
         await websocket.accept()
+        self._redis = redis
         if session_code not in self._connections:
-            self._connections[session_code] = set()
-            # Shared pubsub listener — started once per session, not per socket
-            pubsub = redis.pubsub()
-            await pubsub.subscribe(f"session:{session_code}")
-            task = asyncio.create_task(
-                self._listen(session_code, pubsub),
-                name=f"pubsub:{session_code}",
-            )
-            self._pubsub_tasks[session_code] = task
-        self._connections[session_code].add(websocket)
+            self._connections[session_code] = {}
+            self._counters[session_code] = {
+                "dropped_messages": 0,
+                "coalesced_messages": 0,
+                "dropped_connections": 0,
+                "batched_events": 0,
+                "batch_frames": 0,
+            }
+            await self._sync_subscription(session_code, redis)
+        client = _Client(websocket)
+        # Register before reading the log so nothing published meanwhile is lost;
+        # the writer only starts once the backlog sits in front of the live frames.
+        self._connections[session_code][websocket] = client
+        await self._replay(session_code, client, redis, since)
+        client.task = asyncio.create_task(
+            self._writer(session_code, client),
+            name=f"ws-writer:{session_code}",
+        )
 
     async def disconnect(self, session_code: str, websocket: WebSocket) -> None:
         bucket = self._connections.get(session_code)
         if not bucket:
             return
-        bucket.discard(websocket)
+        client = bucket.pop(websocket, None)
+        if client and client.task and client.task is not asyncio.current_task():
+            client.task.cancel()
         if not bucket:
             del self._connections[session_code]
-            task = self._pubsub_tasks.pop(session_code, None)
+            self._counters.pop(session_code, None)
+            batch = self._batches.pop(session_code, None)
+            if batch and batch.timer:
+                batch.timer.cancel()
+            task = self._prefetches.pop(session_code, None)
             if task:
                 task.cancel()
+            await self._sync_subscription(session_code)
 
     async def broadcast(self, session_code: str, message: dict) -> None:
+        if session_code not in self._connections:
+            return
+        if settings.WS_BATCH_INTERVAL_MS > 0 and _Batch.accepts(message):
+            batch = self._batches.get(session_code)
+            if batch is None:
+                batch = self._batches[session_code] = _Batch()
+                batch.timer = asyncio.get_running_loop().call_later(
+                    settings.WS_BATCH_INTERVAL_MS / 1000, self._flush_batch, session_code
+                )
+            batch.add(message)
+            return
+        # Nothing may overtake the events still waiting in the batch (e.g. a
+        # slide_change must not arrive before responses to the previous slide)
+        self._flush_batch(session_code)
+        self._fan_out(session_code, message)
+        # Only the worker the presenter is connected to renders ahead
+        if message.get("event") in prefetch.TRIGGER_EVENTS and message.get("origin") == SERVER_ID:
+            self._schedule_prefetch(session_code, message)
+
+    def _schedule_prefetch(self, session_code: str, message: dict) -> None:
+        if self._redis is None:
+            return
+        # A newer page change makes the previous guess pointless
+        previous = self._prefetches.get(session_code)
+        if previous is not None and not previous.done():
+            previous.cancel()
+        task = asyncio.create_task(
+            self._prefetch(session_code, message, self._redis),
+            name=f"ws-prefetch:{session_code}",
+        )
+        self._prefetches[session_code] = task
+        task.add_done_callback(
+            lambda t: self._prefetches.pop(session_code, None)
+            if self._prefetches.get(session_code) is t else None
+        )
+
+    async def _prefetch(self, session_code: str, message: dict, redis: Redis) -> None:
+        try:
+            hint = await prefetch.run(redis, session_code, message)
+            if hint is None:
+                return
+            frame = await publish_event(
+                redis, session_code, {"event": "prefetch", "origin": SERVER_ID, "data": hint}
+            )
+            self._fan_out(session_code, frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[WS] Prefetch error: {e}")
+
+    def _flush_batch(self, session_code: str) -> None:
+        batch = self._batches.pop(session_code, None)
+        if batch is None:
+            return
+        if batch.timer:
+            batch.timer.cancel()
+        counters = self._counters.get(session_code)
+        if counters is not None:
+            counters["batched_events"] += batch.events
+            counters["batch_frames"] += 1
+        self._fan_out(session_code, batch.frame())
+
+    def _fan_out(self, session_code: str, message: dict) -> None:
         bucket = self._connections.get(session_code)
         if not bucket:
             return
-        # Serialise once, send to every socket
+        # Serialise once, hand the same string to every socket's queue
         payload = json.dumps(message)
-        dead: list[WebSocket] = []
-        for ws in list(bucket):
-            try:
-                await ws.send_text(payload)
-            except Exception:
-                dead.append(ws)
-        for ws in dead:
-            await self.disconnect(session_code, ws)
+        key = _coalesce_key(message)
+        event_id = message.get("id")
+        for client in list(bucket.values()):
+            self._enqueue(session_code, client, key, event_id, payload)
 
-    async def _listen(self, session_code: str, pubsub) -> None:
+    def _enqueue(
+        self,
+        session_code: str,
+        client: _Client,
+        key: str | None,
+        event_id: str | None,
+        payload: str,
+    ) -> None:
+        if client.evicted:
+            return
+        counters = self._counters[session_code]
+        if len(client.pending) >= settings.WS_SEND_QUEUE_SIZE:
+            if settings.WS_SLOW_CONSUMER_POLICY == "coalesce" and key is not None:
+                for i, (queued_key, _, _) in enumerate(client.pending):
+                    if queued_key == key:
+                        client.pending[i] = (key, event_id, payload)
+                        counters["coalesced_messages"] += 1
+                        return
+            # Nothing to merge with. Losing a frame silently would leave the
+            # client behind its own replay cursor, so it is dropped instead
+            # and catches up from the log when it reconnects.
+            counters["dropped_messages"] += len(client.pending) + 1
+            counters["dropped_connections"] += 1
+            client.pending.clear()
+            client.evicted = True
+            client.wakeup.set()
+            return
+        client.pending.append((key, event_id, payload))
+        client.wakeup.set()
+
+    async def _writer(self, session_code: str, client: _Client) -> None:
+        websocket = client.websocket
         try:
-            async for message in pubsub.listen():
-                if message["type"] == "message":
+            while True:
+                await client.wakeup.wait()
+                client.wakeup.clear()
+                if client.evicted:
+                    # 1013 = try again later; the client reconnects and resyncs
+                    await websocket.close(code=1013)
+                    break
+                while client.pending:
+                    _, _, payload = client.pending.popleft()
+                    await asyncio.wait_for(
+                        websocket.send_text(payload),
+                        timeout=settings.WS_SEND_TIMEOUT_SECONDS,
+                    )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            counters = self._counters.get(session_code)
+            if counters is not None:
+                counters["dropped_messages"] += len(client.pending)
+                counters["dropped_connections"] += 1
+            with contextlib.suppress(Exception):
+                await asyncio.wait_for(websocket.close(code=1011), timeout=1)
+        await self.disconnect(session_code, websocket)
+
+    async def _replay(
+        self,
+        session_code: str,
+        client: _Client,
+        redis: Redis,
+        since: str | None,
+    ) -> None:
+        """
+        Put the frames a reconnecting client missed in front of its queue.
+
+        Without a cursor the client learns where the log currently ends and,
+        for a live session, gets a snapshot of the room from the cached live
+        state. When the cursor has been trimmed out of the log the gap cannot
+        be filled, so the client gets that snapshot instead (or is told to
+        resync from the REST endpoints if the session is not live).
+        """
+        key = _log_key(session_code)
+        resumable = since is not None and _STREAM_ID_RE.match(since)
+        # Inclusive range: the cursor itself must still be in the log,
+        # otherwise entries after it may have been trimmed away
+        entries = await redis.xrange(key, min=since) if resumable else []
+        if entries and entries[0][0] == since:
+            backlog = [
+                (None, entry_id, _log_frame(entry_id, fields["m"]))
+                for entry_id, fields in entries[1:]
+            ]
+        else:
+            # The head is read before the snapshot, so everything up to it is
+            # already reflected there and only later frames are sent live
+            latest = await redis.xrevrange(key, count=1)
+            head = latest[0][0] if latest else "0-0"
+            backlog = [(None, head, json.dumps({"event": "cursor", "id": head}))]
+            snapshot = await live_state.get_snapshot(redis, session_code)
+            if snapshot and snapshot["is_live"]:
+                backlog.append((None, head, json.dumps({"event": "snapshot", "data": snapshot})))
+            elif resumable:
+                backlog.append((None, head, json.dumps({"event": "resync"})))
+        if not backlog:
+            return
+        # Live frames that arrived while the log was read are already in the backlog
+        cutoff = _stream_id_key(backlog[-1][1])
+        live = [
+            item for item in client.pending
+            if item[1] is None or _stream_id_key(item[1]) > cutoff
+        ]
+        client.pending = deque(backlog + live)
+        client.wakeup.set()
+
+    def stats(self) -> dict[str, dict]:
+        """Per-session queue depth, drop and batching counters for this worker process."""
+        out: dict[str, dict] = {}
+        for session_code, bucket in self._connections.items():
+            depths = [len(client.pending) for client in bucket.values()]
+            counters = self._counters.get(session_code, {})
+            frames = counters.get("batch_frames", 0)
+            out[session_code] = {
+                "connections": len(bucket),
+                "queued_messages": sum(depths),
+                "max_queue_depth": max(depths, default=0),
+                **counters,
+                # Events folded into each batch frame on average
+                "batch_compression_ratio": (
+                    round(counters["batched_events"] / frames, 2) if frames else None
+                ),
+            }
+        return out
+
+    async def _sync_subscription(self, session_code: str, redis: Redis | None = None) -> None:
+        """Make the shared pubsub connection's channel set match the hosted sessions."""
+        async with self._subscription_lock:
+            if self._pubsub is None:
+                if redis is None:
+                    return
+                # A private control channel keeps the connection subscribed (and
+                # the listener alive) while this worker hosts no sessions
+                self._pubsub = redis.pubsub()
+                await self._pubsub.subscribe(f"worker:{SERVER_ID}")
+                self._start_listener()
+            wanted = session_code in self._connections
+            if wanted and session_code not in self._subscribed:
+                await self._pubsub.subscribe(f"session:{session_code}")
+                self._subscribed.add(session_code)
+            elif not wanted and session_code in self._subscribed:
+                await self._pubsub.unsubscribe(f"session:{session_code}")
+                self._subscribed.discard(session_code)
+
+    def _start_listener(self) -> None:
+        self._listener = asyncio.create_task(self._listen(), name="pubsub")
+        self._listener.add_done_callback(self._listener_done)
+
+    def _listener_done(self, task: asyncio.Task) -> None:
+        # Every session on this worker depends on this one task, so it must not stay down
+        if task.cancelled() or task is not self._listener or self._pubsub is None:
+            return
+        print(f"[WS] Pubsub listener stopped ({task.exception()!r}), restarting")
+        asyncio.get_running_loop().call_later(1, self._restart_listener, task)
+
+    def _restart_listener(self, stopped: asyncio.Task) -> None:
+        if self._listener is stopped and self._pubsub is not None:
+            self._start_listener()
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async for message in self._pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    channel = message["channel"]
+                    if not channel.startswith("session:"):
+                        continue
                     try:
                         data = json.loads(message["data"])
                         if data.get("origin") == SERVER_ID:
                             continue
-                        await self.broadcast(session_code, data)
-                    except (json.JSONDecodeError, KeyError):
+                        await self.broadcast(channel.removeprefix("session:"), data)
+                    except (json.JSONDecodeError, KeyError, AttributeError):
                         pass
-        except asyncio.CancelledError:
-            await pubsub.unsubscribe(f"session:{session_code}")
+                    except Exception as e:
+                        print(f"[WS] Error relaying {channel}: {e!r}")
+            except RedisConnectionError:
+                # redis-py re-subscribes every channel when the connection comes back
+                await asyncio.sleep(1)
+
+    async def close(self) -> None:
+        """Stop the shared listener and release its Redis connection."""
+        for task in self._prefetches.values():
+            task.cancel()
+        self._prefetches.clear()
+        if self._listener:
+            self._listener.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._listener
+            self._listener = None
+        if self._pubsub:
+            await self._pubsub.aclose()
+            self._pubsub = None
+        self._subscribed.clear()
+
+
+def _log_key(session_code: str) -> str:
+    return f"events:session:{session_code}"
+
+
+def _log_frame(entry_id: str, payload: str) -> str:
+    return '{"id": "' + entry_id + '", ' + payload[1:]
+
+
+def _stream_id_key(entry_id: str) -> tuple[int, int]:
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq)
+
+
+async def publish_event(redis: Redis, session_code: str, message: dict) -> dict:
+    """
+    Publish ``message`` to every worker hosting ``session_code``.
+
+    Non-ephemeral events are also appended to the session's capped replay log;
+    the returned copy of the message carries its log ``id``, which clients
+    send back as ``?since=`` when they reconnect.
+    """
+    payload = json.dumps(message)
+    channel = f"session:{session_code}"
+    if message.get("event") in EPHEMERAL_WS_EVENTS:
+        await redis.publish(channel, payload)
+        return message
+    event_id = await _PUBLISH_LOGGED(
+        redis,
+        [_log_key(session_code), channel],
+        [settings.WS_REPLAY_MAXLEN, payload, settings.WS_REPLAY_TTL_SECONDS],
+    )
+    return {"id": event_id, **message}
 
 
 manager = ConnectionManager()
 
 
 @router.websocket("/ws/{session_code}")
-async def websocket_endpoint(websocket: WebSocket, session_code: str):
+async def websocket_endpoint(websocket: WebSocket, session_code: str, since: str | None = None):
     redis: Redis = websocket.app.state.redis
-    await manager.connect(session_code, websocket, redis)
+    socket_id = uuid.uuid4().hex
+    await manager.connect(session_code, websocket, redis, since=since)
     try:
         while True:
             try:
@@ -108,9 +564,20 @@ async def websocket_endpoint(websocket: WebSocket, session_code: str):
                 # Drop unknown event types to prevent UI injection by guests
                 if message.get("event") not in ALLOWED_WS_EVENTS:
                     continue
+                # Relayed responses and votes must be shaped like the server's own
+                if message["event"] in BATCHED_WS_EVENTS and not _Batch.accepts(message):
+                    continue
+                # A heartbeat only keeps the socket open: nothing to relay or count
+                if message["event"] in EPHEMERAL_WS_EVENTS:
+                    continue
+                # Drop messages from sockets flooding the room
+                decision = await ratelimit.hit(redis, f"ws:{socket_id}", WS_MESSAGE_LIMIT)
+                if not decision.allowed:
+                    continue
+                message.pop("id", None)
                 message.setdefault("origin", SERVER_ID)
+                message = await publish_event(redis, session_code, message)
                 await manager.broadcast(session_code, message)
-                await redis.publish(f"session:{session_code}", json.dumps(message))
             except WebSocketDisconnect:
                 break
             except Exception as e:
@@ -248,6 +248,12 @@ class ResponseOut(BaseModel):
     model_config = {"from_attributes": True}
 
 
+class UpvoteOut(BaseModel):
+    id: uuid.UUID
+    slide_id: uuid.UUID
+    upvotes: int
+
+
 # ── Session Assets ────────────────────────────────────
 class SessionAssetOut(BaseModel):
     id: uuid.UUID
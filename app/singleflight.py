@@ -0,0 +1,173 @@
+"""
+Collapse concurrent identical work into one execution.
+
+``SingleFlight.do`` lets the first caller for a key start the work. Callers
+that arrive while it runs await the same result instead of repeating it.
+That covers one process. ``across_workers`` extends the idea to every app
+worker with a Redis lock: the lock holder computes, and the others poll a
+cheap ``peek`` (for example "is the file in the cache yet?") until the
+result shows up. If the holder dies, its lock expires and a waiter takes
+over.
+
+``coalesce`` applies the same idea to read endpoints. When a room opens its
+phones at once, the identical requests that arrive while one is being
+answered wait for that answer: one DB round trip and one serialization per
+burst in each worker. Each endpoint counts its collapsed requests in
+``endpoint_stats()``.
+"""
+import asyncio
+import functools
+import inspect
+import time
+import uuid
+from collections.abc import Awaitable, Callable, Hashable
+from datetime import date
+from enum import Enum
+from typing import TypeVar
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse, Response
+from redis.asyncio import Redis
+
+from app.lua import Script
+
+T = TypeVar("T")
+
+# Release the lock only if we still hold it (it may have expired and moved on)
+_RELEASE = Script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        self._calls: dict[str, asyncio.Future] = {}
+        self.metrics = {"executions": 0, "collapsed": 0, "remote_hits": 0, "takeovers": 0}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """Run ``fn()`` once for all concurrent callers of ``key`` in this process."""
+        future = self._calls.get(key)
+        if future is None:
+            self.metrics["executions"] += 1
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.metrics["collapsed"] += 1
+        # A caller that goes away (client disconnect) must not cancel the shared work
+        return await asyncio.shield(future)
+
+    async def across_workers(
+        self,
+        redis: Redis,
+        key: str,
+        compute: Callable[[], Awaitable[T]],
+        peek: Callable[[], Awaitable[T | None]],
+        lock_ttl: float,
+    ) -> T:
+        """
+        Run ``compute()`` in at most one worker at a time for ``key``.
+        Other workers wait until ``peek()`` returns a result. They give up
+        waiting and compute for themselves once the lock is gone.
+        """
+        lock_key = f"lock:{key}"
+        token = uuid.uuid4().hex
+        delay = 0.02
+        deadline = time.monotonic() + lock_ttl
+        waited = False
+        while True:
+            # Look before locking: the previous holder may have just finished
+            if waited:
+                result = await peek()
+                if result is not None:
+                    self.metrics["remote_hits"] += 1
+                    return result
+            if await redis.set(lock_key, token, nx=True, px=int(lock_ttl * 1000)):
+                try:
+                    return await compute()
+                finally:
+                    await _RELEASE(redis, [lock_key], [token])
+            if time.monotonic() > deadline:
+                # The holder overran its own lock; stop waiting on it
+                self.metrics["takeovers"] += 1
+                return await compute()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.25)
+            waited = True
+
+    def stats(self) -> dict:
+        return {"in_flight": self.in_flight, **self.metrics}
+
+
+# Arguments that identify a request by default; dependencies (db, request) do not
+_KEY_TYPES = (str, int, float, bool, date, uuid.UUID, Enum, type(None))
+
+_endpoint_flights: dict[str, SingleFlight] = {}
+
+
+def _render(result) -> Response:
+    if isinstance(result, Response):
+        return result
+    return ORJSONResponse(jsonable_encoder(result))
+
+
+def _copy(response: Response) -> Response:
+    """A response of its own for each caller; middleware edits headers in place."""
+    clone = Response(content=response.body, status_code=response.status_code)
+    clone.raw_headers = list(response.raw_headers)
+    return clone
+
+
+def coalesce(name: str, key: Callable[..., Hashable] | None = None):
+    """
+    Share one execution of a read endpoint among identical concurrent calls.
+
+    Calls are identical when ``key(**arguments)`` matches; by default that
+    is the endpoint's plain arguments (path and query parameters). Pass
+    ``key`` when a header changes the answer. The result is rendered once
+    (``ORJSONResponse`` unless it is already a ``Response``), so it skips
+    ``response_model`` filtering; use it on endpoints that return exactly
+    what they send. Errors, such as a 404, are shared the same way.
+    """
+    flight = _endpoint_flights.setdefault(name, SingleFlight())
+
+    def decorate(fn: Callable[..., Awaitable]):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs) -> Response:
+            arguments = signature.bind(*args, **kwargs).arguments
+            if key is not None:
+                parts = key(**arguments)
+            else:
+                parts = tuple(sorted(
+                    (k, v) for k, v in arguments.items() if isinstance(v, _KEY_TYPES)
+                ))
+
+            async def run() -> Response:
+                return _render(await fn(*args, **kwargs))
+
+            return _copy(await flight.do(f"{name}:{parts!r}", run))
+
+        return wrapper
+
+    return decorate
+
+
+def endpoint_stats() -> dict:
+    """Executions and collapsed requests of each ``coalesce``-d endpoint (this worker)."""
+    return {
+        name: {
+            "in_flight": flight.in_flight,
+            "executions": flight.metrics["executions"],
+            "collapsed": flight.metrics["collapsed"],
+        }
+        for name, flight in _endpoint_flights.items()
+    }
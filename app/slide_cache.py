@@ -0,0 +1,149 @@
+"""
+Slide metadata cache for the guest write path.
+
+Every submission needs four facts about its slide: the session's join
+code, whether the slide is active, its type, and (for a poll) the options
+a vote may name. Those facts change only
+when the moderator acts, so they are cached at two levels:
+
+    in-process LRU   slide_id -> SlideMeta   (SLIDE_CACHE_SIZE entries)
+    Redis hash       slide:meta:{slide_id}   (LIVE_STATE_TTL_SECONDS)
+
+Invalidation is versioned. ``invalidate`` deletes the Redis hashes and
+bumps the ``slide:meta:version`` counter. Every worker compares that counter
+with its own copy at most once per ``SLIDE_CACHE_RECHECK_SECONDS``, and
+drops its whole LRU when the counter has moved. A worker that read
+Postgres before an invalidation may finish afterwards; it only fills the
+Redis hash if the counter still has the value it saw before the read, so
+a stale row can never outlive the invalidation.
+"""
+import json
+import time
+import uuid
+from collections import OrderedDict
+from typing import NamedTuple
+
+from redis.asyncio import Redis
+from sqlalchemy import select
+
+from app.config import get_settings
+from app.database import async_session
+from app.lua import Script
+from app.models import Session, Slide, SlideType
+
+settings = get_settings()
+
+_VERSION_KEY = "slide:meta:version"
+
+# Fill the cache only if no invalidation happened since the DB read began
+_FILL_IF_CURRENT = Script("""
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then return 0 end
+redis.call('HSET', KEYS[1], 'session_code', ARGV[3], 'is_active', ARGV[4], 'type', ARGV[5], 'options', ARGV[6])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+""")
+
+
+class SlideMeta(NamedTuple):
+    session_code: str
+    is_active: bool
+    type: SlideType
+    options: frozenset[str]  # a POLL slide's options; empty for other types
+
+
+_local: OrderedDict[str, SlideMeta] = OrderedDict()
+_version = "0"
+_checked_at = 0.0
+_counters = {"local_hits": 0, "redis_hits": 0, "db_loads": 0}
+
+
+def _meta_key(slide_id: uuid.UUID | str) -> str:
+    return f"slide:meta:{slide_id}"
+
+
+def _options(slide_type: SlideType, content_json: dict | None) -> frozenset[str]:
+    if slide_type != SlideType.POLL:
+        return frozenset()
+    options = (content_json or {}).get("options") or []
+    return frozenset(o for o in options if isinstance(o, str))
+
+
+def _remember(slide_id: str, meta: SlideMeta) -> None:
+    _local[slide_id] = meta
+    _local.move_to_end(slide_id)
+    while len(_local) > settings.SLIDE_CACHE_SIZE:
+        _local.popitem(last=False)
+
+
+async def _sync_version(redis: Redis) -> str:
+    """Drop the local LRU if any worker invalidated since the last check."""
+    global _version, _checked_at
+    now = time.monotonic()
+    if now - _checked_at >= settings.SLIDE_CACHE_RECHECK_SECONDS:
+        current = await redis.get(_VERSION_KEY) or "0"
+        if current != _version:
+            _local.clear()
+            _version = current
+        _checked_at = now
+    return _version
+
+
+async def get(redis: Redis, slide_id: uuid.UUID | str) -> SlideMeta | None:
+    """Return the slide's metadata, or ``None`` if the slide does not exist."""
+    slide_id = str(slide_id)
+    await _sync_version(redis)
+    meta = _local.get(slide_id)
+    if meta is not None:
+        _local.move_to_end(slide_id)
+        _counters["local_hits"] += 1
+        return meta
+
+    raw = await redis.hgetall(_meta_key(slide_id))
+    # Entries cached before options were tracked are loaded again
+    if raw and "options" in raw:
+        _counters["redis_hits"] += 1
+        meta = SlideMeta(
+            raw["session_code"], raw["is_active"] == "1", SlideType(raw["type"]),
+            frozenset(json.loads(raw["options"])),
+        )
+        _remember(slide_id, meta)
+        return meta
+
+    # Take the version from Redis itself so the fill check is not fooled
+    # by a local copy that is up to a recheck interval old
+    version = await redis.get(_VERSION_KEY) or "0"
+    async with async_session() as db:
+        row = (await db.execute(
+            select(Session.unique_code, Slide.is_active, Slide.type, Slide.content_json)
+            .join(Session, Session.id == Slide.session_id)
+            .where(Slide.id == uuid.UUID(slide_id))
+        )).one_or_none()
+    if row is None:
+        return None
+    _counters["db_loads"] += 1
+    meta = SlideMeta(row.unique_code, bool(row.is_active), row.type, _options(row.type, row.content_json))
+    filled = await _FILL_IF_CURRENT(
+        redis, [_meta_key(slide_id), _VERSION_KEY],
+        [version, settings.LIVE_STATE_TTL_SECONDS,
+         meta.session_code, int(meta.is_active), meta.type.value, json.dumps(sorted(meta.options))],
+    )
+    if filled:
+        _remember(slide_id, meta)
+    return meta
+
+
+async def invalidate(redis: Redis, slide_ids) -> None:
+    """Forget the given slides everywhere. Call after the change is committed."""
+    global _version
+    slide_ids = [str(sid) for sid in slide_ids]
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.incr(_VERSION_KEY)
+        if slide_ids:
+            pipe.delete(*[_meta_key(sid) for sid in slide_ids])
+        results = await pipe.execute()
+    _version = str(results[0])
+    _local.clear()
+
+
+def stats() -> dict:
+    return {"entries": len(_local), **_counters}
@@ -0,0 +1,264 @@
+"""
+Where uploaded files and rendered pages are kept.
+
+Everything is addressed by a key that reads like a relative path:
+``uploads/{sha256}.pdf`` for an upload (its ``file_url`` without the
+leading slash), ``renders/{digest[:2]}/{digest}/p3w1280.webp`` for a page
+image. ``backend`` is one of two drivers:
+
+- ``LocalStorage`` keeps keys as files under ``STORAGE_LOCAL_ROOT``. This
+  is the layout the app has always used, so nothing moves. The API serves
+  page images itself, straight from the render cache.
+- ``S3Storage`` keeps them in an S3-compatible bucket, so any number of API
+  replicas see the same files. Rendered pages are uploaded once. Clients
+  are then redirected to the bucket (a presigned URL, or
+  ``STORAGE_S3_PUBLIC_URL`` when a CDN or public bucket fronts it), so
+  image bytes no longer pass through the API. PyMuPDF and LibreOffice need
+  real files, so originals are also mirrored on demand into
+  ``STORAGE_CACHE_DIR``. Keys are content-addressed, so a mirrored copy is
+  never stale.
+
+``exists`` always asks the backend. Uploads are deleted by whichever
+replica releases them last, so a worker's memory of having seen a key
+cannot be trusted for deduplication.
+
+Keys are never trusted to stay inside a directory: a key that resolves
+outside its root raises ``ValueError``.
+"""
+import abc
+import asyncio
+import contextlib
+import os
+import shutil
+import tempfile
+import time
+
+from app.config import get_settings
+from app.singleflight import SingleFlight
+
+settings = get_settings()
+
+# Presigned URLs handed out; cleared whole when full
+_MAX_MEMO = 16384
+
+
+class Storage(abc.ABC):
+    """Interface shared by the drivers. All paths are local file paths."""
+
+    # Whether clients fetch objects from the store itself (see ``presign``)
+    remote = False
+
+    @abc.abstractmethod
+    async def put(
+        self, key: str, path: str, *, move: bool = False,
+        content_type: str | None = None, cache_control: str | None = None,
+    ) -> str:
+        """
+        Store the file at ``path`` under ``key``. With ``move`` the file is
+        handed over rather than copied. Returns a local path that holds the
+        bytes afterwards.
+        """
+
+    @abc.abstractmethod
+    async def get(self, key: str, path: str) -> None:
+        """Write the object to ``path``. Raises ``FileNotFoundError`` if missing."""
+
+    @abc.abstractmethod
+    async def delete(self, key: str) -> None:
+        """Remove the object; a missing one is not an error."""
+
+    @abc.abstractmethod
+    async def exists(self, key: str) -> bool:
+        """Whether the object is there, asked of the backend every time."""
+
+    async def presign(self, key: str, expires: int | None = None) -> str | None:
+        """A URL clients can fetch the object from directly, or ``None`` if the API must serve it."""
+        return None
+
+    @abc.abstractmethod
+    async def local_path(self, key: str) -> str:
+        """A local file with the object's bytes. Raises ``FileNotFoundError`` if missing."""
+
+    @abc.abstractmethod
+    def scratch_dir(self, prefix: str) -> str:
+        """
+        A local directory for files that will be ``put`` under ``prefix``
+        with ``move``. It is on the same filesystem as their final place, so
+        the move is an atomic rename.
+        """
+
+
+def _copy_atomic(source: str, target: str) -> None:
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".tmp-")
+    os.close(fd)
+    try:
+        shutil.copyfile(source, tmp)
+        os.replace(tmp, target)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+
+
+class LocalStorage(Storage):
+    """Keys are files under ``root``."""
+
+    def __init__(self, root: str) -> None:
+        self.root = os.path.realpath(root)
+
+    def path(self, key: str) -> str:
+        target = os.path.realpath(os.path.join(self.root, key))
+        if not target.startswith(self.root + os.sep):
+            raise ValueError(f"Storage key outside {self.root}: {key!r}")
+        return target
+
+    async def put(
+        self, key: str, path: str, *, move: bool = False,
+        content_type: str | None = None, cache_control: str | None = None,
+    ) -> str:
+        target = self.path(key)
+        if os.path.realpath(path) == target:
+            return target
+        if move:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            await asyncio.to_thread(shutil.move, path, target)
+        else:
+            await asyncio.to_thread(_copy_atomic, path, target)
+        return target
+
+    async def get(self, key: str, path: str) -> None:
+        await asyncio.to_thread(_copy_atomic, self.path(key), path)
+
+    async def delete(self, key: str) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path(key))
+
+    async def exists(self, key: str) -> bool:
+        return os.path.isfile(self.path(key))
+
+    def scratch_dir(self, prefix: str) -> str:
+        target = self.path(prefix)
+        os.makedirs(target, exist_ok=True)
+        return target
+
+    async def local_path(self, key: str) -> str:
+        target = self.path(key)
+        if not os.path.isfile(target):
+            raise FileNotFoundError(key)
+        return target
+
+
+class S3Storage(Storage):
+    """Keys are objects in ``STORAGE_S3_BUCKET``, mirrored locally when read."""
+
+    remote = True
+
+    def __init__(self) -> None:
+        try:
+            import boto3
+            from botocore.config import Config
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND=s3 needs boto3 (pip install boto3)")
+        self._client_error = ClientError
+        endpoint = settings.STORAGE_S3_ENDPOINT_URL or None
+        self._client = boto3.client(
+            "s3",
+            endpoint_url=endpoint,
+            region_name=settings.STORAGE_S3_REGION,
+            aws_access_key_id=settings.STORAGE_S3_ACCESS_KEY or None,
+            aws_secret_access_key=settings.STORAGE_S3_SECRET_KEY or None,
+            # Stand-ins like MinIO do not do virtual-hosted buckets
+            config=Config(signature_version="s3v4", s3={"addressing_style": "path" if endpoint else "auto"}),
+        )
+        self.bucket = settings.STORAGE_S3_BUCKET
+        self._mirror = LocalStorage(settings.STORAGE_CACHE_DIR)
+        self._downloads = SingleFlight()
+        self._signed: dict[str, tuple[str, float]] = {}
+
+    def _missing(self, e: Exception) -> bool:
+        code = getattr(e, "response", {}).get("Error", {}).get("Code")
+        return code in ("404", "NoSuchKey", "NotFound")
+
+    async def put(
+        self, key: str, path: str, *, move: bool = False,
+        content_type: str | None = None, cache_control: str | None = None,
+    ) -> str:
+        extra = {}
+        if content_type:
+            extra["ContentType"] = content_type
+        if cache_control:
+            extra["CacheControl"] = cache_control
+        await asyncio.to_thread(self._client.upload_file, path, self.bucket, key, ExtraArgs=extra)
+        if move:
+            # Keep the bytes as the local mirror, so this worker never downloads them
+            return await self._mirror.put(key, path, move=True)
+        return path
+
+    def _download(self, key: str, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".tmp-")
+        os.close(fd)
+        try:
+            self._client.download_file(self.bucket, key, tmp)
+            os.replace(tmp, path)
+        except self._client_error as e:
+            if self._missing(e):
+                raise FileNotFoundError(key) from e
+            raise
+        finally:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+
+    async def get(self, key: str, path: str) -> None:
+        await asyncio.to_thread(self._download, key, path)
+
+    async def delete(self, key: str) -> None:
+        self._signed.pop(key, None)
+        await asyncio.to_thread(self._client.delete_object, Bucket=self.bucket, Key=key)
+        await self._mirror.delete(key)
+
+    async def exists(self, key: str) -> bool:
+        try:
+            await asyncio.to_thread(self._client.head_object, Bucket=self.bucket, Key=key)
+        except self._client_error as e:
+            if self._missing(e):
+                return False
+            raise
+        return True
+
+    async def presign(self, key: str, expires: int | None = None) -> str | None:
+        if settings.STORAGE_S3_PUBLIC_URL:
+            return f"{settings.STORAGE_S3_PUBLIC_URL.rstrip('/')}/{key}"
+        expires = expires or settings.STORAGE_PRESIGN_SECONDS
+        now = time.time()
+        cached = self._signed.get(key)
+        # Reused for half its lifetime, so browsers see a stable URL and keep their cached copy
+        if cached and cached[1] - now > expires / 2:
+            return cached[0]
+        url = self._client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": key}, ExpiresIn=expires
+        )
+        if len(self._signed) >= _MAX_MEMO:
+            self._signed.clear()
+        self._signed[key] = (url, now + expires)
+        return url
+
+    async def local_path(self, key: str) -> str:
+        target = self._mirror.path(key)
+        if not os.path.isfile(target):
+            await self._downloads.do(key, lambda: self.get(key, target))
+        return target
+
+    def scratch_dir(self, prefix: str) -> str:
+        return self._mirror.scratch_dir(prefix)
+
+
+def _backend() -> Storage:
+    if settings.STORAGE_BACKEND == "s3":
+        return S3Storage()
+    return LocalStorage(settings.STORAGE_LOCAL_ROOT)
+
+
+backend = _backend()
@@ -0,0 +1,173 @@
+"""
+Live vote counts for POLL slides.
+
+Each poll slide has one Redis hash, ``tally:slide:{slide_id}``, that maps each
+option to its vote count. The empty-string field holds the total; responses
+can never be empty, so it cannot clash with an option. ``submit_response``
+bumps the hash atomically, so reading the results costs one HGETALL however
+many people have voted. A missing hash (expired, or written before tallies
+existed) is rebuilt from the ``responses`` table with a single GROUP BY.
+
+While a rebuild runs, votes cannot be counted into the hash, and the query
+may or may not have seen them. They are queued by response id in
+``tally:slide:{slide_id}:pending`` instead. The rebuild then asks its own
+database snapshot which of them it already counted, adds the rest, and
+installs the result in the same step that clears the queue. It also notes
+the recent votes it counted in ``tally:slide:{slide_id}:counted``, so one
+that was committed before the query but counts itself only afterwards is
+not counted twice.
+"""
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from redis.asyncio import Redis
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import get_settings
+from app.database import async_session
+from app.lua import Script
+from app.models import Response
+
+settings = get_settings()
+
+_TOTAL_FIELD = ""
+# Marks a rebuild in progress; response ids can never be empty
+_REBUILDING_FIELD = ""
+# A rebuilder that died stops holding votes back after this long. Also the
+# longest a vote may take from its commit to counting itself.
+_PENDING_TTL_SECONDS = 60
+
+# Count a vote into the built tally, or queue it for the rebuild (false).
+# A vote the rebuild already found in the database is not counted again.
+_RECORD_VOTE = Script("""
+if redis.call('SISMEMBER', KEYS[3], ARGV[3]) == 1 then
+    return tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+end
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('HSET', KEYS[2], '', '', ARGV[3], ARGV[1])
+    redis.call('EXPIRE', KEYS[2], ARGV[4])
+    return false
+end
+redis.call('HINCRBY', KEYS[1], '', 1)
+local count = redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return count
+""")
+
+# Install a rebuilt tally if it accounts for every queued vote (ARGV[2] of
+# them); 0 means more arrived and the caller must look again. A concurrent
+# rebuild that got there first already took the queue. ARGV[4] recent vote
+# ids follow, then the tally's fields.
+_INSTALL_TALLY = Script("""
+if redis.call('EXISTS', KEYS[1]) == 1 then return 1 end
+local queued = redis.call('HLEN', KEYS[2])
+if redis.call('HEXISTS', KEYS[2], '') == 1 then queued = queued - 1 end
+if queued ~= tonumber(ARGV[2]) then return 0 end
+local recent = tonumber(ARGV[4])
+for i = 5, 4 + recent, 1000 do
+    redis.call('SADD', KEYS[3], unpack(ARGV, i, math.min(i + 999, 4 + recent)))
+end
+redis.call('EXPIRE', KEYS[3], ARGV[3])
+redis.call('HSET', KEYS[1], unpack(ARGV, 5 + recent))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('DEL', KEYS[2])
+return 1
+""")
+
+
+def _tally_key(slide_id: uuid.UUID | str) -> str:
+    return f"tally:slide:{slide_id}"
+
+
+def _pending_key(slide_id: uuid.UUID | str) -> str:
+    return f"tally:slide:{slide_id}:pending"
+
+
+def _counted_key(slide_id: uuid.UUID | str) -> str:
+    return f"tally:slide:{slide_id}:counted"
+
+
+def _counts(raw: dict[str, str]) -> dict[str, int]:
+    return {option: int(count) for option, count in raw.items() if option != _TOTAL_FIELD}
+
+
+async def _uncounted(db: AsyncSession, queued: dict[str, str]) -> dict[str, int]:
+    """Options of the queued votes that the open snapshot in ``db`` does not contain."""
+    ids = [uuid.UUID(response_id) for response_id in queued]
+    seen = set()
+    if ids:
+        seen = {str(i) for i in (await db.scalars(select(Response.id).where(Response.id.in_(ids))))}
+    extra: dict[str, int] = {}
+    for response_id, option in queued.items():
+        if response_id not in seen:
+            extra[option] = extra.get(option, 0) + 1
+    return extra
+
+
+async def _rebuild(redis: Redis, slide_id: uuid.UUID | str) -> dict[str, int]:
+    key, pending = _tally_key(slide_id), _pending_key(slide_id)
+    slide_uuid = uuid.UUID(str(slide_id))
+    # From here on votes are queued rather than dropped
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(pending, _REBUILDING_FIELD, "")
+        pipe.expire(pending, _PENDING_TTL_SECONDS)
+        await pipe.execute()
+    async with async_session() as db:
+        # Every query below sees the database as of the GROUP BY
+        await db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        rows = await db.execute(
+            select(Response.value, func.count(Response.id))
+            .where(Response.slide_id == slide_uuid)
+            .group_by(Response.value)
+        )
+        counted = {value: int(count) for value, count in rows.all()}
+        # Votes that may still be on their way to counting themselves
+        since = datetime.now(timezone.utc) - timedelta(seconds=_PENDING_TTL_SECONDS)
+        recent = [str(i) for i in await db.scalars(
+            select(Response.id).where(Response.slide_id == slide_uuid, Response.created_at >= since)
+        )]
+        while True:
+            queued = await redis.hgetall(pending)
+            queued.pop(_REBUILDING_FIELD, None)
+            counts = dict(counted)
+            for option, extra in (await _uncounted(db, queued)).items():
+                counts[option] = counts.get(option, 0) + extra
+            fields = [_TOTAL_FIELD, sum(counts.values())]
+            for option, count in counts.items():
+                fields += [option, count]
+            if await _INSTALL_TALLY(
+                redis,
+                [key, pending, _counted_key(slide_id)],
+                [
+                    settings.LIVE_STATE_TTL_SECONDS, len(queued), _PENDING_TTL_SECONDS,
+                    len(recent), *recent, *fields,
+                ],
+            ):
+                break
+    return _counts(await redis.hgetall(key))
+
+
+async def get_tally(redis: Redis, slide_id: uuid.UUID | str) -> dict:
+    """Return ``{"slide_id", "counts", "total"}`` for a poll slide."""
+    raw = await redis.hgetall(_tally_key(slide_id))
+    counts = _counts(raw) if raw else await _rebuild(redis, slide_id)
+    return {"slide_id": str(slide_id), "counts": counts, "total": sum(counts.values())}
+
+
+async def record_vote(
+    redis: Redis, slide_id: uuid.UUID | str, response_id: uuid.UUID | str, option: str
+) -> int:
+    """
+    Count the vote ``response_id`` for ``option`` and return that option's
+    new total. The vote may or may not be in the database yet (buffered
+    ingestion writes it later); a rebuild sorts out which.
+    """
+    count = await _RECORD_VOTE(
+        redis,
+        [_tally_key(slide_id), _pending_key(slide_id), _counted_key(slide_id)],
+        [option, settings.LIVE_STATE_TTL_SECONDS, str(response_id), _PENDING_TTL_SECONDS],
+    )
+    if count is None:
+        return (await _rebuild(redis, slide_id)).get(option, 0)
+    return int(count)
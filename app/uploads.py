@@ -0,0 +1,259 @@
+"""
+Streaming file uploads.
+
+FastAPI's ``UploadFile`` spools the whole request before the handler runs,
+and the handlers then read it into memory to check its size. Here the
+multipart body is parsed as it arrives instead. The file part is written
+in chunks to a temp file and hashed along the way. A request whose
+``Content-Length`` is already too big is refused before any of it is
+read. An upload without one is stopped as soon as it crosses the limit.
+Memory per request stays at one chunk, whatever the file size.
+
+The temp file is created in ``storage``'s scratch directory for
+``uploads/``, on the same filesystem as the stored files. ``Upload.save_as``
+then hands it over with a rename, so nothing ever serves a partially
+written upload. It also records the
+SHA-256 with ``rendering``, so the file is never read again to hash it.
+
+Stored files are content-addressed: ``store`` puts an upload at
+``uploads/{sha256}{ext}``. The same deck uploaded into thirty sessions is
+then one stored file. That one file has one PDF conversion
+(``conversion`` writes ``uploads/{sha256}.pdf``) and one set of rendered
+pages (the render cache is keyed by the same digest). A file's references
+are the ``SessionAsset`` rows whose ``file_url`` points at it. ``release``
+deletes it only once the last of them is gone. Both take a Postgres
+advisory lock on the url, so an identical upload committing at the same
+moment cannot lose its file.
+"""
+import asyncio
+import contextlib
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+from fastapi import HTTPException, Request
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+from app import rendering, storage
+from app.database import async_session
+from app.models import SessionAsset
+
+UPLOAD_DIR = "uploads"
+
+# Multipart boundaries and part headers on top of the file itself
+_ENVELOPE_BYTES = 64 * 1024
+
+
+class Upload:
+    """A received file, still in its temp location until ``save_as``."""
+
+    __slots__ = ("filename", "content_type", "size", "sha256", "_tmp")
+
+    def __init__(self, filename: str, content_type: str, size: int, sha256: str, tmp: str) -> None:
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.sha256 = sha256
+        self._tmp = tmp
+
+    @property
+    def extension(self) -> str:
+        return Path(self.filename).suffix.lower()
+
+    async def save_as(self, key: str) -> None:
+        path = await storage.backend.put(key, self._tmp, move=True, content_type=self.content_type)
+        rendering.remember_digest(path, self.sha256)
+
+    def discard(self) -> None:
+        with contextlib.suppress(OSError):
+            os.unlink(self._tmp)
+
+
+def _too_large(max_mb: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"File size exceeds the {max_mb} MB limit")
+
+
+def _cleanup(fh, tmp: str | None) -> None:
+    if fh is not None:
+        fh.close()
+    if tmp is not None:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+
+
+def _write(fh, digest, pieces: list[bytes]) -> None:
+    for piece in pieces:
+        fh.write(piece)
+        digest.update(piece)
+
+
+async def receive(
+    request: Request, allowed_extensions: list[str], max_mb: int, field: str = "file"
+) -> Upload:
+    """Stream the ``field`` file part of a multipart request to a temp file."""
+    max_bytes = max_mb * 1024 * 1024
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > max_bytes + _ENVELOPE_BYTES:
+        raise _too_large(max_mb)
+
+    scratch = storage.backend.scratch_dir(UPLOAD_DIR)
+    state = {"name": b"", "value": b"", "disposition": b"", "type": b"", "in_file": False}
+    found: dict = {}
+    pending: list[bytes] = []
+    size = 0
+    digest = hashlib.sha256()
+    fh = None
+    tmp = None
+
+    def on_part_begin() -> None:
+        state.update(disposition=b"", type=b"", in_file=False)
+
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        state["name"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        state["value"] += data[start:end]
+
+    def on_header_end() -> None:
+        name = state["name"].lower()
+        if name == b"content-disposition":
+            state["disposition"] = state["value"]
+        elif name == b"content-type":
+            state["type"] = state["value"]
+        state["name"] = state["value"] = b""
+
+    def on_headers_finished() -> None:
+        nonlocal fh, tmp
+        _, options = parse_options_header(state["disposition"])
+        if options.get(b"name", b"").decode("latin-1") != field or b"filename" not in options or found:
+            return
+        # Strip any directory components from the filename to prevent path traversal
+        filename = Path(options[b"filename"].decode("utf-8", "replace")).name or "upload.bin"
+        ext = Path(filename).suffix.lower()
+        if ext not in allowed_extensions:
+            allowed = ", ".join(allowed_extensions)
+            raise HTTPException(
+                status_code=400,
+                detail=f"File type '{ext}' not allowed. Allowed types: {allowed}",
+            )
+        found.update(filename=filename, content_type=state["type"].decode("latin-1") or None)
+        fd, tmp = tempfile.mkstemp(dir=scratch, prefix=".upload-")
+        fh = os.fdopen(fd, "wb")
+        state["in_file"] = True
+
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        nonlocal size
+        if not state["in_file"]:
+            return
+        size += end - start
+        if size > max_bytes:
+            raise _too_large(max_mb)
+        pending.append(data[start:end])
+
+    def on_part_end() -> None:
+        state["in_file"] = False
+
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if pending:
+                await asyncio.to_thread(_write, fh, digest, pending[:])
+                pending.clear()
+        parser.finalize()
+        if not found:
+            raise HTTPException(status_code=400, detail="No file uploaded")
+        fh.close()
+    except MultipartParseError:
+        _cleanup(fh, tmp)
+        raise HTTPException(status_code=400, detail="Malformed multipart upload")
+    except BaseException:
+        _cleanup(fh, tmp)
+        raise
+    return Upload(
+        filename=found["filename"],
+        content_type=found["content_type"] or "application/octet-stream",
+        size=size,
+        sha256=digest.hexdigest(),
+        tmp=tmp,
+    )
+
+
+async def lock(db: AsyncSession, file_url: str) -> None:
+    """Serialize changes to the stored file at ``file_url`` until ``db`` commits."""
+    await db.execute(select(func.pg_advisory_xact_lock(func.hashtext(file_url))))
+
+
+def _url(key: str) -> str:
+    return f"/{key}"
+
+
+async def store(db: AsyncSession, upload: Upload, *, office: bool = False) -> tuple[str, bool]:
+    """
+    Put ``upload`` at its content address and return ``(file_url, converted)``.
+
+    If the same bytes are already stored, the upload is dropped and the
+    existing file reused. With ``office``, an existing PDF conversion of
+    those bytes is returned instead, with ``converted`` set. The locks are
+    held until the caller commits the row that references the file. If
+    that fails, the caller hands the url to ``abandon``.
+    """
+    try:
+        if office:
+            pdf_key = f"{UPLOAD_DIR}/{upload.sha256}.pdf"
+            await lock(db, _url(pdf_key))
+            if await storage.backend.exists(pdf_key):
+                return _url(pdf_key), True
+        key = f"{UPLOAD_DIR}/{upload.sha256}{upload.extension}"
+        await lock(db, _url(key))
+        if not await storage.backend.exists(key):
+            await upload.save_as(key)
+        return _url(key), False
+    finally:
+        # Already gone if it was moved into storage
+        upload.discard()
+
+
+async def abandon(db: AsyncSession, upload: Upload, file_url: str | None) -> None:
+    """
+    Clean up after an upload whose row was never committed: roll back,
+    drop the temp file and release the stored one if ``store`` got that far.
+    """
+    upload.discard()
+    try:
+        await db.rollback()
+        await release(file_url)
+    except Exception as e:
+        print(f"[uploads] Error: {e}")
+
+
+async def release(file_url: str | None) -> None:
+    """Delete the file at ``file_url`` if no asset references it any more. Call after committing."""
+    if not file_url:
+        return
+    async with async_session() as db:
+        await lock(db, file_url)
+        refs = await db.scalar(
+            select(func.count(SessionAsset.id)).where(SessionAsset.file_url == file_url)
+        )
+        if not refs:
+            try:
+                await storage.backend.delete(file_url.lstrip("/"))
+            except Exception as e:
+                print(f"[uploads] Error: {e}")
+        await db.commit()
@@ -0,0 +1,165 @@
+"""
+Upvote counters kept in Redis and written back to Postgres in bulk.
+
+Each upvote is a single atomic INCR on ``upvotes:{slide_id}:{response_id}``,
+with no row lock and no read-modify-write. The first upvote of a response
+that has no counter seeds it from ``responses.upvotes``. ``submit_response``
+seeds new responses at zero. The counter is the live value: it is used for
+the WebSocket frames, the snapshot cache, and ``list_responses``.
+
+Each touched counter is also added to the ``upvotes:dirty`` set.
+``run_flusher`` drains that set every ``UPVOTE_FLUSH_INTERVAL_SECONDS``.
+``flush_soon`` drains it straight away, in the background, when a session
+goes offline. Each drain
+writes the absolute counts with one ``UPDATE ... FROM (VALUES ...)``, so
+writing the same count twice does no harm. In buffered ingest mode a
+response may have no row yet; its counter goes back into the set only
+while the response is still queued in ``ingest`` and the counter is still
+there. Any other miss (a rejected insert, a deleted slide) is dropped.
+"""
+import asyncio
+import uuid
+
+from redis.asyncio import Redis
+from sqlalchemy import Integer, column, update, values
+from sqlalchemy.dialects.postgresql import UUID
+
+from app import ingest
+from app.config import get_settings
+from app.database import async_session
+from app.lua import Script
+from app.models import Response
+
+settings = get_settings()
+
+_DIRTY_KEY = "upvotes:dirty"
+_FLUSH_BATCH = 1000
+
+# Flushes started by flush_soon, referenced so they are not garbage-collected mid-run
+_background: set[asyncio.Task] = set()
+
+# Count one upvote and mark the counter dirty. A missing counter is seeded
+# from ARGV[3] when given, otherwise the caller must look the base value up
+_INCREMENT = Script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if not ARGV[3] then return false end
+    redis.call('SET', KEYS[1], ARGV[3])
+end
+local n = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('SADD', KEYS[2], ARGV[2])
+return n
+""")
+
+
+def _member(slide_id: uuid.UUID | str, response_id: uuid.UUID | str) -> str:
+    return f"{slide_id}:{response_id}"
+
+
+def _counter_key(member: str) -> str:
+    return f"upvotes:{member}"
+
+
+async def seed(redis: Redis, slide_id: uuid.UUID | str, response_id: uuid.UUID | str, count: int = 0) -> None:
+    """Start the counter of a fresh response so its first upvote never reads the database."""
+    await redis.set(
+        _counter_key(_member(slide_id, response_id)), count,
+        nx=True, ex=settings.LIVE_STATE_TTL_SECONDS,
+    )
+
+
+async def increment(
+    redis: Redis,
+    slide_id: uuid.UUID | str,
+    response_id: uuid.UUID | str,
+    base: int | None = None,
+) -> int | None:
+    """
+    Count one upvote and return the new total. Returns ``None`` when the
+    counter is cold and no ``base`` (the persisted count) was given.
+    """
+    member = _member(slide_id, response_id)
+    args = [settings.LIVE_STATE_TTL_SECONDS, member]
+    if base is not None:
+        args.append(base)
+    count = await _INCREMENT(redis, [_counter_key(member), _DIRTY_KEY], args)
+    return None if count is None else int(count)
+
+
+async def get_counts(redis: Redis, slide_id: uuid.UUID | str, response_ids: list) -> dict[str, int]:
+    """Live counts for the given responses; ids without a counter are left out."""
+    if not response_ids:
+        return {}
+    raw = await redis.mget([_counter_key(_member(slide_id, rid)) for rid in response_ids])
+    return {str(rid): int(count) for rid, count in zip(response_ids, raw) if count is not None}
+
+
+async def flush(redis: Redis) -> int:
+    """Write every dirty counter to ``responses.upvotes``. Returns the number of rows updated."""
+    updated = 0
+    while True:
+        members = await redis.spop(_DIRTY_KEY, _FLUSH_BATCH)
+        if not members:
+            return updated
+        try:
+            updated += await _write(redis, members)
+        except Exception:
+            # Leave them for the next run rather than losing the counts
+            await redis.sadd(_DIRTY_KEY, *members)
+            raise
+
+
+async def _write(redis: Redis, members: list[str]) -> int:
+    counts = await redis.mget([_counter_key(m) for m in members])
+    # A counter that expired has nothing left to write
+    live = {m: int(count) for m, count in zip(members, counts) if count is not None}
+    rows = [(uuid.UUID(m.split(":", 1)[1]), count) for m, count in live.items()]
+    if not rows:
+        return 0
+    counted = values(
+        column("id", UUID(as_uuid=True)), column("upvotes", Integer), name="counted"
+    ).data(rows)
+    async with async_session() as db:
+        result = await db.execute(
+            update(Response)
+            .where(Response.id == counted.c.id)
+            .values(upvotes=counted.c.upvotes)
+            .returning(Response.id)
+            .execution_options(synchronize_session=False)
+        )
+        written = {str(rid) for rid in result.scalars().all()}
+        await db.commit()
+    if settings.RESPONSE_INGEST_MODE == "buffered":
+        # Responses still queued for ingestion have no row yet; retry them later
+        missing = [m for m in live if m.split(":", 1)[1] not in written]
+        queued = await ingest.pending(redis, [m.split(":", 1)[1] for m in missing])
+        retry = [m for m, q in zip(missing, queued) if q]
+        if retry:
+            await redis.sadd(_DIRTY_KEY, *retry)
+    return len(written)
+
+
+async def _flush_logged(redis: Redis) -> None:
+    try:
+        await flush(redis)
+    except Exception as e:
+        print(f"[upvotes] Flush error: {e}")
+
+
+def flush_soon(redis: Redis) -> None:
+    """Start a flush without waiting for it; a failure leaves the counters for the next run."""
+    task = asyncio.create_task(_flush_logged(redis), name="upvotes-flush")
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+async def run_flusher(redis: Redis) -> None:
+    """Flush dirty counters on a fixed interval until cancelled."""
+    while True:
+        await asyncio.sleep(settings.UPVOTE_FLUSH_INTERVAL_SECONDS)
+        try:
+            await flush(redis)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[upvotes] Flush error: {e}")
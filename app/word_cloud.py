@@ -0,0 +1,256 @@
+"""
+Incremental term-frequency index for WORD_CLOUD slides.
+
+Every submission is normalised (NFKC, case-folded, split into words, stop
+words and one-letter tokens dropped, each term counted once per submission)
+and its terms are added to a per-slide Redis sorted set. The cloud is then
+read as the top N members instead of shipping every raw response to the
+browser. ``record`` reports only the terms that are now inside the top
+``WORD_CLOUD_TOP_K``, which is the delta pushed over the WebSocket.
+
+Redis layout (the first two share ``LIVE_STATE_TTL_SECONDS``):
+
+    words:slide:{id}          zset    term -> count
+    words:slide:{id}:n        string  number of submissions (also marks the index as built)
+    words:slide:{id}:pending  hash    response id -> its terms, while a rebuild runs
+    words:slide:{id}:counted  set     recent response ids the last rebuild found
+
+A cold index is rebuilt the same way as a poll tally (see ``app.tally``):
+submissions that arrive meanwhile are queued, the rebuild adds the ones
+its database snapshot did not see, and recent ones it did see are not
+counted a second time when they report in late.
+"""
+import re
+import unicodedata
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from redis.asyncio import Redis
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import get_settings
+from app.database import async_session
+from app.lua import Script
+from app.models import Response
+
+settings = get_settings()
+
+# Marks a rebuild in progress; response ids can never be empty
+_REBUILDING_FIELD = ""
+# A rebuilder that died stops holding submissions back after this long. Also
+# the longest a submission may take from its commit to counting itself.
+_PENDING_TTL_SECONDS = 60
+
+_WORD_RE = re.compile(r"[^\W_]+(?:['’][^\W_]+)*")
+
+STOP_WORDS = frozenset("""
+a about above after again against all am an and any are aren't as at be because
+been before being below between both but by can can't cannot could couldn't did
+didn't do does doesn't doing don't down during each few for from further had
+hadn't has hasn't have haven't having he he'd he'll he's her here here's hers
+herself him himself his how how's i i'd i'll i'm i've if in into is isn't it
+it's its itself just let's me more most mustn't my myself no nor not of off on
+once only or other ought our ours ourselves out over own same shan't she she'd
+she'll she's should shouldn't so some such than that that's the their theirs
+them themselves then there there's these they they'd they'll they're they've
+this those through to too under until up very was wasn't we we'd we'll we're
+we've were weren't what what's when when's where where's which while who who's
+whom why why's will with won't would wouldn't you you'd you'll you're you've
+your yours yourself yourselves
+""".split())
+
+# Count one submission into the built index and return the touched terms
+# that now rank inside the top K (the delta worth pushing), or queue it for
+# the rebuild (false). One the rebuild already found is not counted again.
+_RECORD = Script("""
+local function top(out)
+    for i = 5, #ARGV do
+        local rank = redis.call('ZREVRANK', KEYS[1], ARGV[i])
+        if rank and rank < tonumber(ARGV[2]) then
+            table.insert(out, ARGV[i])
+            table.insert(out, redis.call('ZSCORE', KEYS[1], ARGV[i]))
+        end
+    end
+    return out
+end
+if redis.call('SISMEMBER', KEYS[4], ARGV[3]) == 1 then
+    return top({tonumber(redis.call('GET', KEYS[2]) or '0')})
+end
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    redis.call('HSET', KEYS[3], '', '', ARGV[3], table.concat(ARGV, ' ', 5))
+    redis.call('EXPIRE', KEYS[3], ARGV[4])
+    return false
+end
+local n = redis.call('INCR', KEYS[2])
+for i = 5, #ARGV do
+    redis.call('ZINCRBY', KEYS[1], 1, ARGV[i])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return top({n})
+""")
+
+# Install a rebuilt index (staged under KEYS[5]) if it accounts for every
+# queued submission (ARGV[2] of them); 0 means more arrived and the caller
+# must look again. A concurrent rebuild that got there first already took
+# the queue. ARGV[5] recent response ids follow, then term/count pairs the
+# snapshot missed.
+_INSTALL = Script("""
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('DEL', KEYS[5])
+    return 1
+end
+local queued = redis.call('HLEN', KEYS[3])
+if redis.call('HEXISTS', KEYS[3], '') == 1 then queued = queued - 1 end
+if queued ~= tonumber(ARGV[2]) then return 0 end
+local recent = tonumber(ARGV[5])
+for i = 6, 5 + recent, 1000 do
+    redis.call('SADD', KEYS[4], unpack(ARGV, i, math.min(i + 999, 5 + recent)))
+end
+redis.call('EXPIRE', KEYS[4], ARGV[3])
+for i = 6 + recent, #ARGV, 2 do
+    redis.call('ZINCRBY', KEYS[5], ARGV[i + 1], ARGV[i])
+end
+if redis.call('EXISTS', KEYS[5]) == 1 then
+    redis.call('RENAME', KEYS[5], KEYS[1])
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+else
+    redis.call('DEL', KEYS[1])
+end
+redis.call('SET', KEYS[2], ARGV[4], 'EX', ARGV[1])
+redis.call('DEL', KEYS[3])
+return 1
+""")
+
+
+def _terms_key(slide_id: uuid.UUID | str) -> str:
+    return f"words:slide:{slide_id}"
+
+
+def _count_key(slide_id: uuid.UUID | str) -> str:
+    return f"words:slide:{slide_id}:n"
+
+
+def _pending_key(slide_id: uuid.UUID | str) -> str:
+    return f"words:slide:{slide_id}:pending"
+
+
+def _counted_key(slide_id: uuid.UUID | str) -> str:
+    return f"words:slide:{slide_id}:counted"
+
+
+def terms(text: str) -> list[str]:
+    """Normalise a submission into its distinct, meaningful terms (in order of appearance)."""
+    text = unicodedata.normalize("NFKC", text).casefold().replace("’", "'")
+    seen: dict[str, None] = {}
+    for word in _WORD_RE.findall(text):
+        if len(word) > 1 and word not in STOP_WORDS:
+            seen.setdefault(word[:64])
+    return list(seen)
+
+
+async def _uncounted(db: AsyncSession, queued: dict[str, str]) -> tuple[int, dict[str, int]]:
+    """How many queued submissions the open snapshot in ``db`` does not contain, and their terms."""
+    ids = [uuid.UUID(response_id) for response_id in queued]
+    seen = set()
+    if ids:
+        seen = {str(i) for i in (await db.scalars(select(Response.id).where(Response.id.in_(ids))))}
+    missed = 0
+    extra: dict[str, int] = {}
+    for response_id, joined in queued.items():
+        if response_id in seen:
+            continue
+        missed += 1
+        for term in joined.split():
+            extra[term] = extra.get(term, 0) + 1
+    return missed, extra
+
+
+async def _rebuild(redis: Redis, slide_id: uuid.UUID | str) -> None:
+    pending = _pending_key(slide_id)
+    slide_uuid = uuid.UUID(str(slide_id))
+    # From here on submissions are queued rather than dropped
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(pending, _REBUILDING_FIELD, "")
+        pipe.expire(pending, _PENDING_TTL_SECONDS)
+        await pipe.execute()
+    staging = f"{_terms_key(slide_id)}:rebuild:{uuid.uuid4().hex}"
+    async with async_session() as db:
+        # Every query below sees the database as of the first SELECT
+        await db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        rows = await db.execute(select(Response.value).where(Response.slide_id == slide_uuid))
+        values = rows.scalars().all()
+        counts: dict[str, int] = {}
+        for value in values:
+            for term in terms(value):
+                counts[term] = counts.get(term, 0) + 1
+        if counts:
+            items = list(counts.items())
+            async with redis.pipeline(transaction=False) as pipe:
+                for start in range(0, len(items), 1000):
+                    pipe.zadd(staging, dict(items[start:start + 1000]))
+                pipe.expire(staging, _PENDING_TTL_SECONDS)
+                await pipe.execute()
+        # Submissions that may still be on their way to counting themselves
+        since = datetime.now(timezone.utc) - timedelta(seconds=_PENDING_TTL_SECONDS)
+        recent = [str(i) for i in await db.scalars(
+            select(Response.id).where(Response.slide_id == slide_uuid, Response.created_at >= since)
+        )]
+        while True:
+            queued = await redis.hgetall(pending)
+            queued.pop(_REBUILDING_FIELD, None)
+            missed, extra = await _uncounted(db, queued)
+            pairs = [field for term, count in extra.items() for field in (term, count)]
+            if await _INSTALL(
+                redis,
+                [_terms_key(slide_id), _count_key(slide_id), pending, _counted_key(slide_id), staging],
+                [
+                    settings.LIVE_STATE_TTL_SECONDS, len(queued), _PENDING_TTL_SECONDS,
+                    len(values) + missed, len(recent), *recent, *pairs,
+                ],
+            ):
+                break
+
+
+async def top_terms(redis: Redis, slide_id: uuid.UUID | str, limit: int | None = None) -> dict:
+    """Return ``{"slide_id", "terms": [{"term", "count"}], "responses"}`` for the top ``limit`` terms."""
+    limit = limit or settings.WORD_CLOUD_TOP_K
+    if not await redis.exists(_count_key(slide_id)):
+        await _rebuild(redis, slide_id)
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.zrevrange(_terms_key(slide_id), 0, limit - 1, withscores=True)
+        pipe.get(_count_key(slide_id))
+        ranked, responses = await pipe.execute()
+    return {
+        "slide_id": str(slide_id),
+        "terms": [{"term": term, "count": int(count)} for term, count in ranked],
+        "responses": int(responses or 0),
+    }
+
+
+async def record(
+    redis: Redis, slide_id: uuid.UUID | str, response_id: uuid.UUID | str, text: str
+) -> dict:
+    """
+    Add the submission ``response_id`` to the index. Returns ``{"slide_id",
+    "terms", "responses"}`` where ``terms`` maps each touched term still
+    inside the top K to its new count. The submission may or may not be in
+    the database yet (buffered ingestion writes it later); a rebuild sorts
+    out which.
+    """
+    words = terms(text)
+    result = await _RECORD(
+        redis,
+        [_terms_key(slide_id), _count_key(slide_id), _pending_key(slide_id), _counted_key(slide_id)],
+        [settings.LIVE_STATE_TTL_SECONDS, settings.WORD_CLOUD_TOP_K, str(response_id), _PENDING_TTL_SECONDS, *words],
+    )
+    if result is None:
+        # Cold index: the rebuild counted this submission one way or the other
+        await _rebuild(redis, slide_id)
+        top = await top_terms(redis, slide_id)
+        changed = {t["term"]: t["count"] for t in top["terms"] if t["term"] in words}
+        return {"slide_id": str(slide_id), "terms": changed, "responses": top["responses"]}
+    responses, flat = result[0], result[1:]
+    changed = {flat[i]: int(float(flat[i + 1])) for i in range(0, len(flat), 2)}
+    return {"slide_id": str(slide_id), "terms": changed, "responses": int(responses)}
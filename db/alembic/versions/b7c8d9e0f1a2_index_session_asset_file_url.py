@@ -0,0 +1,22 @@
+"""Index session_assets.file_url for stored-file reference counts
+
+Revision ID: b7c8d9e0f1a2
+Revises: 9c1d2e3f4a5b
+Create Date: 2026-10-17 00:00:00.000000
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+revision: str = "b7c8d9e0f1a2"
+down_revision: Union[str, None] = "9c1d2e3f4a5b"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index("ix_session_assets_file_url", "session_assets", ["file_url"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_session_assets_file_url", table_name="session_assets")
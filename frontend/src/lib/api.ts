@@ -30,12 +30,16 @@ const withTimeout = async <T>(promise: Promise<T>, ms = 10000): Promise<T> => {
 };
 
 const getToken = () => (typeof localStorage !== 'undefined' ? localStorage.getItem('rforum_token') : null);
+const getGuestId = () => (typeof localStorage !== 'undefined' ? localStorage.getItem('rforum_guest_id') : null);
 
 const buildHeaders = (opts: { auth?: boolean; json?: boolean } = {}) => {
   const headers: Record<string, string> = {};
   if (opts.json) headers['Content-Type'] = 'application/json';
   const token = getToken();
   if (opts.auth && token) headers.Authorization = `Bearer ${token}`;
+  // Guest reads are rate limited per guest, so a room behind one NAT address is not throttled as one client
+  const guestId = getGuestId();
+  if (guestId) headers['X-Guest-Id'] = guestId;
   return headers;
 };
 
@@ -260,6 +264,16 @@ export async function upvoteResponse(slideId: string, responseId: string) {
   });
 }
 
+export async function getWordCloud(
+  slideId: string
+): Promise<{ slide_id: string; terms: { term: string; count: number }[]; responses: number }> {
+  return fetchJson(`/slides/${slideId}/words`, { method: 'GET' });
+}
+
+export async function getTally(slideId: string): Promise<{ slide_id: string; counts: Record<string, number>; total: number }> {
+  return fetchJson(`/slides/${slideId}/tally`, { method: 'GET' });
+}
+
 // ── Analytics ─────────────────────────────────────────
 export async function getAnalytics() {
   return fetchJson('/analytics', { method: 'GET' }, true);
@@ -332,6 +346,18 @@ export async function replaceAssetFile(assetId: string, file: File): Promise<any
   return res.json();
 }
 
+/** Status of a background office-to-PDF conversion (also pushed as `conversion_update` over the WebSocket) */
+export async function getConversion(jobId: string): Promise<{
+  id: string;
+  status: 'queued' | 'running' | 'done' | 'failed';
+  slide_id: string | null;
+  asset_id: string | null;
+  file_url: string | null;
+  error: string | null;
+}> {
+  return fetchJson(`/conversions/${jobId}`, { method: 'GET' }, true) as any;
+}
+
 export async function deleteAsset(assetId: string): Promise<void> {
   await fetchJson(`/assets/${assetId}`, { method: 'DELETE' }, true);
 }
@@ -360,7 +386,29 @@ export function resolveFileUrl(fileUrl?: string | null) {
   return `${origin}${trimmed}`;
 }
 
-/** Build the URL for a single rendered page image from the backend */
-export function getPageImageUrl(sessionId: string, slideId: string, page: number) {
-  return buildUrl(`/sessions/${sessionId}/slides/${slideId}/page/${page}`);
+/**
+ * Build the URL for a single rendered page image from the backend.
+ * `width` is the displayed width in CSS pixels; the server rounds it (times the
+ * device pixel ratio) up to a size bucket and picks WebP when the browser takes it.
+ */
+export function getPageImageUrl(sessionId: string, slideId: string, page: number, fileHash?: string, width?: number) {
+  const params = new URLSearchParams();
+  // The content hash makes the URL immutable, so the browser may cache it for good
+  if (fileHash) params.set('v', fileHash);
+  if (width) {
+    params.set('w', String(width));
+    const dpr = typeof window !== 'undefined' ? window.devicePixelRatio || 1 : 1;
+    params.set('dpr', String(Math.round(dpr * 100) / 100));
+  }
+  const query = params.toString();
+  return buildUrl(`/sessions/${sessionId}/slides/${slideId}/page/${page}${query ? `?${query}` : ''}`);
+}
+
+/** Pull pages the presenter is likely to show next into the browser's HTTP cache */
+export function prefetchPageImages(sessionId: string, slideId: string, pages: number[], fileHash?: string, width?: number) {
+  for (const page of pages) {
+    const img = new Image();
+    img.decoding = 'async';
+    img.src = getPageImageUrl(sessionId, slideId, page, fileHash, width);
+  }
 }
@@ -13,6 +13,8 @@ export class RforumWebSocket {
   private reconnectTimer: ReturnType<typeof setTimeout> | null = null;
   private closed = false;
   private heartbeatTimer: ReturnType<typeof setInterval> | null = null;
+  // Replay cursor: id of the last logged event seen, sent back as ?since= on reconnect
+  private lastEventId: string | null = null;
   public status: ConnectionStatus = 'disconnected';
 
   constructor(code: string) {
@@ -68,6 +70,27 @@ export class RforumWebSocket {
     this.socket.onmessage = (event) => {
       try {
         const data = JSON.parse(event.data);
+        if (typeof data?.id === 'string') this.lastEventId = data.id;
+        // Cursor frames only move the replay position; pages never see them
+        if (data?.event === 'cursor') return;
+        if (data?.event === 'batch') {
+          // The server merges bursts of responses/upvotes; pages see them one by one
+          for (const response of data.data?.new_responses ?? []) {
+            this.handler?.({ event: 'new_response', data: response });
+          }
+          for (const [id, upvotes] of Object.entries(data.data?.upvotes ?? {})) {
+            this.handler?.({ event: 'upvote', data: { id, upvotes } });
+          }
+          for (const [slide_id, counts] of Object.entries(data.data?.tallies ?? {})) {
+            for (const [option, count] of Object.entries(counts as Record<string, number>)) {
+              this.handler?.({ event: 'tally_update', data: { slide_id, option, count } });
+            }
+          }
+          for (const [slide_id, update] of Object.entries(data.data?.words ?? {})) {
+            this.handler?.({ event: 'word_cloud_update', data: { slide_id, ...(update as object) } });
+          }
+          return;
+        }
         this.handler?.(data);
       } catch (err) {
         console.warn('[ws] failed to parse message', err);
@@ -123,13 +146,14 @@ export class RforumWebSocket {
   }
 
   private buildUrl() {
+    const query = this.lastEventId ? `?since=${encodeURIComponent(this.lastEventId)}` : '';
     const base = (WS_ORIGIN || '').replace(/\/$/, '');
-    if (base) return `${base}/ws/${this.code}`;
+    if (base) return `${base}/ws/${this.code}${query}`;
 
     // Fallback to API origin converted to WS if available
     // Otherwise use current origin
     const api = (typeof window !== 'undefined' ? window.location.origin : 'http://localhost:8000');
     const wsBase = api.replace(/^http/, 'ws');
-    return `${wsBase}/ws/${this.code}`;
+    return `${wsBase}/ws/${this.code}${query}`;
   }
 }